@@ -0,0 +1,235 @@
+import json
+import time
+
+import numpy as np
+
+from fitstemplate import FitsTemplate, write_file
+from tilecompress import TileCompressor, is_supported
+
+# Compression algorithms tried by the adaptive writer, None is uncompressed
+ADAPTIVE_ALGORITHMS = ('RICE', 'GZIP', None)
+
+# -C value of the adaptive mode of pp_test.py
+ADAPTIVE = 'AUTO'
+
+# Header keys recording how each file was written
+METHOD_KEY = 'CMPMETH'
+QUANT_KEY = 'CMPQBITS'
+
+
+class AdaptiveWriter(object):
+    """Writes frame files with the best compression that keeps up with the camera.
+
+    A fixed compression type is either wasting disk bandwidth or falling behind the camera,
+    depending on the frame rate, the frame content and the disk or NFS server load. The
+    writer measures for every file how long the compression and the write took and how much
+    the frame compressed, and keeps running estimates (exponentially weighted averages) per
+    method of
+        - the compression time per raw byte,
+        - the compressed size per raw byte,
+    and of the output bandwidth of the disk. The time budget of a file is headroom times the
+    frame period, measured from the frame arrival times given to observe_frame() (the
+    exposure time until then).
+
+    A method is an algorithm of ADAPTIVE_ALGORITHMS and a number of quantization bits, the
+    low bits dropped by rounding the pixel values before the compression (lossy, only used up
+    to max_quant_bits and only if no lossless method fits in the budget). For each file the
+    writer picks, of the methods with the fewest quantization bits whose predicted time fits
+    in the budget, the one with the smallest predicted output; if none fits, the fastest
+    method. Methods without estimates are tried first, the lossy ones only once no method with
+    fewer quantization bits fits, and every probe_interval files the method measured longest
+    ago is tried again to follow changes.
+
+    The method is recorded in the METHOD_KEY and QUANT_KEY keys of each file header, and each
+    decision is appended to the decisions list and to the log_path JSON lines file if given.
+
+    Example:
+        writer = AdaptiveWriter(exposure_time, log_path='compression.jsonl')
+        writer.observe_frame(timestamp)
+        writer.write(path, data, header)
+    """
+
+    def __init__(self, frame_period, max_quant_bits=0, headroom=0.8, n_threads=None,
+                 probe_interval=50, smoothing=0.2, log_path=None, logger=None):
+        """
+        Args:
+            frame_period (float): expected seconds between frames, until measured.
+            max_quant_bits (int): maximum number of low bits dropped, 0 is lossless only.
+            headroom (float): fraction of the frame period available for writing a file.
+            n_threads (int, optional): tile compression threads, default number of CPUs.
+            probe_interval (int): files between trials of the method measured longest ago.
+            smoothing (float): weight of the latest measurement in the running estimates.
+            log_path (str, optional): JSON lines file of the decisions, overwritten.
+            logger (logging.Logger, optional): logger of the method changes.
+        """
+        self.frame_period = frame_period
+        self.headroom = headroom
+        self.probe_interval = probe_interval
+        self.smoothing = smoothing
+        self.logger = logger
+        self.decisions = []
+
+        self.methods = [(algorithm, quant_bits)
+                        for quant_bits in range(max_quant_bits + 1)
+                        for algorithm in ADAPTIVE_ALGORITHMS
+                        if algorithm is None or is_supported(algorithm)]
+        # per method: seconds per raw byte, output bytes per raw byte, file number measured
+        self._estimates = {}
+        self._write_bandwidth = None
+        self._compressors = {algorithm: TileCompressor(algorithm, n_threads=n_threads)
+                             for algorithm, _ in self.methods if algorithm is not None}
+        self._templates = {}
+        self._last_frame_time = None
+        self._method = None
+        self._log = open(log_path, 'w') if log_path is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def budget(self):
+        """Seconds available for writing a file """
+        return self.headroom * self.frame_period
+
+    @property
+    def stats(self):
+        """Number of files written with each method """
+        counts = {}
+        for decision in self.decisions:
+            method = f"{decision['method']}/{decision['quant_bits']}"
+            counts[method] = counts.get(method, 0) + 1
+        return counts
+
+    def observe_frame(self, timestamp):
+        """Update the frame period with the arrival time of a frame, in seconds """
+        if self._last_frame_time is not None and timestamp > self._last_frame_time:
+            self.frame_period = self._smooth(self.frame_period, timestamp - self._last_frame_time)
+        self._last_frame_time = timestamp
+
+    def write(self, path, data, header):
+        """Write a frame to a FITS file with the method chosen for it.
+
+        Args:
+            path (str): path of the file, overwritten if it exists.
+            data (numpy.ndarray): the frame.
+            header (dict): the frame header, METHOD_KEY and QUANT_KEY are added.
+
+        Returns:
+            dict: the decision, see the decisions attribute.
+        """
+        method, predicted, reason = self._choose(data.nbytes)
+        algorithm, quant_bits = method
+        header = dict(header)
+        header[METHOD_KEY] = algorithm or 'NONE'
+        header[QUANT_KEY] = quant_bits
+
+        start_time = time.perf_counter()
+        frame = quantize(data, quant_bits)
+        if algorithm is None:
+            buffers = self._template(frame, header).buffers(frame, header)
+        else:
+            buffers = self._compressors[algorithm].file_buffers(frame, header)
+        compressed_time = time.perf_counter()
+        write_file(path, buffers)
+        end_time = time.perf_counter()
+
+        output_bytes = sum(memoryview(buffer).nbytes for buffer in buffers)
+        self._update(method, data.nbytes, output_bytes, compressed_time - start_time,
+                     end_time - compressed_time)
+
+        decision = {'file': path,
+                    'time': time.time(),
+                    'method': algorithm or 'NONE',
+                    'quant_bits': quant_bits,
+                    'reason': reason,
+                    'budget_s': self.budget,
+                    'predicted_s': predicted,
+                    'compress_s': compressed_time - start_time,
+                    'write_s': end_time - compressed_time,
+                    'raw_bytes': data.nbytes,
+                    'output_bytes': output_bytes,
+                    'write_MBps': self._write_bandwidth / 1e6}
+        self.decisions.append(decision)
+        if self._log is not None:
+            self._log.write(json.dumps(decision) + '\n')
+        if method != self._method and reason != 'probe':
+            if self.logger is not None:
+                self.logger.info(f"Compression {method[0] or 'NONE'}, {quant_bits} quantization bits "
+                                 f"({reason}): predicted {predicted:.3f} s per file, "
+                                 f"budget {self.budget:.3f} s")
+            self._method = method
+        return decision
+
+    def close(self):
+        for compressor in self._compressors.values():
+            compressor.close()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    # Private methods
+
+    def _smooth(self, estimate, value):
+        if estimate is None:
+            return value
+        return (1 - self.smoothing) * estimate + self.smoothing * value
+
+    def _choose(self, raw_bytes):
+        predictions = {method: self._predict(method, raw_bytes) for method in self._estimates}
+        choice = None
+        for quant_bits in sorted({method[1] for method in self.methods}):
+            level = [method for method in self.methods if method[1] == quant_bits]
+            untried = [method for method in level if method not in self._estimates]
+            if untried:
+                # lossier methods are only tried when no method with fewer bits fits
+                return untried[0], None, 'probe'
+            fitting = [method for method in level if predictions[method] <= self.budget]
+            if fitting:
+                best = min(fitting, key=lambda method: self._estimates[method][1])
+                choice = best, predictions[best], 'budget'
+                break
+        if choice is None:
+            fastest = min(predictions, key=predictions.get)
+            choice = fastest, predictions[fastest], 'fastest'
+
+        n_files = len(self.decisions)
+        if self.probe_interval and n_files % self.probe_interval == self.probe_interval - 1:
+            # refresh the estimate measured longest ago, of the methods no lossier than the choice
+            candidates = [method for method in predictions if method[1] <= choice[0][1]]
+            oldest = min(candidates, key=lambda method: self._estimates[method][2])
+            return oldest, predictions[oldest], 'probe'
+        return choice
+
+    def _predict(self, method, raw_bytes):
+        seconds_per_byte, ratio, _ = self._estimates[method]
+        return raw_bytes * (seconds_per_byte + ratio / self._write_bandwidth)
+
+    def _update(self, method, raw_bytes, output_bytes, compress_time, write_time):
+        seconds_per_byte, ratio, _ = self._estimates.get(method, (None, None, None))
+        self._estimates[method] = (self._smooth(seconds_per_byte, compress_time / raw_bytes),
+                                   self._smooth(ratio, output_bytes / raw_bytes),
+                                   len(self.decisions))
+        # page cache writes can take no measurable time
+        self._write_bandwidth = self._smooth(self._write_bandwidth,
+                                             output_bytes / max(write_time, 1e-6))
+
+    def _template(self, data, header):
+        # a template with every key patched, reused while the frame layout and keys are the same
+        layout = (data.shape, data.dtype, tuple(header))
+        if layout not in self._templates:
+            self._templates[layout] = FitsTemplate(header, data.shape, data.dtype,
+                                                   frame_keys=tuple(header))
+        return self._templates[layout]
+
+
+def quantize(data, quant_bits):
+    """Round the pixel values to multiples of 2**quant_bits, within the dtype range """
+    if quant_bits == 0:
+        return data
+    step = 1 << quant_bits
+    info = np.iinfo(data.dtype)
+    rounded = (data.astype(np.int32) + step // 2) & ~(step - 1)
+    return np.clip(rounded, info.min, info.max & ~(step - 1)).astype(data.dtype)
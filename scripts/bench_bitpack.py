@@ -0,0 +1,125 @@
+"""Benchmark of the bit depth packing of RAW16 frames (pp_test.py --pack_bits).
+
+Writes synthetic 12 bit frames, left aligned in 16 bit words like the SDK returns them, with
+and without the right shift, uncompressed and RICE or GZIP compressed, and compares the file
+sizes and write times. Also compares copying the frames into a raw spool with the 12 bit
+packed spool frames:
+
+    python3 bench_bitpack.py
+    python3 bench_bitpack.py -o /mnt/nfs/tmp -n 20
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import fitsio
+import numpy as np
+
+from bitpack import FramePacker, pack12, packed12_size, packing_keys, unpack12
+from tilecompress import TileCompressor
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Bit depth packing benchmark')
+    parser.add_argument('-o', '--output_folder', type=str, default=None,
+                        help='Folder of the test files (default a temporary folder)')
+    parser.add_argument('-n', '--number', type=int, default=10,
+                        help='Number of frames written per measurement')
+    parser.add_argument('--width', type=int, default=2744, help='Frame width (default ASI183 bin 2)')
+    parser.add_argument('--height', type=int, default=1832, help='Frame height')
+    parser.add_argument('--bit_depth', type=int, default=12, help='ADC bit depth (default 12)')
+    parser.add_argument('--background', type=float, default=200, help='Sky background in ADU')
+    parser.add_argument('--noise', type=float, default=5, help='Noise sigma in ADU')
+    return parser.parse_args()
+
+
+def synthetic_frames(args, n_frames=4):
+    """Star field frames of bit_depth ADC values, left aligned in uint16 """
+    rng = np.random.default_rng(1)
+    max_value = (1 << args.bit_depth) - 1
+    sky = np.full((args.height, args.width), args.background, dtype=float)
+    # gaussian stars, sigma 1.5 pixels, in 15 x 15 stamps
+    y, x = np.mgrid[-7:8, -7:8]
+    for _ in range(200):
+        star_x = rng.integers(7, args.width - 8)
+        star_y = rng.integers(7, args.height - 8)
+        flux = rng.uniform(100, max_value)
+        sky[star_y - 7:star_y + 8, star_x - 7:star_x + 8] += flux * np.exp(-(x ** 2 + y ** 2) / 4.5)
+    frames = []
+    for _ in range(n_frames):
+        frame = np.clip(rng.normal(sky, args.noise), 0, max_value).astype(np.uint16)
+        frames.append(frame << (16 - args.bit_depth))
+    return frames
+
+
+def time_writes(frames, write, path, number):
+    """Best time of writing a frame, and the file size """
+    times = []
+    for index in range(number):
+        start_time = time.perf_counter()
+        write(path, frames[index % len(frames)])
+        times.append(time.perf_counter() - start_time)
+    return min(times), os.path.getsize(path)
+
+
+def main():
+    args = parse_args()
+    output_folder = args.output_folder or tempfile.mkdtemp(prefix='bench_bitpack')
+    path = os.path.join(output_folder, 'bench_bitpack.fits')
+    shift = 16 - args.bit_depth
+    frames = synthetic_frames(args)
+    raw_bytes = frames[0].nbytes
+    header = {'INSTRUME': 'bench'}
+    packed_header = dict(header, **packing_keys(shift, args.bit_depth))
+    packer = FramePacker(shift)
+
+    print(f'{args.width} x {args.height} {args.bit_depth} bit frames, {raw_bytes / 1e6:.1f} MB, '
+          f'files in {output_folder}')
+    print(f'{"writer":<24s} {"compress":<8s} {"packed":<6s} {"ms/frame":>9s} {"MB":>7s} {"ratio":>6s}')
+    for compress in (None, 'RICE', 'GZIP'):
+        writers = [('fitsio', lambda path, data, header, compress=compress:
+                    fitsio.write(path, data, header=header, compress=compress, clobber=True))]
+        if compress is not None:
+            compressor = TileCompressor(compress)
+            writers.append((f'TileCompressor {compressor.n_threads} thr', compressor.write))
+        for name, write in writers:
+            for packed in (False, True):
+                if packed:
+                    def write_frame(path, data, write=write):
+                        write(path, packer(data), packed_header)
+                else:
+                    def write_frame(path, data, write=write):
+                        write(path, data, header)
+                seconds, size = time_writes(frames, write_frame, path, args.number)
+                print(f'{name:<24s} {str(compress):<8s} {str(packed):<6s} {seconds * 1e3:9.1f} '
+                      f'{size / 1e6:7.2f} {raw_bytes / size:6.2f}')
+        if compress is not None:
+            compressor.close()
+
+    # the last file is a packed one
+    data = frames[(args.number - 1) % len(frames)]
+    assert np.array_equal(fitsio.read(path), data), 'packed frame not restored'
+
+    if args.bit_depth == 12:
+        slot = np.empty(data.shape, dtype=data.dtype)
+        packed_slot = np.empty(packed12_size(data.size), dtype=np.uint8)
+        assert np.array_equal(unpack12(pack12(data, out=packed_slot), data.shape), data)
+        for name, copy, size in (('spool copy', lambda: np.copyto(slot, data), data.nbytes),
+                                 ('spool pack12', lambda: pack12(data, out=packed_slot),
+                                  packed_slot.nbytes)):
+            times = []
+            for _ in range(args.number):
+                start_time = time.perf_counter()
+                copy()
+                times.append(time.perf_counter() - start_time)
+            print(f'{name:<24s} {"-":<8s} {str(size != data.nbytes):<6s} {min(times) * 1e3:9.1f} '
+                  f'{size / 1e6:7.2f} {raw_bytes / size:6.2f}')
+
+    os.remove(path)
+    if args.output_folder is None:
+        os.rmdir(output_folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Micro-benchmark of the per-call overhead of the ASI SDK ctypes calls.
+
+Compares the old ASIDriver call path (function looked up with getattr on every call, no
+argtypes/restype, new ctypes argument objects for every call) with the prototypes bound once
+at ASIDriver.__init__ and the reusable per-camera scratch arguments.
+
+Runs against the stub SDK library in ../sim, which returns immediately, so the numbers are
+pure Python/ctypes overhead:
+
+    make -C ../sim
+    python3 bench_ctypes.py
+"""
+import argparse
+import ctypes
+import os
+import subprocess
+import timeit
+
+import numpy as np
+
+from libasi import ASIDriver, ControlType, ErrorCode, control_type_codes
+
+SIM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sim')
+STUB_LIBRARY = os.path.join(SIM_DIR, 'libASICamera2_stub.so')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='ASI SDK ctypes call overhead micro-benchmark')
+    parser.add_argument('-l', '--library', type=str, default=STUB_LIBRARY,
+                        help='Path to the stub SDK library (built with make -C sim if missing)')
+    parser.add_argument('-n', '--number', type=int, default=200000,
+                        help='Number of calls per measurement')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of measurements, the best one is reported')
+    return parser.parse_args()
+
+
+def old_call_function(cdll, function_name, camera_ID, *args):
+    """ ASIDriver._call_function before the prototypes were bound """
+    function = getattr(cdll, function_name)
+    error_code = function(ctypes.c_int(camera_ID), *args)
+    if error_code != ErrorCode.SUCCESS:
+        raise RuntimeError(function_name)
+
+
+def old_get_control_value(cdll, camera_ID, control_type):
+    value = ctypes.c_long()
+    is_auto = ctypes.c_int()
+    old_call_function(cdll, 'ASIGetControlValue',
+                      camera_ID,
+                      ControlType[control_type],
+                      ctypes.byref(value),
+                      ctypes.byref(is_auto))
+    return value.value, bool(is_auto)
+
+
+def old_get_video_data(cdll, camera_ID, video_data):
+    old_call_function(cdll, 'ASIGetVideoData',
+                      camera_ID,
+                      video_data.ctypes.data_as(ctypes.POINTER(ctypes.c_byte)),
+                      ctypes.c_long(video_data.nbytes),
+                      ctypes.c_int(-1))
+
+
+def old_get_dropped_frames(cdll, camera_ID):
+    n_dropped_frames = ctypes.c_int()
+    old_call_function(cdll, 'ASIGetDroppedFrames', camera_ID, ctypes.byref(n_dropped_frames))
+    return n_dropped_frames.value
+
+
+def new_get_control_value(cam, camera_ID, control_type):
+    scratch = cam._get_scratch(camera_ID)
+    cam._call_function('ASIGetControlValue',
+                       camera_ID,
+                       control_type_codes[control_type],
+                       scratch.long_ref,
+                       scratch.bool_ref)
+    return scratch.long.value, bool(scratch.bool.value)
+
+
+def new_get_video_data(cam, camera_ID, video_data):
+    cam._call_function('ASIGetVideoData',
+                       camera_ID,
+                       video_data.ctypes.data,
+                       video_data.nbytes,
+                       -1)
+
+
+def new_get_dropped_frames(cam, camera_ID):
+    scratch = cam._get_scratch(camera_ID)
+    cam._call_function('ASIGetDroppedFrames', camera_ID, scratch.int_ref)
+    return scratch.int.value
+
+
+def best_ns_per_call(statement, number, repeat):
+    return min(timeit.repeat(statement, number=number, repeat=repeat)) / number * 1e9
+
+
+def main():
+    args = parse_args()
+    if not os.path.exists(args.library):
+        subprocess.run(['make', '-C', SIM_DIR], check=True)
+
+    cam = ASIDriver(library_path=args.library)
+    cdll = ctypes.CDLL(args.library)  # separate handle without any prototypes
+    camera_ID = 0
+    frame = np.empty((8, 8), dtype=np.uint16)
+
+    benchmarks = [
+        ('ASIGetControlValue',
+         lambda: old_get_control_value(cdll, camera_ID, 'TEMPERATURE'),
+         lambda: new_get_control_value(cam, camera_ID, 'TEMPERATURE')),
+        ('ASIGetVideoData',
+         lambda: old_get_video_data(cdll, camera_ID, frame),
+         lambda: new_get_video_data(cam, camera_ID, frame)),
+        ('ASIGetDroppedFrames',
+         lambda: old_get_dropped_frames(cdll, camera_ID),
+         lambda: new_get_dropped_frames(cam, camera_ID)),
+    ]
+
+    print(f'{"SDK call":24s} {"before [ns]":>12s} {"after [ns]":>12s} {"speed-up":>9s}')
+    for name, before, after in benchmarks:
+        before_ns = best_ns_per_call(before, args.number, args.repeat)
+        after_ns = best_ns_per_call(after, args.number, args.repeat)
+        print(f'{name:24s} {before_ns:12.0f} {after_ns:12.0f} {before_ns / after_ns:8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
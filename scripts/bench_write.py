@@ -0,0 +1,407 @@
+"""Throughput benchmark of the pp_test.py write strategies and compression settings.
+
+Feeds synthetic star field frames of the real ASI183MM and ASI1600MM frame sizes, full frame
+and 2x2 binned, RAW8 and RAW16, through each way pp_test.py can write frames:
+
+    fitsio     a fitsio.write per frame (the default, and -C)
+    template   the precomputed header template (uncompressed default)
+    tile       the parallel tile compressor (-C RICE|GZIP)
+    pool       the writer process pool (-p)
+    cube       multi-frame cube files (--cube)
+    spool      the raw memory mapped spool (--spool)
+    auto       the adaptive compression (-C AUTO)
+
+Each case runs in a new Python process, so that its peak RSS is its own, and reports the
+sustained FPS (frames over the time until the last file is complete), the median, 99th
+percentile and maximum per frame write latency (the time the capture loop is blocked), the
+CPU usage of the process and its writer processes, the peak RSS while writing and its
+growth over the RSS with the frames in memory, and the bytes written.
+The results go into a JSON report, with the host, library versions and git commit, and/or a
+CSV file, to compare versions and hosts:
+
+    python3 bench_write.py -o /mnt/fast/bench --json bench_fast.json
+    python3 bench_write.py -o /var/huntsman/images/bench --cameras ASI183MM --binning 2 \\
+        --image_types RAW16 --strategies fitsio pool tile --csv bench_nfs.csv
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import fitsio
+import numpy as np
+
+from autocompress import AdaptiveWriter
+from cubewriter import CubeWriter
+from fitstemplate import FitsTemplate
+from frameclock import FrameClock
+from libasi import image_layout
+from pp_test import frame_values, make_header
+from spool import SpoolWriter
+from tilecompress import TileCompressor
+from writerpool import WriterPool
+
+# Full frame width, height, pixel size and ADC bit depth
+CAMERAS = {'ASI183MM': (5496, 3672, 2.4, 12),
+           'ASI1600MM': (4656, 3520, 3.8, 12)}
+
+STRATEGIES = ('fitsio', 'template', 'tile', 'pool', 'cube', 'spool', 'auto')
+
+COMPRESSIONS = ('NONE', 'RICE', 'GZIP')
+
+# Compressions each strategy can write, AUTO picks one per file
+STRATEGY_COMPRESSIONS = {'fitsio': COMPRESSIONS,
+                         'template': ('NONE',),
+                         'tile': ('RICE', 'GZIP'),
+                         'pool': COMPRESSIONS,
+                         'cube': ('NONE',),
+                         'spool': ('NONE',),
+                         'auto': ('AUTO',)}
+
+RESULT_FIELDS = ['camera', 'binning', 'image_type', 'width', 'height', 'strategy', 'compress',
+                 'frames', 'fps', 'p50_ms', 'p99_ms', 'max_ms', 'cpu_percent', 'user_s',
+                 'system_s', 'peak_rss_MB', 'rss_growth_MB', 'children_peak_rss_MB', 'bytes_written',
+                 'compression_ratio', 'MBps']
+
+# Distinct synthetic frames of a case, written in turn
+N_SYNTHETIC_FRAMES = 4
+
+# Frames per file of the cube strategy (default of --cube_frames)
+CUBE_FRAMES = 10
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='pp_test.py write strategy benchmark')
+    parser.add_argument('-o', '--output_folder', type=str, default=None,
+                        help='Folder the files are written to, the output target to measure '
+                             '(default a temporary folder)')
+    parser.add_argument('-n', '--frames', type=int, default=30, help='Frames per case (default 30)')
+    parser.add_argument('--fps', type=float, default=None,
+                        help='Feed the frames at this rate instead of as fast as possible')
+    parser.add_argument('--cameras', nargs='+', default=list(CAMERAS), choices=list(CAMERAS))
+    parser.add_argument('--binning', nargs='+', type=int, default=[1, 2], choices=[1, 2])
+    parser.add_argument('--image_types', nargs='+', default=['RAW8', 'RAW16'],
+                        choices=['RAW8', 'RAW16'])
+    parser.add_argument('--strategies', nargs='+', default=list(STRATEGIES), choices=STRATEGIES)
+    parser.add_argument('--compress', nargs='+', default=list(COMPRESSIONS) + ['AUTO'],
+                        choices=list(COMPRESSIONS) + ['AUTO'],
+                        help='Compression settings, the ones a strategy cannot write are skipped')
+    parser.add_argument('--writers', type=int, default=4,
+                        help='Writer processes of the pool strategy (default 4)')
+    parser.add_argument('--cube_frames', type=int, default=CUBE_FRAMES,
+                        help=f'Frames per file of the cube strategy, at most the frames per case '
+                             f'(default {CUBE_FRAMES})')
+    parser.add_argument('--json', type=str, default=None, metavar='PATH', help='JSON report file')
+    parser.add_argument('--csv', type=str, default=None, metavar='PATH', help='CSV report file')
+    parser.add_argument('--case', type=str, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def benchmark_cases(args):
+    """The cases of the benchmark matrix, as dicts """
+    cases = []
+    for camera in args.cameras:
+        for binning in args.binning:
+            for image_type in args.image_types:
+                for strategy in args.strategies:
+                    for compress in STRATEGY_COMPRESSIONS[strategy]:
+                        if compress in args.compress:
+                            cases.append({'camera': camera, 'binning': binning,
+                                          'image_type': image_type, 'strategy': strategy,
+                                          'compress': compress})
+    return cases
+
+
+def synthetic_frames(shape, dtype, bit_depth, n_frames=N_SYNTHETIC_FRAMES):
+    """Star field frames with the noise and value range of the camera, RAW16 left aligned.
+
+    The frames are made in place in one float32 work frame, so the RSS of a case is the
+    frames and not float64 temporaries several times their size.
+    """
+    rng = np.random.default_rng(1)
+    height, width = shape
+    sky = np.full(shape, 200.0 if dtype == np.uint16 else 20.0, dtype=np.float32)
+    max_value = (1 << bit_depth) - 1 if dtype == np.uint16 else 255
+    # gaussian stars, sigma 1.5 pixels, in 15 x 15 stamps
+    y, x = np.mgrid[-7:8, -7:8]
+    star = np.exp(-(x ** 2 + y ** 2) / 4.5).astype(np.float32)
+    for _ in range(int(width * height / 25000)):
+        star_x = rng.integers(7, width - 8)
+        star_y = rng.integers(7, height - 8)
+        sky[star_y - 7:star_y + 8, star_x - 7:star_x + 8] += (
+            np.float32(rng.uniform(0.05, 1) * max_value) * star)
+    noise = np.empty(shape, dtype=np.float32)
+    frames = []
+    for _ in range(n_frames):
+        rng.standard_normal(dtype=np.float32, out=noise)
+        noise *= 5 if dtype == np.uint16 else 2
+        noise += sky
+        np.clip(noise, 0, max_value, out=noise)
+        frame = noise.astype(dtype)
+        if dtype == np.uint16:
+            frame <<= 16 - bit_depth
+        frames.append(frame)
+    return frames
+
+
+def make_writer(case, folder, shape, dtype, settings, n_frames, fps, n_writers,
+                cube_frames=CUBE_FRAMES):
+    """Make the write function of a case strategy, and its close function.
+
+    The write function takes the frame index, data, header and per frame header values.
+    """
+    compress = None if case['compress'] == 'NONE' else case['compress']
+    strategy = case['strategy']
+
+    def path(index):
+        return os.path.join(folder, f'frame{index:06d}.fits')
+
+    if strategy == 'fitsio':
+        def write(index, data, header, values):
+            fitsio.write(path(index), data, header=header, compress=compress, clobber=True)
+        return write, None
+    if strategy == 'template':
+        template = FitsTemplate(make_header('frame000000.fits', settings, 45000, '', '', 0.0),
+                                shape, dtype)
+        return (lambda index, data, header, values: template.write(path(index), data, values),
+                None)
+    if strategy == 'tile':
+        compressor = TileCompressor(compress)
+        return (lambda index, data, header, values: compressor.write(path(index), data, header),
+                compressor.close)
+    if strategy == 'pool':
+        pool = WriterPool(int(np.prod(shape)) * dtype.itemsize, n_workers=n_writers)
+        return (lambda index, data, header, values:
+                pool.submit(data, header, path(index), compress),
+                pool.close)
+    if strategy == 'cube':
+        # full files, not a preallocation trimmed on close
+        cube_writer = CubeWriter(folder, frames_per_file=min(n_frames, cube_frames))
+        return (lambda index, data, header, values: cube_writer.write(data, header, index),
+                cube_writer.close)
+    if strategy == 'spool':
+        spool = SpoolWriter(os.path.join(folder, 'bench.spool'), n_frames, shape, dtype,
+                            make_header('', settings, 45000, '', '', 0.0))
+
+        def write(index, data, header, values):
+            now = time.time()
+            spool.write(data, now, now, 45000, 0.0, index)
+        return write, spool.close
+    if strategy == 'auto':
+        adaptive_writer = AdaptiveWriter(1 / fps if fps else 0.05)
+
+        def write(index, data, header, values):
+            adaptive_writer.observe_frame(time.perf_counter())
+            adaptive_writer.write(path(index), data, header)
+        return write, adaptive_writer.close
+    raise ValueError(f'Unknown strategy {strategy}')
+
+
+def run_case(case, folder, n_frames, fps, n_writers, cube_frames=CUBE_FRAMES):
+    """Run a benchmark case in this process.
+
+    Returns:
+        dict: the case and its RESULT_FIELDS.
+    """
+    width, height, pixel_size, bit_depth = CAMERAS[case['camera']]
+    binning = case['binning']
+    # the ROI pp_test.py sets for the full sensor
+    shape, dtype = image_layout((width // binning) // 8 * 8, (height // binning) // 8 * 8,
+                                case['image_type'])
+    settings = {'start_x': 0, 'start_y': 0, 'binning': binning, 'gain': 100,
+                'image_type': case['image_type'], 'camera_name': case['camera'],
+                'pixel_size': pixel_size * binning, 'bit_depth': bit_depth, 'pack_shift': 0}
+    frames = synthetic_frames(shape, dtype, bit_depth)
+
+    # the pool starts its processes before any other threads
+    write, close = make_writer(case, folder, shape, dtype, settings, n_frames, fps, n_writers,
+                               cube_frames)
+
+    clock = FrameClock()
+    latencies = []
+    # the peak of the writes, not of making the frames
+    peak_reset = _reset_peak_rss()
+    start_rss_kB = _memory_status('VmRSS')
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_time = time.perf_counter()
+    for index in range(n_frames):
+        if fps:
+            delay = start_time + index / fps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        # the header is built in the capture loop too
+        frame_ns = clock.now()
+        iso_start_date = clock.iso_date(frame_ns - 45000 * 1000)
+        iso_end_date = clock.iso_date(frame_ns)
+        filename = f'frame{index:06d}.fits'
+        header = make_header(filename, settings, 45000, iso_start_date, iso_end_date, -5.0)
+        values = frame_values(filename, 45000, iso_start_date, iso_end_date, -5.0)
+        frame_start_time = time.perf_counter()
+        write(index, frames[index % len(frames)], header, values)
+        latencies.append(time.perf_counter() - frame_start_time)
+    if close is not None:
+        # until the last file is complete
+        close()
+    elapsed_time = time.perf_counter() - start_time
+    self_end = resource.getrusage(resource.RUSAGE_SELF)
+    children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    user_time = (self_end.ru_utime - self_usage.ru_utime
+                 + children_end.ru_utime - children_usage.ru_utime)
+    system_time = (self_end.ru_stime - self_usage.ru_stime
+                   + children_end.ru_stime - children_usage.ru_stime)
+    bytes_written = sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+    raw_bytes = n_frames * frames[0].nbytes
+    latencies_ms = np.array(latencies) * 1e3
+    return {**case,
+            'width': shape[1],
+            'height': shape[0],
+            'frames': n_frames,
+            'fps': n_frames / elapsed_time,
+            'p50_ms': float(np.percentile(latencies_ms, 50)),
+            'p99_ms': float(np.percentile(latencies_ms, 99)),
+            'max_ms': float(latencies_ms.max()),
+            'cpu_percent': 100 * (user_time + system_time) / elapsed_time,
+            'user_s': user_time,
+            'system_s': system_time,
+            # ru_maxrss is in kB on Linux
+            'peak_rss_MB': (_memory_status('VmHWM') if peak_reset else self_end.ru_maxrss) / 1e3,
+            'rss_growth_MB': ((_memory_status('VmHWM') - start_rss_kB) / 1e3
+                              if peak_reset else None),
+            'children_peak_rss_MB': children_end.ru_maxrss / 1e3,
+            'bytes_written': bytes_written,
+            'compression_ratio': raw_bytes / bytes_written if bytes_written else 0.0,
+            'MBps': bytes_written / elapsed_time / 1e6}
+
+
+def run_case_process(case, args, output_folder):
+    """Run a benchmark case in a new process, in an empty folder removed afterwards """
+    folder = tempfile.mkdtemp(prefix='bench_', dir=output_folder)
+    try:
+        command = [sys.executable, os.path.abspath(__file__), '--case', json.dumps(case),
+                   '-o', folder, '-n', str(args.frames), '--writers', str(args.writers),
+                   '--cube_frames', str(args.cube_frames)]
+        if args.fps:
+            command += ['--fps', str(args.fps)]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(completed.stderr, file=sys.stderr)
+            return None
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def host_info(output_folder):
+    """Description of the host, software and output target of a report """
+    info = {'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'fitsio': fitsio.__version__,
+            'output_folder': os.path.abspath(output_folder),
+            'filesystem': _filesystem_type(output_folder)}
+    try:
+        info['commit'] = subprocess.run(['git', 'describe', '--always', '--dirty'],
+                                        cwd=os.path.dirname(os.path.abspath(__file__)),
+                                        capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['commit'] = None
+    return info
+
+
+def _reset_peak_rss():
+    # Linux only, resets VmHWM of /proc/self/status to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _memory_status(field):
+    # a kB value of /proc/self/status, e.g. VmRSS or VmHWM
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def _filesystem_type(path):
+    # the mount with the longest prefix of the path, e.g. nfs4 or ext4
+    path = os.path.realpath(path)
+    best_mount, best_type = '', None
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                _, mount_point, fs_type = line.split()[:3]
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) \
+                        and len(mount_point) > len(best_mount):
+                    best_mount, best_type = mount_point, fs_type
+    except OSError:
+        pass
+    return best_type
+
+
+def main():
+    args = parse_args()
+    if args.case is not None:
+        print(json.dumps(run_case(json.loads(args.case), args.output_folder, args.frames,
+                                  args.fps, args.writers, args.cube_frames)))
+        return
+
+    output_folder = args.output_folder or tempfile.mkdtemp(prefix='bench_write')
+    os.makedirs(output_folder, exist_ok=True)
+    report = {'host': host_info(output_folder),
+              'settings': {'frames': args.frames, 'fps': args.fps, 'writers': args.writers,
+                           'cube_frames': args.cube_frames},
+              'results': []}
+    cases = benchmark_cases(args)
+    print(f'{len(cases)} cases of {args.frames} frames, writing to {output_folder} '
+          f'({report["host"]["filesystem"]})')
+    print(f'{"camera":<10s} {"bin":>3s} {"type":<5s} {"strategy":<8s} {"compress":<8s} '
+          f'{"FPS":>7s} {"p50 ms":>7s} {"p99 ms":>7s} {"CPU %":>6s} {"RSS MB":>7s} {"+RSS MB":>7s} '
+          f'{"MB/s":>7s} '
+          f'{"ratio":>5s}')
+    for case in cases:
+        result = run_case_process(case, args, output_folder)
+        if result is None:
+            print(f'{case} failed')
+            continue
+        report['results'].append(result)
+        print(f'{result["camera"]:<10s} {result["binning"]:>3d} {result["image_type"]:<5s} '
+              f'{result["strategy"]:<8s} {result["compress"]:<8s} {result["fps"]:7.2f} '
+              f'{result["p50_ms"]:7.1f} {result["p99_ms"]:7.1f} {result["cpu_percent"]:6.0f} '
+              f'{max(result["peak_rss_MB"], result["children_peak_rss_MB"]):7.0f} '
+              f'{result["rss_growth_MB"] if result["rss_growth_MB"] is not None else float("nan"):7.0f} '
+              f'{result["MBps"]:7.1f} {result["compression_ratio"]:5.2f}')
+    if args.output_folder is None:
+        os.rmdir(output_folder)
+
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.csv is not None:
+        with open(args.csv, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            for result in report['results']:
+                writer.writerow({field: result[field] for field in RESULT_FIELDS})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import numpy as np
+
+# Header keys of the packing, besides BSCALE and BZERO
+BIT_DEPTH_KEY = 'BITDEPTH'
+SHIFT_KEY = 'PACKSHFT'
+
+
+def packing_shift(bit_depth, dtype):
+    """Number of always zero low bits of the frames of an ADC with bit_depth bits.
+
+    The SDK left aligns RAW16 pixels of ADCs with fewer than 16 bits in the 16 bit words, e.g.
+    the 12 bit values of the ASI183MM and ASI1600MM are multiplied by 16.
+
+    Args:
+        bit_depth (int): ADC bit depth, CameraInfo.bit_depth.
+        dtype (numpy.dtype): frame dtype.
+
+    Returns:
+        int: the shift, 0 if the frames cannot be packed.
+    """
+    if np.dtype(dtype) != np.uint16 or not 0 < bit_depth < 16:
+        return 0
+    return 16 - bit_depth
+
+
+def packed_dtype(dtype, shift):
+    """Dtype of the frames packed by shift_frame() """
+    return np.dtype(np.int16) if shift else np.dtype(dtype)
+
+
+def packing_keys(shift, bit_depth):
+    """Header keys of the frames packed by shift_frame().
+
+    FITS readers scale the stored values by BSCALE, which recovers the original values; the
+    custom keys record the ADC bit depth and the shift for readers of the raw values.
+    """
+    return {'BSCALE': 1 << shift,
+            'BZERO': 0,
+            BIT_DEPTH_KEY: bit_depth,
+            SHIFT_KEY: shift}
+
+
+def shift_frame(data, shift, out=None):
+    """Right shift a left aligned frame to its ADC values, lossless if the low bits are zero.
+
+    The values are stored as int16, they fit without a BZERO offset and signed 16 bit
+    integers are what FITS stores.
+    """
+    if not shift:
+        return data
+    if out is None:
+        out = np.empty(data.shape, dtype=np.int16)
+    return np.right_shift(data, shift, out=out.view(np.uint16)).view(np.int16)
+
+
+def has_zero_low_bits(data, shift):
+    """Whether the low shift bits of all the pixels are zero, i.e. shift_frame() is lossless """
+    return not np.bitwise_and(data, (1 << shift) - 1).any()
+
+
+def packed12_size(n_pixels):
+    """Bytes of n_pixels 12 bit pixels packed by pack12() """
+    return (n_pixels + 1) // 2 * 3
+
+
+def pack12(data, shift=4, out=None):
+    """Pack 12 bit pixels into 3 bytes per pair of pixels.
+
+    The pixel values are data >> shift, the first pixel of a pair goes into the first byte
+    and the low nibble of the second byte, the second pixel into the high nibble of the
+    second byte and the third byte. An odd last pixel is paired with a 0.
+
+    Returns:
+        numpy.ndarray: the packed uint8 bytes, out if given.
+    """
+    values = np.right_shift(data.reshape(-1), shift)
+    if values.size % 2:
+        values = np.append(values, np.zeros(1, dtype=values.dtype))
+    pairs = values.reshape(-1, 2)
+    if out is None:
+        out = np.empty(packed12_size(values.size), dtype=np.uint8)
+    triples = out.reshape(-1, 3)
+    first = pairs[:, 0]
+    second = pairs[:, 1]
+    np.copyto(triples[:, 0], first, casting='unsafe')
+    np.copyto(triples[:, 1], (first >> 8) | ((second & 0xF) << 4), casting='unsafe')
+    np.copyto(triples[:, 2], second >> 4, casting='unsafe')
+    return out
+
+
+def unpack12(packed, shape, shift=4):
+    """Unpack pixels packed by pack12() into a uint16 frame, shifted back by shift """
+    n_pixels = int(np.prod(shape))
+    triples = np.asarray(packed, dtype=np.uint8)[:packed12_size(n_pixels)].reshape(-1, 3)
+    triples = triples.astype(np.uint16)
+    pairs = np.empty((triples.shape[0], 2), dtype=np.uint16)
+    pairs[:, 0] = triples[:, 0] | ((triples[:, 1] & 0xF) << 8)
+    pairs[:, 1] = (triples[:, 1] >> 4) | (triples[:, 2] << 4)
+    return (pairs.reshape(-1)[:n_pixels] << shift).reshape(shape)
+
+
+class FramePacker(object):
+    """Right shifts the frames of a run with shift_frame() into a reused buffer.
+
+    The first frame is checked for non-zero low bits, in case the camera does not left align
+    its pixels as the SDK documents.
+
+    Example:
+        shift = packing_shift(bit_depth, np.uint16)
+        packer = FramePacker(shift)
+        fitsio.write(path, packer(data), header=dict(header, **packing_keys(shift, bit_depth)))
+    """
+
+    def __init__(self, shift):
+        self.shift = shift
+        self._buffer = None
+
+    def __call__(self, data):
+        """Get the packed frame, valid until the next call.
+
+        Raises:
+            ValueError: if the low bits of the first frame are not zero.
+        """
+        if self._buffer is None or self._buffer.shape != data.shape:
+            if not has_zero_low_bits(data, self.shift):
+                raise ValueError(f'The low {self.shift} bits of the frames are not zero, '
+                                 f'they cannot be packed without loss')
+            self._buffer = np.empty(data.shape, dtype=np.int16)
+        return shift_frame(data, self.shift, out=self._buffer)
@@ -0,0 +1,168 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+# Accumulator dtypes of the stacks, by the names accepted by pp_test.py --coadd_dtype
+STACK_DTYPES = {'uint32': np.dtype(np.uint32),
+                'float32': np.dtype(np.float32)}
+
+# Largest integer a float32 holds exactly
+FLOAT32_EXACT = 1 << 24
+
+
+@dataclass
+class Stack:
+    """The sum of consecutive video frames.
+
+    Attributes:
+        index (int): running number of the stack, starting at 0.
+        data (numpy.ndarray): the summed frame, the stacker accumulator, valid until the next
+            frame is added.
+        n_frames (int): number of frames summed, NCOMBINE.
+        exposure_us (int): total exposure time of the frames in microseconds.
+        start_ns (int): monotonic stamp of the start of the first exposure.
+        end_ns (int): monotonic stamp of the end of the last exposure.
+        temp_C (float): mean sensor temperature of the frames.
+        first_sequence (int): sequence number of the first frame.
+    """
+    index: int
+    data: np.ndarray
+    n_frames: int
+    exposure_us: int
+    start_ns: int
+    end_ns: int
+    temp_C: float
+    first_sequence: int
+
+
+class FrameStacker(object):
+    """Co-adds consecutive video frames in memory, to write one file per n_frames frames.
+
+    For faint targets the frames are only summed offline, and writing each of them costs n
+    times the disk and network bandwidth of their sum. The stacker adds every frame in place
+    into a wider accumulator, uint32 or float32, with np.add(out=), which converts the frame
+    in small internal chunks instead of a converted copy per frame. The first frame of a stack
+    is copied into the accumulator, so it is never cleared.
+
+    A stack is complete after n_frames frames, or at the last of total_frames frames if given,
+    so the end of a run is written as a shorter stack. Its total exposure time, first start,
+    last end and number of frames go into EXPTIME, DATE-OBS, DATE-END and NCOMBINE. Frames left
+    out of the sums, e.g. by the lucky imaging selection, are counted with skip().
+
+    uint32 sums are exact for up to 65537 frames of 16 bit; float32 sums are exact while they
+    stay below 2**24, e.g. up to 4096 frames of 12 bit ADC values, but left aligned RAW16
+    values lose their lowest bits in 256 frames or more.
+
+    Example:
+        stacker = FrameStacker(10, np.uint16)
+        stack = stacker.add(data, start_ns, end_ns, exposure_us, temp_C)
+        if stack is not None:
+            write(stack.data, ...)
+    """
+
+    def __init__(self, n_frames, frame_dtype, dtype=np.uint32, total_frames=None):
+        """
+        Args:
+            n_frames (int): number of frames per stack.
+            frame_dtype (numpy.dtype): dtype of the frames.
+            dtype (numpy.dtype): accumulator dtype, one of STACK_DTYPES.
+            total_frames (int, optional): number of frames of the run.
+        """
+        self.frame_dtype = np.dtype(frame_dtype)
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in STACK_DTYPES.values():
+            raise ValueError(f'Unsupported stack dtype {self.dtype}, use one of {list(STACK_DTYPES)}')
+        if n_frames < 1:
+            raise ValueError('n_frames must be at least 1')
+        if (self.dtype.kind == 'u'
+                and n_frames * np.iinfo(self.frame_dtype).max > np.iinfo(self.dtype).max):
+            raise ValueError(f'The sum of {n_frames} {self.frame_dtype} frames can overflow {self.dtype}')
+        self.n_frames = n_frames
+        self.total_frames = total_frames
+
+        self.n_added = 0
+        self.n_skipped = 0
+        self.n_stacks = 0
+        self._sum = None
+        self._count = 0
+        self._first_sequence = 0
+        self._start_ns = 0
+        self._end_ns = 0
+        self._exposure_us = 0
+        self._temp_sum = 0.0
+
+    @property
+    def n_pending(self):
+        """Number of frames in the unfinished stack """
+        return self._count
+
+    def add(self, data, start_ns, end_ns, exposure_us, temp_C, sequence=None):
+        """Add a frame to the current stack.
+
+        The frame buffer is not referenced afterwards, it can be released right away.
+
+        Args:
+            data (numpy.ndarray): the frame, of frame_dtype.
+            start_ns, end_ns (int): monotonic stamps of the start and end of its exposure.
+            exposure_us (int): its exposure time in microseconds.
+            temp_C (float): its sensor temperature.
+            sequence (int, optional): its sequence number, default the number of frames added.
+
+        Returns:
+            Stack or None: the stack if it is complete with this frame.
+        """
+        if data.dtype != self.frame_dtype:
+            raise ValueError(f'Frame dtype {data.dtype} is not the stacker frame dtype {self.frame_dtype}')
+        if self._count == 0:
+            if self._sum is None or self._sum.shape != data.shape:
+                self._sum = np.empty(data.shape, dtype=self.dtype)
+            np.copyto(self._sum, data)
+            self._first_sequence = self.n_added if sequence is None else sequence
+            self._start_ns = start_ns
+            self._exposure_us = 0
+            self._temp_sum = 0.0
+        elif data.shape != self._sum.shape:
+            raise ValueError(f'Frame {data.shape} does not match the stack {self._sum.shape}')
+        else:
+            np.add(self._sum, data, out=self._sum)
+        self._count += 1
+        self.n_added += 1
+        self._end_ns = end_ns
+        self._exposure_us += exposure_us
+        self._temp_sum += temp_C
+
+        if self._count >= self.n_frames:
+            return self.flush()
+        return self._end_of_run()
+
+    def skip(self):
+        """Count a frame which is not added, e.g. rejected by the frame selection.
+
+        Returns:
+            Stack or None: the last, shorter stack if this was the last of total_frames frames.
+        """
+        self.n_skipped += 1
+        return self._end_of_run()
+
+    def flush(self):
+        """Complete the current stack, however many frames it has.
+
+        Returns:
+            Stack or None: the stack, None if it has no frames.
+        """
+        if not self._count:
+            return None
+        stack = Stack(index=self.n_stacks, data=self._sum, n_frames=self._count,
+                      exposure_us=self._exposure_us, start_ns=self._start_ns,
+                      end_ns=self._end_ns, temp_C=self._temp_sum / self._count,
+                      first_sequence=self._first_sequence)
+        self.n_stacks += 1
+        self._count = 0
+        return stack
+
+    # Private methods
+
+    def _end_of_run(self):
+        if self.n_added + self.n_skipped == self.total_frames:
+            return self.flush()
+        return None
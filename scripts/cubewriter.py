@@ -0,0 +1,242 @@
+import os
+
+import fitsio
+import numpy as np
+
+# Output file layouts
+CUBE_MODES = ('cube', 'mef')
+
+# Per frame values stored in the FRAMES binary table instead of the frame headers
+FRAME_COLUMNS = [('FRAME', 'i8'),
+                 ('DATE-OBS', 'S23'),
+                 ('DATE-END', 'S23'),
+                 ('EXPTIME', 'f8'),
+                 ('EXPOINUS', 'i8'),
+                 ('CCD_TEMP', 'f8')]
+
+FRAMES_EXTNAME = 'FRAMES'
+
+# Data scaling keys, e.g. of bit packed frames, which cfitsio applies to the writes
+SCALE_KEYS = ('BSCALE', 'BZERO')
+
+
+class CubeWriter(object):
+    """Writes a video sequence into a few multi-frame FITS files instead of a file per frame.
+
+    Creating, opening and closing a file per frame costs several metadata round trips, which
+    on NFS take longer than the frame data transfer. The writer keeps one file open and
+    appends the frames to it, rolling over to a new file after frames_per_file frames or
+    max_bytes of frame data. Two layouts are supported:
+        'cube': the frames are the planes of a 3D image in the primary HDU, NAXIS3 is the
+            frame number. The cube is preallocated for frames_per_file frames and trimmed
+            when the file is closed. Compression is not supported.
+        'mef': multi-extension file, each frame is an image extension, optionally tile
+            compressed.
+
+    The header keys constant for a run (instrument, binning, gain, ...) are written once to
+    the primary header of each file. The FRAME_COLUMNS values of each frame go into a row of
+    the FRAMES binary table extension, preallocated with FRAME = -1 in the unused rows.
+    The SCALE_KEYS of the frame headers go into each image extension in 'mef' mode, and are
+    added to the primary header when the file is closed in 'cube' mode, as cfitsio would
+    otherwise scale the frames written after them.
+
+    File names are <prefix><file number>.fits, e.g. cube0000.fits. Use CubeReader to read
+    frames back.
+    """
+
+    def __init__(self, output_folder, prefix='cube', frames_per_file=100, max_bytes=None,
+                 mode='cube', compress=None, first_file=0, on_file_closed=None):
+        """
+        Args:
+            output_folder (str): folder of the files, existing files are overwritten.
+            prefix (str): file name prefix.
+            frames_per_file (int): maximum number of frames per file.
+            max_bytes (int, optional): maximum (uncompressed) frame data bytes per file.
+            mode (str): file layout, one of CUBE_MODES.
+            compress (str, optional): fitsio compression type for 'mef' mode, e.g. 'RICE'.
+            first_file (int): number of the first file.
+            on_file_closed (callable, optional): called with the path of each completed file.
+        """
+        if mode not in CUBE_MODES:
+            raise ValueError(f'Unknown cube mode {mode}, use one of {CUBE_MODES}')
+        if compress is not None and mode == 'cube':
+            raise ValueError("Compression is only supported in 'mef' mode")
+        if frames_per_file < 1:
+            raise ValueError('frames_per_file must be at least 1')
+
+        self.output_folder = output_folder
+        self.prefix = prefix
+        self.frames_per_file = frames_per_file
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.compress = compress
+        self.first_file = first_file
+        self.on_file_closed = on_file_closed
+
+        self.files = []
+        self.n_frames = 0
+        self._fits = None
+        self._file_frames = 0
+        self._file_capacity = 0
+        self._frame_layout = None
+        self._scale_keys = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data, header, sequence=None):
+        """Append a frame to the current file, rolling over to a new file when it is full.
+
+        Args:
+            data (numpy.ndarray): the frame.
+            header (dict): the frame header keys. FRAME_COLUMNS keys go into the FRAMES
+                table, the other keys into the primary header of a new file, except FILE.
+            sequence (int, optional): frame number for the FRAME column, default is the
+                number of frames written so far.
+        """
+        if (self._fits is None or self._file_frames >= self._file_capacity
+                or self._frame_layout != (data.shape, data.dtype)):
+            self._close_file()
+            self._open_file(data, header)
+
+        if self.mode == 'cube':
+            self._fits[0].write(data[np.newaxis], start=[self._file_frames] + [0] * data.ndim)
+        else:
+            self._fits.write(data, header=self._scale_keys or None, compress=self.compress)
+
+        row = np.zeros(1, dtype=FRAME_COLUMNS)
+        row['FRAME'] = self.n_frames if sequence is None else sequence
+        for name, _ in FRAME_COLUMNS[1:]:
+            if name in header:
+                row[name] = header[name]
+        self._fits[FRAMES_EXTNAME].write(row, firstrow=self._file_frames)
+
+        self._file_frames += 1
+        self.n_frames += 1
+
+    def close(self):
+        """Trim and close the current file """
+        self._close_file()
+
+    # Private methods
+
+    def _open_file(self, data, header):
+        frame_bytes = data.nbytes
+        capacity = self.frames_per_file
+        if self.max_bytes is not None:
+            capacity = max(1, min(capacity, self.max_bytes // frame_bytes))
+
+        filename = f'{self.prefix}{self.first_file + len(self.files):04d}.fits'
+        path = os.path.join(self.output_folder, filename)
+        frame_keys = {name for name, _ in FRAME_COLUMNS}
+        primary_header = {key: value for key, value in header.items()
+                          if key not in frame_keys and key not in SCALE_KEYS and key != 'FILE'}
+        primary_header.update({'FILE': filename, 'CUBEMODE': self.mode, 'NFRAMES': 0})
+
+        fits = fitsio.FITS(path, 'rw', clobber=True)
+        if self.mode == 'cube':
+            fits.create_image_hdu(dims=[capacity] + list(data.shape), dtype=data.dtype)
+            fits[0].write_keys(primary_header)
+        else:
+            fits.write(None, header=primary_header)
+        rows = np.zeros(capacity, dtype=FRAME_COLUMNS)
+        rows['FRAME'] = -1
+        fits.write(rows, extname=FRAMES_EXTNAME)
+
+        self._fits = fits
+        self._file_frames = 0
+        self._file_capacity = capacity
+        self._frame_layout = (data.shape, data.dtype)
+        self._scale_keys = {key: header[key] for key in SCALE_KEYS if key in header}
+        self.files.append(path)
+
+    def _close_file(self):
+        if self._fits is None:
+            return
+        n_frames = self._file_frames
+        if n_frames < self._file_capacity:
+            self._fits[FRAMES_EXTNAME].delete_rows(np.arange(n_frames, self._file_capacity))
+            if self.mode == 'cube':
+                self._fits[0].reshape([n_frames] + list(self._frame_layout[0]))
+        self._fits[0].write_key('NFRAMES', n_frames, comment='Number of frames in the file')
+        if self.mode == 'cube' and self._scale_keys:
+            self._fits[0].write_keys(self._scale_keys)
+        self._fits.close()
+        self._fits = None
+        if self.on_file_closed is not None:
+            self.on_file_closed(self.files[-1])
+
+
+class CubeReader(object):
+    """Reads single frames and their metadata from files written by CubeWriter.
+
+    Files left behind by an interrupted run, not trimmed, are read up to the last frame with
+    a FRAMES table row.
+
+    Example:
+        with CubeReader('cube0000.fits') as cube:
+            data = cube[10]
+            metadata = cube.metadata(10)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fits = fitsio.FITS(path)
+        self.header = self._fits[0].read_header()
+        self.mode = self.header['CUBEMODE']
+        frames = self._fits[FRAMES_EXTNAME].read()
+        self.frames = frames[frames['FRAME'] >= 0]
+        if self.mode == 'mef':
+            self.frames = self.frames[:len(self._fits) - 2]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return self.read(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.read(index)
+
+    def read(self, index):
+        """Read the data of the frame with given index in the file """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f'Frame index {index} out of range, {self.path} has {len(self)} frames')
+        if self.mode == 'cube':
+            frame_ndim = len(self._fits[0].get_dims()) - 1
+            return self._fits[0][(slice(index, index + 1),) + (slice(None),) * frame_ndim][0]
+        return self._fits[index + 2].read()
+
+    def metadata(self, index):
+        """Get the FRAMES table values of the frame with given index in the file, as a dict """
+        row = self.frames[index]
+        metadata = {}
+        for name, _ in FRAME_COLUMNS:
+            value = row[name].item()
+            metadata[name] = value.decode() if isinstance(value, bytes) else value
+        return metadata
+
+    def close(self):
+        self._fits.close()
+
+
+def read_frame(path, index):
+    """Read a single frame and its metadata from a file written by CubeWriter.
+
+    Returns:
+        (numpy.ndarray, dict): the frame data and its FRAMES table values.
+    """
+    with CubeReader(path) as cube:
+        return cube.read(index), cube.metadata(index)
@@ -0,0 +1,334 @@
+import os
+import queue
+import socket
+import threading
+import time
+
+import fitsio
+import numpy as np
+
+from cubewriter import CubeWriter
+from frameclock import NS_PER_SECOND, FrameClock
+
+# Output of the events: 3D cube or multi-extension file per event, or a folder of frame files
+EVENT_MODES = ('cube', 'mef', 'sequence')
+
+# Length of the trigger reason kept in the EVREASON header card
+MAX_REASON_LENGTH = 60
+
+
+class EventCapture(object):
+    """Keeps the last frames in memory and writes them only when an event is triggered.
+
+    For transient work, e.g. fireball and meteor cameras, almost all frames are of no
+    interest, but the frames before an event are needed as much as the frames after it. The
+    capture loop copies every frame with add() into a preallocated ring of frame slots, as many
+    as fit in max_bytes. Nothing is written until trigger() is called, by a detector, the
+    TriggerSocket or a signal handler. The event then has the frames which ended up to
+    pre_seconds before the trigger and up to post_seconds after it. Triggers during an event
+    extend it to post_seconds after the last trigger.
+
+    A writer thread writes the frames of each event as they become available, into a file
+    <prefix><number>_0000.fits in 'cube' or 'mef' mode (see CubeWriter), or into a folder
+    <prefix><number> of frame files in 'sequence' mode, so the capture loop never waits on the
+    disk. A frame slot is not reused until the writer has written its frame; if the writer falls
+    that far behind, add() drops the new frames instead, counted in stats.
+
+    trigger() only queues the request, it is safe to call from any thread and from signal
+    handlers. The queued triggers are handled by the next add().
+
+    Example:
+        events = EventCapture(shape, dtype, 5.0, 2.0, 2 << 30, output_folder, header_function)
+        signal.signal(signal.SIGUSR1, lambda *_: events.trigger('SIGUSR1'))
+        events.add(data, start_ns, end_ns, exposure_us, temp_C, sequence)
+        ...
+        events.close()
+    """
+
+    def __init__(self, shape, dtype, pre_seconds, post_seconds, max_bytes, output_folder,
+                 header_function, mode='cube', compress=None, prefix='event', clock=None,
+                 on_file_closed=None, logger=None):
+        """
+        Args:
+            shape (tuple): frame shape.
+            dtype (numpy.dtype): frame dtype.
+            pre_seconds (float): seconds of frames written before a trigger.
+            post_seconds (float): seconds of frames written after a trigger.
+            max_bytes (int): memory of the frame slots.
+            output_folder (str): folder of the event files.
+            header_function (callable): called with the file name, exposure time in us, start
+                and end monotonic stamps and temperature of a frame, returns its header dict.
+            mode (str): one of EVENT_MODES.
+            compress (str, optional): fitsio compression type, not in 'cube' mode.
+            prefix (str): file or folder name prefix of the events.
+            clock (FrameClock, optional): clock of the trigger dates.
+            on_file_closed (callable, optional): called with the path of each completed file.
+            logger (logging.Logger, optional): logger of the events.
+        """
+        if mode not in EVENT_MODES:
+            raise ValueError(f'Unknown event mode {mode}, use one of {EVENT_MODES}')
+        if compress is not None and mode == 'cube':
+            raise ValueError("Compression is not supported in 'cube' mode")
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.output_folder = output_folder
+        self.header_function = header_function
+        self.mode = mode
+        self.compress = compress
+        self.prefix = prefix
+        self.clock = clock if clock is not None else FrameClock()
+        self.on_file_closed = on_file_closed
+        self.logger = logger
+
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.n_slots = max(2, max_bytes // frame_bytes)
+        self._frames = np.empty((self.n_slots,) + self.shape, dtype=self.dtype)
+        self._index = np.full(self.n_slots, -1, dtype=np.int64)
+        self._start_ns = np.zeros(self.n_slots, dtype=np.int64)
+        self._end_ns = np.zeros(self.n_slots, dtype=np.int64)
+        self._exposure_us = np.zeros(self.n_slots, dtype=np.int64)
+        self._temp_C = np.zeros(self.n_slots)
+        self._sequence = np.zeros(self.n_slots, dtype=np.int64)
+
+        self.n_added = 0
+        self.n_dropped = 0
+        self.n_events = 0
+        self.n_retriggers = 0
+        self.n_written = 0
+        self.n_write_errors = 0
+        self.files = []
+        self._requests = queue.SimpleQueue()
+        # events not completely written yet, the first one is being written
+        self._events = []
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='EventWriter', daemon=True)
+        self._thread.start()
+
+    @property
+    def stats(self):
+        """Dictionary of the event counters """
+        return {'frames': self.n_added,
+                'slots': self.n_slots,
+                'dropped': self.n_dropped,
+                'events': self.n_events,
+                'retriggers': self.n_retriggers,
+                'written': self.n_written,
+                'write_errors': self.n_write_errors}
+
+    def trigger(self, reason='', stamp=None):
+        """Request an event, from any thread or a signal handler.
+
+        Args:
+            reason (str): what triggered the event, recorded in the headers.
+            stamp (int, optional): time.monotonic_ns() of the event, default now.
+        """
+        self._requests.put((time.monotonic_ns() if stamp is None else stamp, str(reason)))
+
+    def add(self, data, start_ns, end_ns, exposure_us, temp_C, sequence):
+        """Copy a frame into the ring, the frame buffer can be released afterwards.
+
+        Args:
+            data (numpy.ndarray): the frame.
+            start_ns, end_ns (int): monotonic stamps of the start and end of its exposure.
+            exposure_us (int): its exposure time in microseconds.
+            temp_C (float): its sensor temperature.
+            sequence (int): its frame number.
+
+        Returns:
+            bool: False if the frame was dropped because the writer is behind.
+        """
+        with self._condition:
+            index = self.n_added
+            hold = self._hold()
+            if hold is not None and index - hold >= self.n_slots:
+                # the slot has a frame of an event not written yet
+                self.n_dropped += 1
+                return False
+        slot = index % self.n_slots
+        # the writer only reads the slots of frames already added
+        np.copyto(self._frames[slot], data)
+        with self._condition:
+            self._index[slot] = index
+            self._start_ns[slot] = start_ns
+            self._end_ns[slot] = end_ns
+            self._exposure_us[slot] = exposure_us
+            self._temp_C[slot] = temp_C
+            self._sequence[slot] = sequence
+            self.n_added = index + 1
+            while not self._requests.empty():
+                self._start_event(*self._requests.get_nowait())
+            self._condition.notify_all()
+        return True
+
+    def close(self):
+        """Write the events in progress, with the frames added so far, and stop the writer """
+        with self._condition:
+            while not self._requests.empty():
+                self._start_event(*self._requests.get_nowait())
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    # Private methods
+
+    def _hold(self):
+        # index of the oldest frame still to be written, or None
+        return min((event['next'] for event in self._events), default=None)
+
+    def _start_event(self, stamp, reason):
+        post_end_ns = stamp + int(self.post_seconds * NS_PER_SECOND)
+        if (self._events and not self._events[-1]['closed']
+                and self._events[-1]['end_ns'] >= stamp):
+            # still recording the last event, it goes on for longer
+            self._events[-1]['end_ns'] = max(self._events[-1]['end_ns'], post_end_ns)
+            self.n_retriggers += 1
+            return
+        # a free slot is left for the next frame
+        oldest = max(0, self.n_added - self.n_slots + 1)
+        indices = np.arange(oldest, self.n_added)
+        slots = indices % self.n_slots
+        pre_start_ns = stamp - int(self.pre_seconds * NS_PER_SECOND)
+        in_event = (self._index[slots] == indices) & (self._end_ns[slots] >= pre_start_ns)
+        first = int(indices[in_event][0]) if in_event.any() else self.n_added
+        # the expected number of frames, for the cube size
+        n_frames = int(in_event.sum()) + 1
+        if len(indices) > 1:
+            period_ns = (self._end_ns[slots[-1]] - self._end_ns[slots[0]]) / (len(indices) - 1)
+            if period_ns > 0:
+                n_frames += int(self.post_seconds * NS_PER_SECOND / period_ns)
+        event = {'number': self.n_events, 'stamp': stamp, 'reason': reason[:MAX_REASON_LENGTH],
+                 'first': first, 'next': first, 'end_ns': post_end_ns, 'n_frames': n_frames,
+                 'closed': False}
+        self._events.append(event)
+        self.n_events += 1
+        if self.logger is not None:
+            self.logger.info(f"Event {event['number']} triggered at {self.clock.iso_date(stamp)}"
+                             f"{': ' + event['reason'] if event['reason'] else ''}, "
+                             f"{int(in_event.sum())} frames before the trigger")
+        self._condition.notify_all()
+
+    def _next_frame(self, event):
+        # slot of the next frame of the event, or None at its end, waits for the frame
+        with self._condition:
+            while True:
+                index = event['next']
+                if index < self.n_added:
+                    slot = index % self.n_slots
+                    if self._end_ns[slot] > event['end_ns']:
+                        event['closed'] = True
+                        return None
+                    return slot
+                if self._stopping:
+                    event['closed'] = True
+                    return None
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._events and not self._stopping:
+                    self._condition.wait()
+                if not self._events:
+                    return
+                event = self._events[0]
+            try:
+                self._write_event(event)
+            except Exception as err:
+                self.n_write_errors += 1
+                if self.logger is not None:
+                    self.logger.error(f"Writing event {event['number']} failed: {err}")
+            with self._condition:
+                self._events.pop(0)
+                self._condition.notify_all()
+
+    def _write_event(self, event):
+        name = f"{self.prefix}{event['number']:04d}"
+        cube_writer = None
+        if self.mode == 'sequence':
+            folder = os.path.join(self.output_folder, name)
+            os.makedirs(folder, exist_ok=True)
+        else:
+            cube_writer = CubeWriter(self.output_folder, prefix=f'{name}_',
+                                     frames_per_file=event['n_frames'], mode=self.mode,
+                                     compress=self.compress, on_file_closed=self.on_file_closed)
+        n_frames = 0
+        try:
+            while True:
+                slot = self._next_frame(event)
+                if slot is None:
+                    break
+                sequence = int(self._sequence[slot])
+                filename = f'frame{sequence:06d}.fits'
+                header = self.header_function(filename, int(self._exposure_us[slot]),
+                                              int(self._start_ns[slot]), int(self._end_ns[slot]),
+                                              float(self._temp_C[slot]))
+                header.update({'EVENT': event['number'],
+                               'TRIGGER': self.clock.iso_date(event['stamp']),
+                               'EVREASON': event['reason']})
+                if cube_writer is not None:
+                    cube_writer.write(self._frames[slot], header, sequence)
+                else:
+                    path = os.path.join(folder, filename)
+                    fitsio.write(path, self._frames[slot], header=header, compress=self.compress,
+                                 clobber=True)
+                    self.files.append(path)
+                    if self.on_file_closed is not None:
+                        self.on_file_closed(path)
+                n_frames += 1
+                self.n_written += 1
+                with self._condition:
+                    event['next'] += 1
+        finally:
+            if cube_writer is not None:
+                cube_writer.close()
+                self.files.extend(cube_writer.files)
+        if self.logger is not None:
+            self.logger.info(f"Event {event['number']}: wrote {n_frames} frames")
+
+
+class TriggerSocket(object):
+    """Triggers events on UDP datagrams to a local port, the text of a datagram is the reason.
+
+    Example:
+        listener = TriggerSocket(events.trigger, 9102)
+        $ echo fireball > /dev/udp/127.0.0.1/9102
+    """
+
+    def __init__(self, trigger, port, host='127.0.0.1'):
+        """
+        Args:
+            trigger (callable): called with the reason of each trigger.
+            port (int): UDP port, 0 for any free port.
+            host (str): address listened on, local only by default.
+        """
+        self.trigger = trigger
+        self.n_triggers = 0
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((host, port))
+        self._socket.settimeout(0.5)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='TriggerSocket', daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self._socket.getsockname()[1]
+
+    def close(self):
+        self._stopping.set()
+        self._thread.join()
+        self._socket.close()
+
+    # Private methods
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                message = self._socket.recv(1024)
+            except socket.timeout:
+                continue
+            self.n_triggers += 1
+            self.trigger(message.decode('utf-8', errors='replace').strip())
@@ -0,0 +1,294 @@
+import collections
+import math
+import threading
+import time
+
+import numpy as np
+
+from libasi import control_type_codes
+
+# Exposure control policies
+AE_POLICIES = ('pid', 'step')
+
+# Pixels of a frame sampled for its brightness statistics
+SAMPLE_PIXELS = 1 << 16
+
+# Gain units (0.1 dB) per factor 10 of the signal
+GAIN_UNITS_PER_DECADE = 200
+
+# Brightness above which a percentile is taken as saturated
+SATURATED = 0.98
+
+# Relative exposure change below which a correction is left out, e.g. float residue
+MIN_CHANGE = 1e-3
+
+
+def frame_percentiles(data, percentiles, max_pixels=SAMPLE_PIXELS):
+    """Percentiles of the pixel values of a frame, as fractions of the full scale.
+
+    The percentiles come from the histogram of a strided view of about max_pixels pixels,
+    made with np.bincount: 256 bins for 8 bit frames, 4096 for 16 bit frames, the 12 bit ADC
+    resolution of the left aligned RAW16 pixels. This takes well under a millisecond for a
+    full frame, whatever its size.
+
+    Args:
+        data (numpy.ndarray): uint8 or uint16 frame.
+        percentiles (sequence of float): percentiles, 0 to 100.
+        max_pixels (int): approximate number of pixels sampled.
+
+    Returns:
+        numpy.ndarray: the percentiles, the centres of their bins divided by the full scale.
+    """
+    step = max(1, int(math.sqrt(data.size / max_pixels)))
+    sample = data[..., ::step, ::step]
+    if data.dtype == np.uint8:
+        n_bins = 256
+    else:
+        n_bins = 4096
+        sample = sample >> 4
+    cumulative = np.cumsum(np.bincount(sample.ravel(), minlength=n_bins))
+    ranks = np.asarray(percentiles, dtype=float) / 100 * (cumulative[-1] - 1)
+    return (np.searchsorted(cumulative, ranks, side='right') + 0.5) / n_bins
+
+
+class ExposureSchedule(object):
+    """The exposure time and gain of each video frame, from the times they were set.
+
+    In video mode the camera keeps exposing while the controls change, and reading EXPOSURE
+    after a frame arrived gives the value of a later frame. The schedule sets the controls
+    itself and stamps each change with time.monotonic_ns(). A frame is taken to have the
+    settings of the last change made before its exposure started, i.e. before its arrival
+    minus its exposure time.
+    """
+
+    def __init__(self, driver, camera_ID, exposure_us, gain, history_size=64):
+        """
+        Args:
+            driver (ASIDriver): driver of the camera.
+            camera_ID (int): integer ID of the camera
+            exposure_us (int): exposure time set on the camera, in microseconds.
+            gain (int): gain set on the camera.
+            history_size (int): number of changes kept.
+        """
+        self.driver = driver
+        self.camera_ID = camera_ID
+        self.n_changes = 0
+        self._history = collections.deque([(0, exposure_us, gain)], maxlen=history_size)
+        self._lock = threading.Lock()
+
+    @property
+    def exposure_us(self):
+        """The last exposure time set """
+        return self._history[-1][1]
+
+    @property
+    def gain(self):
+        """The last gain set """
+        return self._history[-1][2]
+
+    def set(self, exposure_us=None, gain=None):
+        """Set the exposure time in microseconds and/or the gain on the camera """
+        exposure_us = self.exposure_us if exposure_us is None else int(exposure_us)
+        gain = self.gain if gain is None else int(gain)
+        if exposure_us != self.exposure_us:
+            self.driver.set_control_raw(self.camera_ID, 'EXPOSURE', exposure_us)
+        if gain != self.gain:
+            self.driver.set_control_raw(self.camera_ID, 'GAIN', gain)
+        # frames exposed from now on have the new settings
+        with self._lock:
+            self._history.append((time.monotonic_ns(), exposure_us, gain))
+        self.n_changes += 1
+
+    def at(self, frame_end_ns):
+        """Get the exposure time and gain of the frame which arrived at frame_end_ns.
+
+        Returns:
+            (int, int): exposure time in microseconds and gain.
+        """
+        with self._lock:
+            for set_ns, exposure_us, gain in reversed(self._history):
+                if frame_end_ns - exposure_us * 1000 >= set_ns:
+                    return exposure_us, gain
+            return self._history[0][1:]
+
+
+class ExposureController(object):
+    """Closed loop exposure control from the frame brightness, on the host.
+
+    The SDK auto exposure is a black box with a fixed target. The controller instead
+    measures a percentile of each frame, e.g. the median for the sky background or the 99th
+    percentile to keep stars off the saturation, with frame_percentiles(), and drives the
+    brightness to the target fraction of the full scale through an ExposureSchedule.
+
+    The error is the log of the target over the brightness, so corrections are exposure
+    factors. The 'pid' policy applies kp times the error plus ki times its sum plus kd times
+    its change, the 'step' policy a fixed step_factor up or down. Errors within the
+    tolerance are ignored, each correction is limited to max_step, and a saturated
+    percentile gives at least a halving. A brighter exposure is made by a longer exposure
+    time first, and by more gain only once the exposure time is at its limit, if
+    control_gain; a darker one by less gain first. The integral term is limited to max_step,
+    and does not grow while the controls are at their limit in the direction of the error.
+
+    The limits are the control caps of the camera, narrowed by the given limits. Frames
+    exposed before the last change are not used, so the loop waits for the result of each
+    change instead of overshooting.
+
+    Example:
+        schedule = ExposureSchedule(cam, cam_id, exposure_us, gain)
+        controller = ExposureController(cam, cam_id, schedule, target=0.25)
+        controller.update(data, frame_end_ns)
+        exposure_us, gain = schedule.at(frame_end_ns)
+    """
+
+    def __init__(self, driver, camera_ID, schedule, target=0.25, percentile=50.0, policy='pid',
+                 tolerance=0.1, kp=0.6, ki=0.1, kd=0.0, step_factor=1.25, max_step=4.0,
+                 min_exposure_us=None, max_exposure_us=None, control_gain=False, min_gain=None,
+                 max_gain=None, max_pixels=SAMPLE_PIXELS, logger=None):
+        """
+        Args:
+            driver (ASIDriver): driver of the initialised camera.
+            camera_ID (int): integer ID of the camera
+            schedule (ExposureSchedule): schedule setting the controls.
+            target (float): target brightness, a fraction of the full scale.
+            percentile (float): percentile of the pixel values measured, 0 to 100.
+            policy (str): one of AE_POLICIES.
+            tolerance (float): relative brightness error ignored.
+            kp, ki, kd (float): gains of the 'pid' policy.
+            step_factor (float): exposure factor of the 'step' policy.
+            max_step (float): maximum exposure factor of a correction.
+            min_exposure_us, max_exposure_us (int, optional): exposure time limits.
+            control_gain (bool): also control the gain.
+            min_gain, max_gain (int, optional): gain limits.
+            max_pixels (int): pixels sampled for the brightness.
+            logger (logging.Logger, optional): logger of the changes.
+        """
+        if policy not in AE_POLICIES:
+            raise ValueError(f'Unknown exposure control policy {policy}, use one of {AE_POLICIES}')
+        if not 0 < target < 1:
+            raise ValueError(f'Target brightness {target} is not a fraction of the full scale')
+        self.schedule = schedule
+        self.target = target
+        self.percentile = percentile
+        self.policy = policy
+        self.tolerance = tolerance
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.step_factor = step_factor
+        self.max_step = max_step
+        self.control_gain = control_gain
+        self.max_pixels = max_pixels
+        self.logger = logger
+
+        caps_index = driver.get_control_caps_index(camera_ID) or {}
+        self.min_exposure_us, self.max_exposure_us = _limits(
+            caps_index.get(control_type_codes['EXPOSURE']), min_exposure_us, max_exposure_us)
+        self.min_gain, self.max_gain = _limits(
+            caps_index.get(control_type_codes['GAIN']), min_gain, max_gain)
+
+        self.brightness = None
+        self.n_updates = 0
+        self.n_skipped = 0
+        self._integral = 0.0
+        self._last_error = None
+
+    @property
+    def stats(self):
+        """Dictionary of the controller counters and state """
+        return {'updates': self.n_updates,
+                'skipped': self.n_skipped,
+                'changes': self.schedule.n_changes,
+                'brightness': self.brightness,
+                'exposure_us': self.schedule.exposure_us,
+                'gain': self.schedule.gain}
+
+    def update(self, data, frame_end_ns):
+        """Measure a frame and correct the exposure for the next frames.
+
+        Args:
+            data (numpy.ndarray): the frame, as returned by the camera.
+            frame_end_ns (int): time.monotonic_ns() when the frame arrived.
+
+        Returns:
+            float or None: the measured brightness, None if the frame was exposed with older
+                settings.
+        """
+        if self.schedule.at(frame_end_ns) != (self.schedule.exposure_us, self.schedule.gain):
+            self.n_skipped += 1
+            return None
+        self.n_updates += 1
+        brightness = float(frame_percentiles(data, (self.percentile,), self.max_pixels)[0])
+        self.brightness = brightness
+
+        error = math.log(self.target / brightness)
+        if abs(error) <= math.log1p(self.tolerance):
+            self._last_error = error
+            return brightness
+        max_correction = math.log(self.max_step)
+        if self.policy == 'pid':
+            if not self._at_limit(error):
+                # no windup while the controls cannot follow
+                self._integral += error
+            if self.ki > 0:
+                limit = max_correction / self.ki
+                self._integral = min(max(self._integral, -limit), limit)
+            derivative = 0.0 if self._last_error is None else error - self._last_error
+            correction = self.kp * error + self.ki * self._integral + self.kd * derivative
+        else:
+            correction = math.copysign(math.log(self.step_factor), error)
+        self._last_error = error
+        if brightness >= SATURATED:
+            # the real brightness is unknown, at least halve the exposure
+            correction = min(correction, -math.log(2))
+        correction = min(max(correction, -max_correction), max_correction)
+
+        self._apply(math.exp(correction))
+        return brightness
+
+    # Private methods
+
+    def _at_limit(self, error):
+        # whether the controls are at their limit in the direction of the error
+        if error > 0:
+            return (self.schedule.exposure_us >= self.max_exposure_us
+                    and (not self.control_gain or self.schedule.gain >= self.max_gain))
+        return (self.schedule.exposure_us <= self.min_exposure_us
+                and (not self.control_gain or self.schedule.gain <= self.min_gain))
+
+    def _apply(self, factor):
+        exposure_us = self.schedule.exposure_us
+        gain = self.schedule.gain
+        new_gain = gain
+        if factor < 1 - MIN_CHANGE:
+            if self.control_gain:
+                # less gain first, for less noise
+                new_gain = max(gain + GAIN_UNITS_PER_DECADE * math.log10(factor), self.min_gain)
+                factor /= 10 ** ((new_gain - gain) / GAIN_UNITS_PER_DECADE)
+            new_exposure_us = max(exposure_us * factor, self.min_exposure_us)
+        elif factor > 1 + MIN_CHANGE:
+            new_exposure_us = min(exposure_us * factor, self.max_exposure_us)
+            # what the exposure time could not do
+            factor *= exposure_us / new_exposure_us
+            if (self.control_gain and new_exposure_us >= self.max_exposure_us
+                    and factor > 1 + MIN_CHANGE):
+                new_gain = min(gain + GAIN_UNITS_PER_DECADE * math.log10(factor), self.max_gain)
+        else:
+            return False
+        new_exposure_us = int(round(min(max(new_exposure_us, self.min_exposure_us),
+                                        self.max_exposure_us)))
+        new_gain = int(round(new_gain))
+        if new_exposure_us == exposure_us and new_gain == gain:
+            return False
+        self.schedule.set(new_exposure_us, new_gain)
+        if self.logger is not None:
+            self.logger.debug(f'Brightness {self.brightness:.3f}, target {self.target:.3f}: exposure '
+                              f'{exposure_us} -> {new_exposure_us} us, gain {gain} -> {new_gain}')
+        return True
+
+
+def _limits(caps, low, high):
+    # the control caps range, narrowed by the given limits
+    if caps is not None:
+        low = caps.min_value if low is None else max(low, caps.min_value)
+        high = caps.max_value if high is None else min(high, caps.max_value)
+    return low if low is not None else 0, high if high is not None else math.inf
@@ -0,0 +1,171 @@
+import os
+
+import numpy as np
+
+FITS_BLOCK = 2880
+CARD_LENGTH = 80
+
+# Keys of the pp_test.py frame headers that change from frame to frame
+FRAME_KEYS = ('FILE', 'EXPTIME', 'EXPOSURE', 'EXPOINUS', 'DATE-OBS', 'DATE-STA', 'DATE-END',
+              'CCD_TEMP')
+
+# BITPIX and BZERO of the supported frame dtypes
+fits_types = {np.dtype(np.uint8): (8, None),
+              np.dtype(np.uint16): (16, 32768),
+              np.dtype(np.int16): (16, None),
+              np.dtype(np.uint32): (32, 2147483648),
+              np.dtype(np.float32): (-32, None)}
+
+
+def format_value(value):
+    """Format a header value as a fixed format FITS card value field """
+    if isinstance(value, (bool, np.bool_)):
+        return f'{"T" if value else "F":>20s}'
+    if isinstance(value, (int, np.integer)):
+        return f'{value:>20d}'
+    if isinstance(value, (float, np.floating)):
+        text = f'{value:.15G}'
+        if '.' not in text:
+            # a FITS real needs a decimal point, e.g. 45. or 1.E-05
+            mantissa, _, exponent = text.partition('E')
+            text = f'{mantissa}.E{exponent}' if exponent else f'{mantissa}.'
+        return f'{text:>20s}'
+    text = "'{:8s}'".format(str(value).replace("'", "''"))
+    return f'{text:20s}'
+
+
+def format_card(key, value):
+    """Format a header card as 80 bytes """
+    card = f'{key:8s}= {format_value(value)}'
+    if len(card) > CARD_LENGTH:
+        raise ValueError(f'Value of {key} does not fit in a header card: {value}')
+    return f'{card:{CARD_LENGTH}s}'.encode('ascii')
+
+
+class FitsTemplate(object):
+    """Precomputed FITS file header, patched with the per frame values.
+
+    The headers of a run differ only in a few values, but fitsio builds every header from a
+    dict, card by card. The template serialises the whole primary header once, padded to
+    whole 2880 byte blocks, and remembers where the cards of the FRAME_KEYS are. Writing a
+    frame then formats only those cards into their slots, converts the data to big endian
+    FITS integers into a reused buffer, and writes header, data and padding with a single
+    writev.
+
+    Only uncompressed frames of the fits_types dtypes are supported, compressed frames are
+    still written by fitsio.
+
+    Example:
+        template = FitsTemplate(make_header(...), shape, np.uint16)
+        template.write(path, data, {'FILE': filename, 'DATE-OBS': ..., ...})
+    """
+
+    def __init__(self, header, shape, dtype, frame_keys=FRAME_KEYS):
+        """
+        Args:
+            header (dict): header of the first frame, the values of the other keys are the
+                same for all frames.
+            shape (tuple): frame shape.
+            dtype (numpy.dtype): frame dtype.
+            frame_keys (sequence of str): keys which can be patched for each frame.
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in fits_types:
+            raise ValueError(f'Unsupported frame dtype {self.dtype}')
+        bitpix, bzero = fits_types[self.dtype]
+
+        cards = [format_card('SIMPLE', True),
+                 format_card('BITPIX', bitpix),
+                 format_card('NAXIS', len(self.shape))]
+        # FITS axes are in the reverse order of numpy axes
+        cards += [format_card(f'NAXIS{axis}', size)
+                  for axis, size in enumerate(reversed(self.shape), start=1)]
+        cards.append(format_card('EXTEND', True))
+        if bzero is not None:
+            cards += [format_card('BZERO', bzero), format_card('BSCALE', 1)]
+
+        self._slots = {}
+        for key, value in header.items():
+            if key in frame_keys:
+                self._slots[key] = len(cards) * CARD_LENGTH
+            cards.append(format_card(key, value))
+        cards.append(f'{"END":{CARD_LENGTH}s}'.encode('ascii'))
+
+        header_bytes = b''.join(cards)
+        self._header = bytearray(header_bytes.ljust(padded_size(len(header_bytes)), b' '))
+
+        # big endian data buffer, reused for every frame
+        self._data = np.empty(self.shape if self.dtype.itemsize > 1 else 0,
+                              dtype=self.dtype.newbyteorder('>'))
+        self._bzero = bzero
+        data_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._padding = bytes(padded_size(data_size) - data_size)
+
+    @property
+    def header_size(self):
+        return len(self._header)
+
+    def patch(self, values):
+        """Format the values of frame keys into their header cards """
+        for key, value in values.items():
+            offset = self._slots[key]
+            self._header[offset:offset + CARD_LENGTH] = format_card(key, value)
+
+    def write(self, path, data, values):
+        """Write a frame to a FITS file with the template header.
+
+        Args:
+            path (str): path of the file, overwritten if it exists.
+            data (numpy.ndarray): the frame, of the template shape and dtype.
+            values (dict): values of the frame keys, the other frame keys keep the value of
+                the previous frame.
+        """
+        write_file(path, self.buffers(data, values))
+
+    def buffers(self, data, values):
+        """Patch the header and convert a frame, see write().
+
+        Returns:
+            list of bytes-like: header, data and padding of the file, valid until the next
+                frame.
+        """
+        if data.shape != self.shape or data.dtype != self.dtype:
+            raise ValueError(f'Frame {data.shape} {data.dtype} does not match the template '
+                             f'{self.shape} {self.dtype}')
+        self.patch(values)
+        if self.dtype.itemsize == 1:
+            big_endian = np.ascontiguousarray(data)
+        elif self._bzero is not None:
+            # unsigned to the signed FITS integers, value - BZERO is flipping the sign bit
+            big_endian = np.bitwise_xor(data, self._bzero, out=self._data)
+        else:
+            big_endian = self._data
+            big_endian[...] = data
+        return [self._header, big_endian, self._padding]
+
+
+def padded_size(size):
+    """Size rounded up to whole FITS blocks """
+    return (size + FITS_BLOCK - 1) // FITS_BLOCK * FITS_BLOCK
+
+
+def write_buffers(fd, buffers):
+    """Write all the buffers to a file descriptor, with a single writev if possible """
+    buffers = [memoryview(buffer).cast('B') for buffer in buffers]
+    total = sum(len(buffer) for buffer in buffers)
+    written = os.writev(fd, buffers)
+    if written < total:
+        # e.g. interrupted or more than 2 GB, write the rest
+        remaining = b''.join(buffers)[written:]
+        while remaining:
+            remaining = remaining[os.write(fd, remaining):]
+
+
+def write_file(path, buffers):
+    """Write the buffers to a file, overwritten if it exists """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        write_buffers(fd, buffers)
+    finally:
+        os.close(fd)
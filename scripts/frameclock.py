@@ -0,0 +1,139 @@
+import bisect
+import threading
+import time
+
+import numpy as np
+
+NS_PER_SECOND = 1_000_000_000
+NS_PER_MS = 1_000_000
+
+
+class FrameClock(object):
+    """Frame timestamps as monotonic clock integers, converted to UTC when needed.
+
+    Reading the UTC time for every frame with datetime.now() costs a system call and a few
+    objects per frame, and the system clock can be stepped by NTP in the middle of a run. The
+    capture loop instead records time.monotonic_ns() of each frame (see now()), a plain
+    integer, and the clock converts the stamps to UTC only when a header is written.
+
+    The clock anchors the monotonic clock to UTC by reading both clocks, keeping the reading
+    with the shortest gap of n_samples. It re-anchors when a stamp is converted more than
+    refresh_interval seconds after the last anchor, and interpolates the offset between
+    anchors, so the slow drift between the two clocks is followed without any UTC step within
+    a run. Conversions of many stamps at once, e.g. of a spool, are vectorized with numpy.
+
+    A clock can be shared by threads, e.g. the capture threads of all the cameras.
+
+    Example:
+        clock = FrameClock()
+        stamp = clock.now()
+        ... wait for the frame ...
+        header['DATE-END'] = clock.iso_date(stamp)
+        header['DATE-OBS'] = clock.iso_date(stamp - exp_us * 1000)
+    """
+
+    def __init__(self, refresh_interval=60.0, n_samples=5, max_anchors=1024):
+        """
+        Args:
+            refresh_interval (float): seconds between anchors to UTC.
+            n_samples (int): readings of the two clocks per anchor.
+            max_anchors (int): number of anchors kept to convert older stamps.
+        """
+        self.refresh_interval = refresh_interval
+        self.n_samples = n_samples
+        self.max_anchors = max_anchors
+        self._refresh_ns = int(refresh_interval * NS_PER_SECOND)
+        self._lock = threading.Lock()
+        # monotonic stamps and UTC offsets of the anchors, replaced as a whole
+        self._anchors = ((), ())
+        # the UTC second and its ISO string of the last iso_date()
+        self._iso_cache = (None, '')
+        self.refresh()
+
+    now = staticmethod(time.monotonic_ns)
+
+    @property
+    def offset_ns(self):
+        """The latest offset of UTC nanoseconds since epoch to the monotonic clock """
+        return self._anchors[1][-1]
+
+    def refresh(self):
+        """Anchor the monotonic clock to UTC again """
+        best_gap = None
+        for _ in range(self.n_samples):
+            before = time.monotonic_ns()
+            utc = time.time_ns()
+            after = time.monotonic_ns()
+            if best_gap is None or after - before < best_gap:
+                best_gap = after - before
+                stamp = (before + after) // 2
+                offset = utc - stamp
+        with self._lock:
+            stamps, offsets = self._anchors
+            if stamps and stamp <= stamps[-1]:
+                return
+            self._anchors = ((stamps + (stamp,))[-self.max_anchors:],
+                             (offsets + (offset,))[-self.max_anchors:])
+
+    def utc_ns(self, stamp):
+        """Convert a monotonic stamp to UTC nanoseconds since epoch """
+        stamps, offsets = self._anchors
+        if stamp >= stamps[-1]:
+            if stamp - stamps[-1] <= self._refresh_ns:
+                return stamp + offsets[-1]
+            self.refresh()
+            stamps, offsets = self._anchors
+            if stamp >= stamps[-1]:
+                return stamp + offsets[-1]
+        index = bisect.bisect_right(stamps, stamp)
+        if index == 0:
+            return stamp + offsets[0]
+        stamp0, stamp1 = stamps[index - 1], stamps[index]
+        offset0, offset1 = offsets[index - 1], offsets[index]
+        return stamp + offset0 + (offset1 - offset0) * (stamp - stamp0) // (stamp1 - stamp0)
+
+    def timestamp(self, stamp):
+        """Convert a monotonic stamp to seconds since epoch, like time.time() """
+        return self.utc_ns(stamp) / NS_PER_SECOND
+
+    def iso_date(self, stamp):
+        """Convert a monotonic stamp to an ISO format UTC date string with milliseconds """
+        seconds, ns = divmod(self.utc_ns(stamp), NS_PER_SECOND)
+        cached_seconds, prefix = self._iso_cache
+        if seconds != cached_seconds:
+            # a new date and time string only once per second
+            prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))
+            self._iso_cache = (seconds, prefix)
+        return f'{prefix}.{ns // NS_PER_MS:03d}'
+
+    def utc_ns_array(self, stamps):
+        """Convert an array of monotonic stamps to UTC nanoseconds since epoch, as int64 """
+        stamps = np.asarray(stamps, dtype=np.int64)
+        anchor_stamps, offsets = self._anchors
+        if stamps.size and stamps.max() - anchor_stamps[-1] > self._refresh_ns:
+            self.refresh()
+            anchor_stamps, offsets = self._anchors
+        # offsets relative to the first anchor, so the interpolation keeps nanoseconds
+        offsets = np.array(offsets, dtype=np.int64)
+        drift = np.interp(stamps, anchor_stamps, offsets - offsets[0])
+        return stamps + offsets[0] + np.rint(drift).astype(np.int64)
+
+    def iso_dates(self, stamps):
+        """Convert an array of monotonic stamps to ISO format UTC date strings, see iso_date() """
+        return iso_dates(self.utc_ns_array(stamps))
+
+
+def iso_dates(utc_ns):
+    """Convert UTC nanoseconds since epoch to ISO format date strings with milliseconds.
+
+    Args:
+        utc_ns (numpy.ndarray): int64 nanoseconds since epoch, or float64 seconds since epoch.
+
+    Returns:
+        numpy.ndarray: the date strings.
+    """
+    utc_ns = np.asarray(utc_ns)
+    if utc_ns.dtype.kind == 'f':
+        # rounded to microseconds first, like datetime.fromtimestamp()
+        utc_ns = np.rint(utc_ns * 1e6).astype(np.int64) * 1000
+    return np.datetime_as_string(utc_ns.astype('datetime64[ns]'), unit='ms')
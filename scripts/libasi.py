@@ -1,5 +1,7 @@
+import collections
 import ctypes
 import enum
+import threading
 
 import numpy as np
 from astropy import units as u
@@ -7,6 +9,8 @@ from panoptes.pocs.camera.sdk import AbstractSDKDriver
 from panoptes.utils import error
 from panoptes.utils.utils import get_quantity_value
 
+from telemetry import DEFAULT_CONTROLS, TelemetrySampler
+
 
 ####################################################################################################
 #
@@ -19,7 +23,7 @@ from panoptes.utils.utils import get_quantity_value
 
 
 class ASIDriver(AbstractSDKDriver):
-    def __init__(self, library_path=None, **kwargs):
+    def __init__(self, library_path=None, frame_pool_size=8, **kwargs):
         """Main class representing the ZWO ASI library interface.
 
         On construction loads the shared object/dynamically linked version of the ASI SDK library,
@@ -30,6 +34,8 @@ class ASIDriver(AbstractSDKDriver):
 
         Args:
             library_path (str, optional): path to the library e.g. '/usr/local/lib/libASICamera2.so'
+            frame_pool_size (int, optional): maximum number of free frame buffers of each size kept
+                for reuse by get_video_data and get_exposure_data, default 8.
 
         Returns:
             `~pocs.camera.libasi.ASIDriver`
@@ -40,7 +46,12 @@ class ASIDriver(AbstractSDKDriver):
             OSError: raises if the ctypes.CDLL loader cannot load the library.
         """
         super().__init__(name='ASICamera2', library_path=library_path, **kwargs)
+        self._bind_functions()
+        self._scratch = threading.local()  # Reusable ctypes output arguments, see _get_scratch
+        self._telemetry = {}  # TelemetrySamplers by camera ID
+        self._caps_index = {}  # Control capabilities by camera ID, see get_control_caps_index
         self._product_ids = self.get_product_ids()  # Supported camera models
+        self.frame_pool = FramePool(max_buffers=frame_pool_size)
 
     # Methods
 
@@ -105,12 +116,12 @@ class ASIDriver(AbstractSDKDriver):
 
     def get_product_ids(self):
         """Get product IDs of cameras supported by the SDK."""
-        n_pids = self._CDLL.ASIGetProductIDs(0)  # Call once to get number of product IDs
+        n_pids = self._CDLL.ASIGetProductIDs(None)  # Call once to get number of product IDs
         if n_pids > 0:
             # Make array of C ints of required size.
             product_ids = (ctypes.c_int * n_pids)()
             # Call again to get product IDs. Should get same n_pids as before.
-            assert n_pids == self._CDLL.ASIGetProductIDs(ctypes.byref(product_ids))
+            assert n_pids == self._CDLL.ASIGetProductIDs(product_ids)
         else:
             self.logger.error("Error getting supported camera product IDs from SDK.")
             raise RuntimeError("ZWO SDK support 0 SDK products?")
@@ -148,13 +159,15 @@ class ASIDriver(AbstractSDKDriver):
         self.logger.debug("Opened camera {}".format(camera_ID))
 
     def init_camera(self, camera_ID):
-        """ Initialise camera with given integer ID """
+        """ Initialise camera with given integer ID, and index its control capabilities """
         self._call_function('ASIInitCamera', camera_ID)
         self.logger.debug("Initialised camera {}".format(camera_ID))
+        self._index_control_caps(camera_ID)
 
     def close_camera(self, camera_ID):
         """ Close camera with given integer ID """
         self._call_function('ASICloseCamera', camera_ID)
+        self._caps_index.pop(camera_ID, None)
         self.logger.debug("Closed camera {}".format(camera_ID))
 
     def get_ID(self, camera_ID):
@@ -195,34 +208,31 @@ class ASIDriver(AbstractSDKDriver):
         return n_controls
 
     def get_control_caps(self, camera_ID):
-        """ Gets the details of all the controls supported by the camera with given integer ID """
-        n_controls = self.get_num_of_controls(camera_ID)  # First get number of controls
+        """ Gets the details of all the controls supported by the camera with given integer ID
+
+        Served from the capabilities index built by init_camera, if the camera was initialised.
+        """
+        if camera_ID not in self._caps_index:
+            self._index_control_caps(camera_ID)
         controls = {}
-        for i in range(n_controls):
-            control_caps = ControlCaps()
-            self._call_function('ASIGetControlCaps',
-                                camera_ID,
-                                ctypes.c_int(i),
-                                ctypes.byref(control_caps))
-            # print(control_caps)
-            # print(f'control_caps.control_type = {control_caps.control_type}')
-            # print(f'control_caps.name = {control_caps.name}')
+        for control_caps in self._caps_index[camera_ID].values():
             control = self._parse_caps(control_caps)
             controls[control['control_type']] = control
-        self.logger.debug("Got details of {} controls from camera {}".format(n_controls, camera_ID))
         return controls
 
+    def get_control_caps_index(self, camera_ID):
+        """Get the raw capabilities of the controls supported by camera with given integer ID
+
+        Returns:
+            dict: ControlCapsEntry, with raw SDK values, by ControlType. Built by init_camera,
+                or None if the camera was not initialised.
+        """
+        return self._caps_index.get(camera_ID)
+
     def get_control_value(self, camera_ID, control_type):
         """ Gets the value of the control control_type from camera with given integer ID """
-        value = ctypes.c_long()
-        is_auto = ctypes.c_int()
-        self._call_function('ASIGetControlValue',
-                            camera_ID,
-                            ControlType[control_type],
-                            ctypes.byref(value),
-                            ctypes.byref(is_auto))
-        nice_value = self._parse_return_value(value, control_type)
-        return nice_value, bool(is_auto)
+        value, is_auto = self.get_control_raw(camera_ID, control_type)
+        return self._parse_return_value(value, control_type), is_auto
 
     def set_control_value(self, camera_ID, control_type, value):
         """ Sets the value of the control control_type on camera with given integer ID """
@@ -234,15 +244,81 @@ class ASIDriver(AbstractSDKDriver):
         #   cam.set_control_value(cam_id, 'EXPOSURE', 'AUTO')
         if value == 'AUTO':
             # Apparently need to pass current value when turning auto on
-            auto = True
-            value = self.get_control_value(camera_ID, control_type)[0]
+            self.set_control_raw(camera_ID, control_type,
+                                 self.get_control_raw(camera_ID, control_type)[0], auto=True)
         else:
-            auto = False
+            self.set_control_raw(camera_ID, control_type,
+                                 self._parse_input_value(value, control_type))
+
+    def get_control_raw(self, camera_ID, control_type):
+        """Gets the raw SDK value of the control control_type from camera with given integer ID
+
+        Fast path of get_control_value without unit and type conversions, e.g. EXPOSURE is an
+        int in microseconds and TEMPERATURE an int in tenths of degree C.
+
+        Returns:
+            (int, bool): the value and whether the control is in auto mode.
+        """
+        scratch = self._get_scratch(camera_ID)
+        self._call_function('ASIGetControlValue',
+                            camera_ID,
+                            control_type_codes[control_type],
+                            scratch.long_ref,
+                            scratch.bool_ref)
+        return scratch.long.value, scratch.bool.value != 0
+
+    def get_controls_raw(self, camera_ID, control_types, errors=None):
+        """Gets the raw SDK values of several controls from camera with given integer ID
+
+        Args:
+            camera_ID (int): integer ID of the camera
+            control_types (sequence of str): names of the controls.
+            errors (dict, optional): if given, a control which cannot be read is left out of
+                the values and its ASIError stored here by control name, instead of raising.
+
+        Returns:
+            dict: (int, bool) value and auto mode, see get_control_raw, by control name.
+        """
+        scratch = self._get_scratch(camera_ID)
+        call = self._call_function
+        values = {}
+        for control_type in control_types:
+            try:
+                call('ASIGetControlValue',
+                     camera_ID,
+                     control_type_codes[control_type],
+                     scratch.long_ref,
+                     scratch.bool_ref)
+            except ASIError as err:
+                if errors is None:
+                    raise
+                errors[control_type] = err
+                continue
+            values[control_type] = scratch.long.value, scratch.bool.value != 0
+        return values
+
+    def set_control_raw(self, camera_ID, control_type, value, auto=False):
+        """Sets the raw SDK value of the control control_type on camera with given integer ID
+
+        Fast path of set_control_value without unit and type conversions, value must be an
+        int in the SDK units, e.g. microseconds for EXPOSURE.
+
+        If the camera was initialised the value is checked against the control capabilities
+        without calling the SDK, and clamped to the allowed range.
+
+        Raises:
+            panoptes.utils.error.NotSupported: if the camera has no such control, it is read
+                only, or does not support auto mode and auto is True.
+        """
+        control_code = control_type_codes[control_type]
+        caps_index = self._caps_index.get(camera_ID)
+        if caps_index is not None:
+            value = self._check_control_value(caps_index, control_code, control_type, value, auto)
         self._call_function('ASISetControlValue',
                             camera_ID,
-                            ctypes.c_int(ControlType[control_type]),
-                            self._parse_input_value(value, control_type),
-                            ctypes.c_int(auto))
+                            control_code,
+                            value,
+                            auto)
         self.logger.debug("Set {} to {} on camera {}".format(control_type,
                                                              'AUTO' if auto else value,
                                                              camera_ID))
@@ -312,10 +388,11 @@ class ASIDriver(AbstractSDKDriver):
 
     def get_dropped_frames(self, camera_ID):
         """Get the number of dropped frames during video capture."""
-        n_dropped_frames = ctypes.c_int()
+        scratch = self._get_scratch(camera_ID)
         self._call_function('ASIGetDroppedFrames',
                             camera_ID,
-                            ctypes.byref(n_dropped_frames))
+                            scratch.int_ref)
+        n_dropped_frames = scratch.int.value
         self.logger.debug("Camera {} has dropped {} frames.".format(camera_ID, n_dropped_frames))
         return n_dropped_frames
 
@@ -376,7 +453,7 @@ class ASIDriver(AbstractSDKDriver):
         modes_struct = SupportedMode()
         self._call_function('ASIGetCameraSupportMode',
                             camera_ID,
-                            ctypes.byref(modes_struct.modes))
+                            ctypes.byref(modes_struct))
         supported_modes = []
         for mode_int in modes_struct.modes:
             if mode_int == CameraMode.END:
@@ -389,11 +466,11 @@ class ASIDriver(AbstractSDKDriver):
 
     def get_camera_mode(self, camera_ID):
         """Get current trigger mode for camera with given integer ID."""
-        mode = ctypes.int()
+        mode = ctypes.c_int()
         self._call_function('ASIGetCameraMode',
                             camera_ID,
                             ctypes.byref(mode))
-        mode_name = CameraMode(mode).name
+        mode_name = CameraMode(mode.value).name
         self.logger.debug('Camera {} is in trigger mode {}'.format(camera_ID, mode_name))
         return mode_name
 
@@ -429,20 +506,20 @@ class ASIDriver(AbstractSDKDriver):
         self.logger.debug("Got serial number '{}' from camera {}".format(serial_number, camera_ID))
         return serial_number
 
-    def get_trigger_output_io_conf(self, camera_ID):
-        """Get external trigger configuration of the camera with given integer ID."""
-        pin = ctypes.c_int()
+    def get_trigger_output_io_conf(self, camera_ID, pin='PINA'):
+        """Get external trigger configuration of given output pin of the camera with given
+        integer ID."""
         pin_high = ctypes.c_int()
         delay = ctypes.c_long()
         duration = ctypes.c_long()
         self._call_function('ASIGetTriggerOutputIOConf',
                             camera_ID,
-                            ctypes.byref(pin),
-                            ctypes.bytef(pin_high),
+                            TrigOutput[pin],
+                            ctypes.byref(pin_high),
                             ctypes.byref(delay),
                             ctypes.byref(duration))
         self.logger.debug("Got trigger config from camera {}".format(camera_ID))
-        return TrigOutput(pin).name, bool(pin_high), int(delay), int(duration)
+        return pin, bool(pin_high.value), delay.value, duration.value
 
     def set_trigger_ouput_io_conf(self, camera_ID, pin, pin_high, delay, duration):
         """Set external trigger configuration of the camera with given integer ID."""
@@ -454,9 +531,9 @@ class ASIDriver(AbstractSDKDriver):
                             ctypes.c_long(duration))
         self.logger.debug("Set trigger config of camera {}".format(camera_ID))
 
-    def start_exposure(self, camera_ID):
+    def start_exposure(self, camera_ID, is_dark=False):
         """ Start exposure on the camera with given integer ID """
-        self._call_function('ASIStartExposure', camera_ID)
+        self._call_function('ASIStartExposure', camera_ID, is_dark)
         self.logger.debug("Exposure started on camera {}".format(camera_ID))
 
     def stop_exposure(self, camera_ID):
@@ -466,18 +543,35 @@ class ASIDriver(AbstractSDKDriver):
 
     def get_exposure_status(self, camera_ID):
         """ Get status of current exposure on camera with given integer ID """
-        status = ctypes.c_int()
-        self._call_function('ASIGetExpStatus', camera_ID, ctypes.byref(status))
-        return ExposureStatus(status.value).name
+        scratch = self._get_scratch(camera_ID)
+        self._call_function('ASIGetExpStatus', camera_ID, scratch.int_ref)
+        return ExposureStatus(scratch.int.value).name
 
-    def get_exposure_data(self, camera_ID, width, height, image_type):
-        """ Get image data from exposure on camera with given integer ID """
-        exposure_data = self._image_array(width, height, image_type)
+    def get_exposure_data(self, camera_ID, width, height, image_type, out=None):
+        """Get image data from exposure on camera with given integer ID
 
-        self._call_function('ASIGetDataAfterExp',
-                            camera_ID,
-                            exposure_data.ctypes.data_as(ctypes.POINTER(ctypes.c_byte)),
-                            ctypes.c_long(exposure_data.nbytes))
+        Args:
+            camera_ID (int): integer ID of the camera
+            width (int or astropy.units.Quantity): ROI width
+            height (int or astropy.units.Quantity): ROI height
+            image_type (str): image type name, e.g. 'RAW16'
+            out (numpy.ndarray, optional): C contiguous array to read the data into. If not
+                given a buffer is taken from the frame pool, and should be handed back with
+                release_frame() once no longer needed.
+
+        Returns:
+            numpy.ndarray: the image data
+        """
+        exposure_data, pooled = self._frame_buffer(width, height, image_type, out)
+        try:
+            self._call_function('ASIGetDataAfterExp',
+                                camera_ID,
+                                exposure_data.ctypes.data,
+                                exposure_data.nbytes)
+        except RuntimeError:
+            if pooled:
+                self.frame_pool.release(exposure_data)
+            raise
         self.logger.debug("Got exposure data from camera {}".format(camera_ID))
         return exposure_data
 
@@ -489,33 +583,209 @@ class ASIDriver(AbstractSDKDriver):
         """ Stop video capture mode on camera with given integer ID """
         self._call_function('ASIStopVideoCapture', camera_ID)
 
-    def get_video_data(self, camera_ID, width, height, image_type, timeout):
-        """ Get the image data from the next available video frame """
-        video_data = self._image_array(width, height, image_type)
-        timeout = int(get_quantity_value(timeout, unit=u.ms))
+    def get_video_data(self, camera_ID, width, height, image_type, timeout, out=None):
+        """Get the image data from the next available video frame
+
+        Args:
+            camera_ID (int): integer ID of the camera
+            width (int or astropy.units.Quantity): ROI width
+            height (int or astropy.units.Quantity): ROI height
+            image_type (str): image type name, e.g. 'RAW16'
+            timeout (int or astropy.units.Quantity): maximum wait for the frame, in ms if given
+                as int, or None to wait forever. ZWO recommend exposure time * 2 + 500 ms.
+            out (numpy.ndarray, optional): C contiguous array to read the frame into. If not
+                given a buffer is taken from the frame pool, and should be handed back with
+                release_frame() once no longer needed.
+
+        Returns:
+            numpy.ndarray or None: the frame data, or None if the frame was dropped.
+
+        Raises:
+            panoptes.utils.error.Timeout: if no frame arrived within the timeout.
+        """
+        video_data, pooled = self._frame_buffer(width, height, image_type, out)
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = int(get_quantity_value(timeout, unit=u.ms))
         try:
             self._call_function('ASIGetVideoData',
                                 camera_ID,
-                                video_data.ctypes.data_as(ctypes.POINTER(ctypes.c_byte)),
-                                ctypes.c_long(video_data.nbytes),
-                                ctypes.c_int(-1))
-            # If set timeout to anything but -1 (no timeout) this call times out instantly?
-        except RuntimeError:
+                                video_data.ctypes.data,
+                                video_data.nbytes,
+                                timeout)
+        except ASIError as err:
+            if pooled:
+                self.frame_pool.release(video_data)
+            if err.error_code == ErrorCode.TIMEOUT:
+                raise error.Timeout(f"No video frame from camera {camera_ID} in {timeout} ms")
             # Expect some dropped frames during video capture
             return None
         else:
             return video_data
 
+    def wait_video_data(self, camera_ID, width, height, image_type, timeout, policy=None,
+                        stop_event=None, out=None):
+        """Get the next video frame, retrying timed out waits according to a retry policy.
+
+        Each wait is bounded, so a set stop_event is noticed within one (backed off) timeout
+        even if the camera stalls.
+
+        Args:
+            camera_ID (int): integer ID of the camera
+            width (int or astropy.units.Quantity): ROI width
+            height (int or astropy.units.Quantity): ROI height
+            image_type (str): image type name, e.g. 'RAW16'
+            timeout (int or astropy.units.Quantity): timeout of the first wait, in ms if int.
+            policy (TimeoutPolicy, optional): retry/backoff policy, default TimeoutPolicy().
+            stop_event (threading.Event, optional): give up waiting as soon as this is set.
+            out (numpy.ndarray, optional): C contiguous array to read the frame into.
+
+        Returns:
+            numpy.ndarray or None: the frame data, or None if the frame was dropped or the
+                stop_event was set.
+
+        Raises:
+            panoptes.utils.error.Timeout: if all the retries timed out.
+        """
+        if policy is None:
+            policy = TimeoutPolicy()
+        timeout = get_quantity_value(timeout, unit=u.ms)
+        for attempt, attempt_timeout in enumerate(policy.timeouts(timeout)):
+            if stop_event is not None and stop_event.is_set():
+                return None
+            if attempt > 0:
+                policy.n_retries += 1
+            try:
+                return self.get_video_data(camera_ID, width, height, image_type,
+                                           attempt_timeout, out=out)
+            except error.Timeout:
+                policy.n_timeouts += 1
+                self.logger.debug(f"Video frame wait {attempt} on camera {camera_ID} timed out"
+                                  f" after {attempt_timeout} ms")
+        policy.n_exhausted += 1
+        raise error.Timeout(f"No video frame from camera {camera_ID} after "
+                            f"{policy.max_retries} retries")
+
+    def start_telemetry(self, camera_ID, controls=DEFAULT_CONTROLS, interval=1.0,
+                        history_size=3600):
+        """Start background sampling of control values of camera with given integer ID.
+
+        See TelemetrySampler for details, the arguments are passed on to it.
+
+        Returns:
+            TelemetrySampler: the running sampler, also available from get_telemetry().
+        """
+        self.stop_telemetry(camera_ID)
+        sampler = TelemetrySampler(self, camera_ID, controls=controls, interval=interval,
+                                   history_size=history_size)
+        sampler.start()
+        self._telemetry[camera_ID] = sampler
+        self.logger.debug("Started telemetry of {} on camera {} every {} s".format(
+            sampler.controls, camera_ID, interval))
+        return sampler
+
+    def stop_telemetry(self, camera_ID):
+        """Stop background sampling of control values of camera with given integer ID """
+        sampler = self._telemetry.get(camera_ID)
+        if sampler is not None:
+            sampler.stop()
+            self.logger.debug("Stopped telemetry on camera {}".format(camera_ID))
+
+    def get_telemetry(self, camera_ID):
+        """Get the TelemetrySampler of camera with given integer ID, None if never started """
+        return self._telemetry.get(camera_ID)
+
+    def release_frame(self, frame):
+        """Hand a frame buffer returned by get_video_data/get_exposure_data back for reuse.
+
+        The caller must not touch the array after releasing it, the next frame will be read
+        into it.
+        """
+        self.frame_pool.release(frame)
+
     # Private methods
 
+    def _bind_functions(self):
+        """ Declare argument and return types of the SDK functions, once for all calls """
+        self._functions = {}
+        for function_name, (restype, argtypes) in function_prototypes.items():
+            try:
+                function = getattr(self._CDLL, function_name)
+            except AttributeError:
+                # Not in this version of the SDK
+                self.logger.debug("SDK library has no function {}".format(function_name))
+                continue
+            function.restype = restype
+            function.argtypes = argtypes
+            self._functions[function_name] = function
+
+    def _index_control_caps(self, camera_ID):
+        """ Read the capabilities of all the controls of given camera into the caps index """
+        n_controls = self.get_num_of_controls(camera_ID)  # First get number of controls
+        caps_index = {}
+        control_caps = ControlCaps()
+        for i in range(n_controls):
+            self._call_function('ASIGetControlCaps',
+                                camera_ID,
+                                i,
+                                ctypes.byref(control_caps))
+            control_type = ControlType(control_caps.control_type)
+            caps_index[control_type] = ControlCapsEntry(
+                name=control_caps.name.decode(),
+                description=control_caps.description.decode(),
+                max_value=control_caps.max_value,
+                min_value=control_caps.min_value,
+                default_value=control_caps.default_value,
+                is_auto_supported=bool(control_caps.is_auto_supported),
+                is_writable=bool(control_caps.is_writable),
+                control_type=control_type)
+        self._caps_index[camera_ID] = caps_index
+        self.logger.debug("Got details of {} controls from camera {}".format(n_controls, camera_ID))
+        return caps_index
+
+    def _check_control_value(self, caps_index, control_code, control_type, value, auto):
+        """ Validate a raw control value against the control caps, returns the clamped value """
+        caps = caps_index.get(control_code)
+        if caps is None:
+            raise error.NotSupported("Camera has no control {}".format(control_type))
+        if not caps.is_writable:
+            raise error.NotSupported("Control {} is read only".format(control_type))
+        if auto and not caps.is_auto_supported:
+            raise error.NotSupported("Control {} has no auto mode".format(control_type))
+        if value > caps.max_value or value < caps.min_value:
+            clamped = min(max(value, caps.min_value), caps.max_value)
+            self.logger.warning("{} value {} out of range {}..{}, set to {}".format(
+                control_type, value, caps.min_value, caps.max_value, clamped))
+            return clamped
+        return value
+
+    def _get_scratch(self, camera_ID):
+        """ Get the reusable ctypes output arguments of given camera for the calling thread """
+        try:
+            return self._scratch.cameras[camera_ID]
+        except AttributeError:
+            self._scratch.cameras = {}
+        except KeyError:
+            pass
+        scratch = self._scratch.cameras[camera_ID] = _Scratch()
+        return scratch
+
     def _call_function(self, function_name, camera_ID, *args):
         """ Utility function for calling the SDK functions that return ErrorCode """
-        function = getattr(self._CDLL, function_name)
-        error_code = function(ctypes.c_int(camera_ID), *args)
-        if error_code != ErrorCode.SUCCESS:
+        try:
+            function = self._functions[function_name]
+        except KeyError:
+            raise error.NotSupported("SDK library has no function {}".format(function_name))
+        error_code = function(camera_ID, *args)
+        if error_code != SUCCESS:
             msg = "Error calling {}: {}".format(function_name, ErrorCode(error_code).name)
-            self.logger.error(msg)
-            raise RuntimeError(msg)
+            if error_code == ErrorCode.TIMEOUT:
+                # Timeouts are an expected outcome of bounded waits
+                self.logger.debug(msg)
+            else:
+                self.logger.error(msg)
+            raise ASIError(msg, error_code)
 
     def _parse_info(self, camera_info):
         """ Utility function to parse CameraInfo Structures into something more Pythonic """
@@ -554,10 +824,10 @@ class ASIDriver(AbstractSDKDriver):
         return tuple(formats)
 
     def _parse_caps(self, control_caps):
-        """ Utility function to parse ControlCaps Structures into something more Pythonic """
+        """ Utility function to parse ControlCapsEntry tuples into something more Pythonic """
         control_type = ControlType(control_caps.control_type).name
-        control_info = {'name': control_caps.name.decode(),
-                        'description': control_caps.description.decode(),
+        control_info = {'name': control_caps.name,
+                        'description': control_caps.description,
                         'max_value': self._parse_return_value(control_caps.max_value,
                                                               control_type),
                         'min_value': self._parse_return_value(control_caps.min_value,
@@ -589,28 +859,182 @@ class ASIDriver(AbstractSDKDriver):
         return nice_value
 
     def _parse_input_value(self, value, control_type):
-        """ Helper function to convert input values to appropriate ctypes.c_long """
+        """ Helper function to convert input values to the raw int values used by the SDK """
 
         if control_type in units_and_scale:
             value = get_quantity_value(value, unit=units_and_scale[control_type])
         elif control_type == 'FLIP':
             value = FlipStatus[value]
 
-        return ctypes.c_long(int(value))
+        return int(value)
 
-    def _image_array(self, width, height, image_type):
-        """ Creates a suitable numpy array for storing image data """
-        width = int(get_quantity_value(width, unit=u.pixel))
-        height = int(get_quantity_value(height, unit=u.pixel))
+    def _frame_buffer(self, width, height, image_type, out=None):
+        """ Check the given output array, or get one from the frame pool if not given """
+        if out is None:
+            return self.frame_pool.acquire(width, height, image_type), True
+
+        shape, dtype = image_layout(width, height, image_type)
+        if out.shape != shape or out.dtype != dtype or not out.flags.c_contiguous:
+            raise ValueError("Output array must be C contiguous {} with shape {}, got {} {}".format(
+                np.dtype(dtype).name, shape, out.dtype.name, out.shape))
+        return out, False
+
+
+class _Scratch(object):
+    """ ctypes output arguments, and their addresses, reused by the frequent SDK calls """
+    __slots__ = ('int', 'long', 'bool', 'int_ref', 'long_ref', 'bool_ref')
+
+    def __init__(self):
+        self.int = ctypes.c_int()
+        self.long = ctypes.c_long()
+        self.bool = ctypes.c_int()
+        self.int_ref = ctypes.addressof(self.int)
+        self.long_ref = ctypes.addressof(self.long)
+        self.bool_ref = ctypes.addressof(self.bool)
+
+
+class ASIError(RuntimeError):
+    """ Error returned by an ASI SDK function, with the SDK error code """
+
+    def __init__(self, msg, error_code):
+        super().__init__(msg)
+        self.error_code = ErrorCode(error_code)
+
+
+class TimeoutPolicy(object):
+    """Retry and backoff policy for bounded video frame waits.
 
-        if image_type in ('RAW8', 'Y8'):
-            image_array = np.zeros((height, width), dtype=np.uint8, order='C')
-        elif image_type == 'RAW16':
-            image_array = np.zeros((height, width), dtype=np.uint16, order='C')
-        elif image_type == 'RGB24':
-            image_array = np.zeros((3, height, width), dtype=np.uint8, order='C')
+    After a timed out wait, the wait is retried up to max_retries times, with the timeout
+    multiplied by backoff on each retry (capped at max_timeout). The counters accumulate over
+    all the waits using the policy, so use one policy per camera.
+    """
 
-        return image_array
+    def __init__(self, max_retries=3, backoff=2.0, max_timeout=10000):
+        """
+        Args:
+            max_retries (int): number of retries after the first timed out wait.
+            backoff (float): timeout multiplier applied on each retry.
+            max_timeout (float): upper limit of the backed off timeout in ms.
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_timeout = max_timeout
+        self.n_timeouts = 0  # timed out waits
+        self.n_retries = 0  # waits repeated after a timeout
+        self.n_exhausted = 0  # frames given up on after all retries timed out
+
+    @property
+    def stats(self):
+        """Dictionary of the policy counters """
+        return {'timeouts': self.n_timeouts,
+                'retries': self.n_retries,
+                'exhausted': self.n_exhausted}
+
+    def timeouts(self, timeout):
+        """Successive wait timeouts in ms, starting with timeout """
+        for _ in range(self.max_retries + 1):
+            yield int(timeout)
+            timeout = min(timeout * self.backoff, self.max_timeout)
+
+
+def image_layout(width, height, image_type):
+    """Get the numpy array shape and dtype for image data of given size and type.
+
+    Args:
+        width (int or astropy.units.Quantity): image width
+        height (int or astropy.units.Quantity): image height
+        image_type (str): image type name, one of 'RAW8', 'Y8', 'RAW16', 'RGB24'
+
+    Returns:
+        (tuple, numpy.dtype): array shape and dtype
+    """
+    width = int(get_quantity_value(width, unit=u.pixel))
+    height = int(get_quantity_value(height, unit=u.pixel))
+
+    if image_type in ('RAW8', 'Y8'):
+        return (height, width), np.dtype(np.uint8)
+    elif image_type == 'RAW16':
+        return (height, width), np.dtype(np.uint16)
+    elif image_type == 'RGB24':
+        return (3, height, width), np.dtype(np.uint8)
+    raise ValueError("Unsupported image type {}".format(image_type))
+
+
+class FramePool(object):
+    """Pool of reusable frame buffers.
+
+    Allocating (and zero filling) a new array for every video frame costs as much memory
+    bandwidth as the frame itself, e.g. ~33 MB for a full frame RAW16 ASI183 image. The pool
+    keeps released buffers, keyed by (width, height, image_type), and hands them out again.
+    At most max_buffers free buffers of each key are kept, extra released buffers are left to
+    the garbage collector.
+
+    The allocation and reuse counters can be used to check that a capture loop reaches a
+    steady state with no allocations. The pool is thread safe.
+    """
+
+    def __init__(self, max_buffers=8):
+        self.max_buffers = max_buffers
+        self.n_allocated = 0
+        self.n_reused = 0
+        self.n_released = 0
+        self.n_discarded = 0
+        self._free = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    @property
+    def n_free(self):
+        """Number of buffers currently available for reuse """
+        with self._lock:
+            return sum(len(buffers) for buffers in self._free.values())
+
+    @property
+    def stats(self):
+        """Dictionary of the pool counters """
+        return {'allocated': self.n_allocated,
+                'reused': self.n_reused,
+                'released': self.n_released,
+                'discarded': self.n_discarded,
+                'free': self.n_free}
+
+    def acquire(self, width, height, image_type):
+        """Get a buffer for image data of given size and type, reusing a free one if available.
+
+        The contents of the returned array are undefined.
+        """
+        shape, dtype = image_layout(width, height, image_type)
+        key = self._key(shape, dtype)
+        with self._lock:
+            buffers = self._free.get(key)
+            if buffers:
+                self.n_reused += 1
+                return buffers.pop()
+            self.n_allocated += 1
+        return np.empty(shape, dtype=dtype, order='C')
+
+    def release(self, frame):
+        """Return a buffer to the pool """
+        if frame is None:
+            return
+        key = self._key(frame.shape, frame.dtype)
+        with self._lock:
+            self.n_released += 1
+            buffers = self._free[key]
+            if len(buffers) < self.max_buffers:
+                buffers.append(frame)
+            else:
+                self.n_discarded += 1
+
+    def clear(self):
+        """Drop all free buffers """
+        with self._lock:
+            self._free.clear()
+
+    def _key(self, shape, dtype):
+        # (width, height, image_type), with Y8 sharing the RAW8 buffers as the layout is the same
+        if len(shape) == 3:
+            return shape[2], shape[1], 'RGB24'
+        return shape[1], shape[0], 'RAW16' if dtype == np.uint16 else 'RAW8'
 
 
 units_and_scale = {'AUTO_TARGET_BRIGHTNESS': u.adu,
@@ -781,6 +1205,11 @@ class ControlType(enum.IntEnum):
     AUTO_MAX_BRIGHTNESS = AUTO_TARGET_BRIGHTNESS
 
 
+# Plain int versions of the enums used on every frame, ctypes converts these faster
+control_type_codes = {name: int(value) for name, value in ControlType.__members__.items()}
+SUCCESS = int(ErrorCode.SUCCESS)
+
+
 class ControlCaps(ctypes.Structure):
     """ Structure for caps (limits) on allowable parameter values for each camera control """
     _fields_ = [('name', ctypes.c_char * 64),  # The name of the control, .e.g. Exposure, Gain
@@ -794,6 +1223,17 @@ class ControlCaps(ctypes.Structure):
                 ('unused', ctypes.c_char * 32)]
 
 
+# Control capabilities kept by ASIDriver, with the raw SDK values
+ControlCapsEntry = collections.namedtuple('ControlCapsEntry', ['name',
+                                                               'description',
+                                                               'max_value',
+                                                               'min_value',
+                                                               'default_value',
+                                                               'is_auto_supported',
+                                                               'is_writable',
+                                                               'control_type'])
+
+
 class ExposureStatus(enum.IntEnum):
     """ Exposure status codes """
     IDLE = 0
@@ -809,3 +1249,58 @@ class ID(ctypes.Structure):
 class SupportedMode(ctypes.Structure):
     """ Array of supported CameraModes, terminated with CameraMode.END """
     _fields_ = [('modes', ctypes.c_int * 16)]
+
+
+# Prototypes of the ASICamera2.h functions, {name: (restype, argtypes)}. Enum arguments are
+# C ints, ASI_BOOL is an int and image buffers are passed as addresses. int and long output
+# arguments are declared as void pointers, which ctypes converts ~2x faster than typed
+# pointers, and which take both byref() objects and the plain addresses kept in _Scratch.
+_int_p = ctypes.c_void_p
+_long_p = ctypes.c_void_p
+
+function_prototypes = {
+    'ASIGetNumOfConnectedCameras': (ctypes.c_int, []),
+    'ASIGetProductIDs': (ctypes.c_int, [_int_p]),
+    'ASIGetSDKVersion': (ctypes.c_char_p, []),
+    'ASIGetCameraProperty': (ctypes.c_int, [ctypes.POINTER(CameraInfo), ctypes.c_int]),
+    'ASIGetCameraPropertyByID': (ctypes.c_int, [ctypes.c_int, ctypes.POINTER(CameraInfo)]),
+    'ASIOpenCamera': (ctypes.c_int, [ctypes.c_int]),
+    'ASIInitCamera': (ctypes.c_int, [ctypes.c_int]),
+    'ASICloseCamera': (ctypes.c_int, [ctypes.c_int]),
+    'ASIGetNumOfControls': (ctypes.c_int, [ctypes.c_int, _int_p]),
+    'ASIGetControlCaps': (ctypes.c_int, [ctypes.c_int, ctypes.c_int,
+                                         ctypes.POINTER(ControlCaps)]),
+    'ASIGetControlValue': (ctypes.c_int, [ctypes.c_int, ctypes.c_int, _long_p, _int_p]),
+    'ASISetControlValue': (ctypes.c_int, [ctypes.c_int, ctypes.c_int, ctypes.c_long,
+                                          ctypes.c_int]),
+    'ASISetROIFormat': (ctypes.c_int, [ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                       ctypes.c_int]),
+    'ASIGetROIFormat': (ctypes.c_int, [ctypes.c_int, _int_p, _int_p, _int_p, _int_p]),
+    'ASISetStartPos': (ctypes.c_int, [ctypes.c_int, ctypes.c_int, ctypes.c_int]),
+    'ASIGetStartPos': (ctypes.c_int, [ctypes.c_int, _int_p, _int_p]),
+    'ASIGetDroppedFrames': (ctypes.c_int, [ctypes.c_int, _int_p]),
+    'ASIEnableDarkSubtract': (ctypes.c_int, [ctypes.c_int, ctypes.c_char_p]),
+    'ASIDisableDarkSubtract': (ctypes.c_int, [ctypes.c_int]),
+    'ASIStartVideoCapture': (ctypes.c_int, [ctypes.c_int]),
+    'ASIStopVideoCapture': (ctypes.c_int, [ctypes.c_int]),
+    'ASIGetVideoData': (ctypes.c_int, [ctypes.c_int, ctypes.c_void_p, ctypes.c_long,
+                                       ctypes.c_int]),
+    'ASIPulseGuideOn': (ctypes.c_int, [ctypes.c_int, ctypes.c_int]),
+    'ASIPulseGuideOff': (ctypes.c_int, [ctypes.c_int, ctypes.c_int]),
+    'ASIStartExposure': (ctypes.c_int, [ctypes.c_int, ctypes.c_int]),
+    'ASIStopExposure': (ctypes.c_int, [ctypes.c_int]),
+    'ASIGetExpStatus': (ctypes.c_int, [ctypes.c_int, _int_p]),
+    'ASIGetDataAfterExp': (ctypes.c_int, [ctypes.c_int, ctypes.c_void_p, ctypes.c_long]),
+    'ASIGetID': (ctypes.c_int, [ctypes.c_int, ctypes.POINTER(ID)]),
+    'ASISetID': (ctypes.c_int, [ctypes.c_int, ID]),
+    'ASIGetGainOffset': (ctypes.c_int, [ctypes.c_int, _int_p, _int_p, _int_p, _int_p]),
+    'ASIGetCameraSupportMode': (ctypes.c_int, [ctypes.c_int, ctypes.POINTER(SupportedMode)]),
+    'ASIGetCameraMode': (ctypes.c_int, [ctypes.c_int, _int_p]),
+    'ASISetCameraMode': (ctypes.c_int, [ctypes.c_int, ctypes.c_int]),
+    'ASISendSoftTrigger': (ctypes.c_int, [ctypes.c_int, ctypes.c_int]),
+    'ASIGetSerialNumber': (ctypes.c_int, [ctypes.c_int, ctypes.POINTER(ID)]),
+    'ASISetTriggerOutputIOConf': (ctypes.c_int, [ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                                 ctypes.c_long, ctypes.c_long]),
+    'ASIGetTriggerOutputIOConf': (ctypes.c_int, [ctypes.c_int, ctypes.c_int, _int_p, _long_p,
+                                                 _long_p]),
+}
@@ -0,0 +1,311 @@
+import bisect
+import http.server
+import logging
+import os
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in seconds, 50 us to 13 s in factors of 2
+LATENCY_BUCKETS = tuple(50e-6 * 2 ** index for index in range(19))
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    """Counts of observed values in fixed buckets, like a Prometheus histogram.
+
+    Recording a value is a bisect and two additions, cheap enough for every frame of every
+    stage. A histogram is meant to be updated by one thread, other threads only read it, so
+    there is no lock; a reader may see a count one observation ahead of the sum.
+
+    Example:
+        histogram = Histogram()
+        with histogram.time():
+            fitsio.write(path, data, header=header)
+        print(histogram.quantile(0.99))
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            buckets (sequence of float): increasing upper bounds of the buckets, the last
+                bucket without upper bound is added.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Add a value, in seconds for latencies """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self):
+        """Context manager observing the time spent in its block """
+        return _Timer(self)
+
+    def cumulative_counts(self):
+        """Number of values up to each bucket bound, the last one is the total count """
+        total = 0
+        cumulative = []
+        for count in list(self.counts):
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+    def quantile(self, q):
+        """Estimate of the q quantile, interpolated within its bucket like Prometheus does.
+
+        Returns:
+            float or None: the estimate, the largest bucket bound if it is in the last bucket,
+                None if there are no values.
+        """
+        cumulative = self.cumulative_counts()
+        if not cumulative[-1]:
+            return None
+        rank = q * cumulative[-1]
+        index = bisect.bisect_left(cumulative, rank)
+        if index == len(self.buckets):
+            return self.buckets[-1]
+        lower = self.buckets[index - 1] if index > 0 else 0.0
+        below = cumulative[index - 1] if index > 0 else 0
+        in_bucket = cumulative[index] - below
+        if in_bucket == 0:
+            return self.buckets[index]
+        return lower + (self.buckets[index] - lower) * (rank - below) / in_bucket
+
+
+class Metrics(object):
+    """Registry of the histograms and sampled values of a run, rendered in the Prometheus text
+    format.
+
+    Histograms are updated by the code being measured. Sampled values (queue depths, dropped
+    frame counters, ...) are functions called when the metrics are rendered, so they cost
+    nothing in the capture loop. Metrics with the same name and different labels, e.g. one
+    per stage and camera, are rendered as one metric family.
+
+    Example:
+        metrics = Metrics()
+        write_time = metrics.histogram('stage_seconds', 'Time per frame in a stage', stage='write')
+        metrics.sample('ring_depth', 'Frames waiting in the ring buffer', lambda: stream.depth)
+        text = metrics.render()
+    """
+
+    def __init__(self, prefix='pp', logger=None):
+        """
+        Args:
+            prefix (str): prefix of the metric names.
+            logger (logging.Logger, optional): logger of the sampling errors.
+        """
+        self.prefix = prefix
+        self.logger = logger or logging.getLogger(__name__)
+        # name: (type, help, list of (labels, histogram or function))
+        self._families = {}
+        self._lock = threading.Lock()
+
+    @property
+    def histograms(self):
+        """List of the (name, labels, histogram) of all the histograms """
+        with self._lock:
+            return [(name, labels, histogram)
+                    for name, (metric_type, _, members) in self._families.items()
+                    if metric_type == 'histogram'
+                    for labels, histogram in members]
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, **labels):
+        """Register a new histogram.
+
+        Returns:
+            Histogram: the histogram to update.
+        """
+        histogram = Histogram(buckets)
+        self._add(name, 'histogram', help_text, labels, histogram)
+        return histogram
+
+    def sample(self, name, help_text, function, metric_type='gauge', **labels):
+        """Register a value sampled by calling function when the metrics are rendered.
+
+        Args:
+            name (str): metric name, without the prefix.
+            help_text (str): description of the metric.
+            function (callable): returns the current value, or None if there is none.
+            metric_type (str): 'gauge', or 'counter' for values that only go up.
+            labels: label names and values of this metric.
+        """
+        self._add(name, metric_type, help_text, labels, function)
+
+    def render(self):
+        """Get all the metrics in the Prometheus text exposition format """
+        with self._lock:
+            families = [(name, metric_type, help_text, list(members))
+                        for name, (metric_type, help_text, members) in self._families.items()]
+        lines = []
+        for name, metric_type, help_text, members in families:
+            full_name = f'{self.prefix}_{name}' if self.prefix else name
+            lines.append(f'# HELP {full_name} {help_text}')
+            lines.append(f'# TYPE {full_name} {metric_type}')
+            for labels, member in members:
+                if metric_type == 'histogram':
+                    lines.extend(_histogram_lines(full_name, labels, member))
+                    continue
+                try:
+                    value = member()
+                except Exception as err:
+                    self.logger.debug(f'Sampling {full_name} {labels} failed: {err}')
+                    continue
+                if value is not None:
+                    lines.append(f'{full_name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    # Private methods
+
+    def _add(self, name, metric_type, help_text, labels, member):
+        with self._lock:
+            family = self._families.setdefault(name, (metric_type, help_text, []))
+            if family[0] != metric_type:
+                raise ValueError(f'Metric {name} is a {family[0]}, not a {metric_type}')
+            family[2].append((labels, member))
+
+
+class MetricsExporter(object):
+    """Publishes the metrics of a run while it is going on.
+
+    A background thread renders the metrics every interval seconds and writes them atomically
+    to path, e.g. into the textfile collector folder of the Prometheus node exporter, and/or
+    keeps them for a local HTTP endpoint on port, for Prometheus to scrape or to look at with
+    curl http://localhost:<port>/metrics during a long capture.
+
+    Example:
+        with MetricsExporter(metrics, path='/var/lib/node_exporter/pp_test.prom', port=9101):
+            ... capture ...
+    """
+
+    def __init__(self, metrics, path=None, port=None, host='127.0.0.1', interval=5.0):
+        """
+        Args:
+            metrics (Metrics): the metrics to publish.
+            path (str, optional): file the metrics are written to.
+            port (int, optional): port of the HTTP endpoint, 0 for any free port.
+            host (str): address the HTTP endpoint listens on, local only by default.
+            interval (float): seconds between refreshes of the metrics.
+        """
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.n_refreshes = 0
+        self._text = metrics.render()
+        self._stopping = threading.Event()
+        self._server = None
+        if port is not None:
+            self._server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+            self._server.daemon_threads = True
+            # the handlers serve the text of the last refresh
+            self._server.exporter = self
+            threading.Thread(target=self._server.serve_forever, name='MetricsHTTP',
+                             daemon=True).start()
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name='MetricsExporter', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def port(self):
+        """Port of the HTTP endpoint, or None """
+        return self._server.server_address[1] if self._server is not None else None
+
+    def refresh(self):
+        """Render the metrics, and write them to the file """
+        self._text = self.metrics.render()
+        if self.path is not None:
+            partial = f'{self.path}.{os.getpid()}.tmp'
+            with open(partial, 'w') as file:
+                file.write(self._text)
+            os.replace(partial, self.path)
+        self.n_refreshes += 1
+
+    def close(self):
+        """Publish the final metrics and stop the thread and the HTTP endpoint """
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._thread.join()
+        self.refresh()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    # Private methods
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.refresh()
+            except OSError as err:
+                self.metrics.logger.warning(f'Writing the metrics to {self.path} failed: {err}')
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.exporter._text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # no line on stderr for every scrape
+        pass
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'start_time')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start_time)
+
+
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _histogram_lines(name, labels, histogram):
+    cumulative = histogram.cumulative_counts()
+    lines = [f'{name}_bucket{_format_labels(labels, le=repr(bound))} {count}'
+             for bound, count in zip(histogram.buckets, cumulative)]
+    lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {cumulative[-1]}')
+    lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum!r}')
+    lines.append(f'{name}_count{_format_labels(labels)} {cumulative[-1]}')
+    return lines
@@ -0,0 +1,290 @@
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+
+from panoptes.utils import error
+
+# Journal of the staged files, in the staging folder
+JOURNAL_NAME = '.migrator.journal'
+
+# Copy buffer size of a migration thread
+CHUNK_SIZE = 1 << 20
+
+
+class Migrator(object):
+    """Moves completed files from a fast local staging folder to the output folder.
+
+    Writing frames straight to the NFS mounted storage slows the capture down to the NFS
+    throughput and latency. With a migrator the frames are written to a local (NVMe) staging
+    folder at capture speed, and n_workers background threads move each completed file to
+    the output folder:
+        - copy it to <name>.part in the output folder, computing its SHA-256,
+        - fsync it, drop it from the page cache and read it back to verify the checksum,
+        - rename it to its final name, fsync the output folder so the rename is on the
+          storage, and remove the staged file.
+    A failed migration is retried up to retries times, then the file stays in the staging
+    folder.
+
+    The files handed over with submit() are recorded in a journal in the staging folder, as
+    well as the completed migrations. A new migrator on the same staging folder resumes the
+    migration of the files of an interrupted run. Files of the staging folder which were never
+    submitted, e.g. the file being written when the capture crashed, are left alone.
+
+    The staging disk must not fill up: wait_for_space() blocks the capture while the staging
+    file system is more than high_water full, until the migration frees enough space.
+
+    Example:
+        with Migrator('/mnt/fast/staging', '/var/huntsman/images/demo') as migrator:
+            migrator.wait_for_space()
+            fitsio.write(path_in_staging_folder, data, header=header)
+            migrator.submit(path_in_staging_folder)
+    """
+
+    def __init__(self, staging_folder, output_folder, n_workers=2, high_water=0.9, retries=3,
+                 logger=None):
+        """
+        Args:
+            staging_folder (str): local folder the files are written to, created if needed.
+            output_folder (str): final folder of the files.
+            n_workers (int): number of migration threads, the maximum concurrent copies.
+            high_water (float): maximum used fraction of the staging file system.
+            retries (int): attempts of a file migration before it is given up.
+            logger (logging.Logger, optional): logger of the migration errors.
+        """
+        if n_workers < 1:
+            raise ValueError('Migrator needs at least 1 worker')
+        if os.path.realpath(staging_folder) == os.path.realpath(output_folder):
+            raise ValueError(f'The staging folder is the output folder {output_folder}')
+        os.makedirs(staging_folder, exist_ok=True)
+
+        self.staging_folder = staging_folder
+        self.output_folder = output_folder
+        self.n_workers = n_workers
+        self.high_water = high_water
+        self.retries = retries
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.n_submitted = 0
+        self.n_migrated = 0
+        self.n_failed = 0
+        self.n_retries = 0
+        self.bytes_migrated = 0
+        self.busy_time = 0.0
+        self.n_blocked = 0
+        self.blocked_time = 0.0
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._journal_lock = threading.Lock()
+        self._queue = queue.Queue()
+
+        # files of an interrupted run, then a compacted journal with just those
+        resumed = self._read_journal()
+        self._journal = open(os.path.join(staging_folder, JOURNAL_NAME), 'w')
+        for name in resumed:
+            self._write_journal('ready', name)
+            self._enqueue(name)
+        self.n_resumed = len(resumed)
+
+        self._workers = [threading.Thread(target=self._migrate_worker, name=f'Migrator-{index}',
+                                          daemon=True)
+                         for index in range(n_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def pending(self):
+        """Number of files waiting for or being migrated """
+        with self._cond:
+            return self._pending
+
+    @property
+    def staging_usage(self):
+        """Used fraction of the staging file system """
+        stat = os.statvfs(self.staging_folder)
+        return 1 - stat.f_bavail / stat.f_blocks
+
+    @property
+    def stats(self):
+        """Dictionary of the migration counters """
+        return {'submitted': self.n_submitted,
+                'resumed': self.n_resumed,
+                'migrated': self.n_migrated,
+                'failed': self.n_failed,
+                'retries': self.n_retries,
+                'pending': self.pending,
+                'MB': self.bytes_migrated / 1e6,
+                'MBps': self.bytes_migrated / self.busy_time / 1e6 if self.busy_time > 0 else 0.0,
+                'blocked': self.n_blocked,
+                'blocked_time': self.blocked_time}
+
+    def submit(self, path):
+        """Queue a completely written file of the staging folder for migration """
+        name = os.path.relpath(path, self.staging_folder)
+        if name.startswith(os.pardir):
+            raise ValueError(f'{path} is not in the staging folder {self.staging_folder}')
+        self._write_journal('ready', name)
+        self.n_submitted += 1
+        self._enqueue(name)
+
+    def wait_for_space(self, timeout=None):
+        """Block while the staging file system is above the high water mark.
+
+        Raises:
+            panoptes.utils.error.Timeout: if there is no space after timeout seconds.
+            panoptes.utils.error.PanError: if the staging file system is full with other files.
+        """
+        if self.staging_usage <= self.high_water:
+            return
+        start_time = time.perf_counter()
+        self.n_blocked += 1
+        self.logger.warning(f'Staging folder {self.staging_folder} above {self.high_water:.0%}, '
+                            f'waiting for the migration of {self.pending} files')
+        try:
+            with self._cond:
+                while self.staging_usage > self.high_water:
+                    if self._pending == 0:
+                        raise error.PanError(f'Staging folder {self.staging_folder} is above '
+                                             f'{self.high_water:.0%} with no files to migrate')
+                    wait = 0.5
+                    if timeout is not None:
+                        wait = min(wait, timeout - (time.perf_counter() - start_time))
+                        if wait <= 0:
+                            raise error.Timeout(f'No space in staging folder {self.staging_folder} '
+                                                f'after {timeout} s')
+                    self._cond.wait(wait)
+        finally:
+            self.blocked_time += time.perf_counter() - start_time
+
+    def flush(self, timeout=None):
+        """Wait until all the submitted files are migrated or failed.
+
+        Raises:
+            panoptes.utils.error.Timeout: if files are still pending after timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending:
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    raise error.Timeout(f'{self._pending} files still to migrate after {timeout} s')
+                self._cond.wait(wait)
+
+    def close(self, timeout=None):
+        """Wait for the pending migrations and stop the threads """
+        if self._journal.closed:
+            return
+        try:
+            self.flush(timeout)
+        finally:
+            for _ in self._workers:
+                self._queue.put(None)
+            for worker in self._workers:
+                worker.join()
+            with self._journal_lock:
+                self._journal.close()
+
+    # Private methods
+
+    def _read_journal(self):
+        path = os.path.join(self.staging_folder, JOURNAL_NAME)
+        if not os.path.exists(path):
+            return []
+        ready = {}
+        with open(path) as journal:
+            for line in journal:
+                state, _, name = line.rstrip('\n').partition(' ')
+                if state == 'ready':
+                    ready[name] = True
+                elif state == 'done':
+                    ready.pop(name, None)
+        return [name for name in ready
+                if os.path.exists(os.path.join(self.staging_folder, name))]
+
+    def _write_journal(self, state, name):
+        with self._journal_lock:
+            self._journal.write(f'{state} {name}\n')
+            self._journal.flush()
+
+    def _enqueue(self, name):
+        with self._cond:
+            self._pending += 1
+        self._queue.put(name)
+
+    def _migrate_worker(self):
+        buffer = bytearray(CHUNK_SIZE)
+        while True:
+            name = self._queue.get()
+            if name is None:
+                break
+            for attempt in range(self.retries):
+                start_time = time.perf_counter()
+                try:
+                    size = self._migrate(name, buffer)
+                except OSError as err:
+                    self.logger.warning(f'Migrating {name} failed (attempt {attempt + 1}): {err}')
+                    self.n_retries += 1
+                else:
+                    self.busy_time += time.perf_counter() - start_time
+                    self.bytes_migrated += size
+                    self.n_migrated += 1
+                    break
+            else:
+                self.n_failed += 1
+                self.logger.error(f'Giving up migrating {name}, it stays in {self.staging_folder}')
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify_all()
+
+    def _migrate(self, name, buffer):
+        source = os.path.join(self.staging_folder, name)
+        destination = os.path.join(self.output_folder, name)
+        partial = destination + '.part'
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        view = memoryview(buffer)
+        checksum = hashlib.sha256()
+        size = 0
+        with open(source, 'rb', buffering=0) as source_file, \
+                open(partial, 'wb', buffering=0) as partial_file:
+            while True:
+                n_bytes = source_file.readinto(buffer)
+                if not n_bytes:
+                    break
+                checksum.update(view[:n_bytes])
+                partial_file.write(view[:n_bytes])
+                size += n_bytes
+            os.fsync(partial_file.fileno())
+
+        # read back what reached the storage, not the page cache
+        written = hashlib.sha256()
+        with open(partial, 'rb', buffering=0) as partial_file:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(partial_file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            while True:
+                n_bytes = partial_file.readinto(buffer)
+                if not n_bytes:
+                    break
+                written.update(view[:n_bytes])
+        if written.digest() != checksum.digest():
+            os.remove(partial)
+            raise OSError(f'checksum mismatch of {destination}')
+
+        os.replace(partial, destination)
+        # the renamed entry must be on the storage before the staged copy is removed
+        folder = os.open(os.path.dirname(destination), os.O_RDONLY)
+        try:
+            os.fsync(folder)
+        finally:
+            os.close(folder)
+        os.remove(source)
+        self._write_journal('done', name)
+        return size
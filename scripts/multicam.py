@@ -0,0 +1,147 @@
+import threading
+import time
+
+
+class CameraRecorder(object):
+    """Records a number of frames from one camera.
+
+    The frames come from a VideoStream, which has its own acquisition thread, and are written
+    by a writer thread of the recorder, so a camera neither waits on the writes of its own
+    frames nor on any other camera.
+    """
+
+    def __init__(self, name, stream, write_frame, num_frames, logger):
+        """
+        Args:
+            name (str): name of the camera, for the reports.
+            stream (VideoStream): not started video stream of the camera.
+            write_frame (callable): function writing a videostream.Frame, called in the
+                writer thread.
+            num_frames (int): number of frames to record.
+            logger: logger to report errors.
+        """
+        self.name = name
+        self.stream = stream
+        self.write_frame = write_frame
+        self.num_frames = num_frames
+        self.logger = logger
+
+        self.n_written = 0
+        self.n_write_errors = 0
+        self.n_sdk_dropped = 0
+        self.start_time = None
+        self.end_time = None
+        self._thread = None
+
+    @property
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def elapsed_time(self):
+        if self.start_time is None:
+            return 0.0
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        return end_time - self.start_time
+
+    @property
+    def fps(self):
+        elapsed_time = self.elapsed_time
+        return self.n_written / elapsed_time if elapsed_time > 0 else 0.0
+
+    @property
+    def stats(self):
+        """Dictionary of the recording counters """
+        if self.is_alive:
+            self._update_sdk_dropped()
+        return {'name': self.name,
+                'written': self.n_written,
+                'write_errors': self.n_write_errors,
+                'fps': self.fps,
+                'sdk_dropped': self.n_sdk_dropped,
+                'ring_dropped': self.stream.n_dropped_oldest + self.stream.n_dropped_newest,
+                **self.stream.stats}
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.stream.start()
+        self._thread = threading.Thread(target=self._record, name=f'Writer-{self.name}',
+                                        daemon=True)
+        self._thread.start()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    # Private methods
+
+    def _update_sdk_dropped(self):
+        try:
+            self.n_sdk_dropped = self.stream.driver.get_dropped_frames(self.stream.camera_ID)
+        except RuntimeError as err:
+            self.logger.warning(f'Cannot get dropped frames of {self.name}: {err}')
+
+    def _record(self):
+        try:
+            for frame in self.stream:
+                try:
+                    self.write_frame(frame)
+                except Exception as err:
+                    self.n_write_errors += 1
+                    self.logger.error(f'Writing frame {frame.sequence} of {self.name} failed: {err}')
+                else:
+                    self.n_written += 1
+                finally:
+                    self.stream.release(frame)
+                if self.n_written + self.n_write_errors >= self.num_frames:
+                    break
+        finally:
+            self.end_time = time.perf_counter()
+            self._update_sdk_dropped()
+            self.stream.stop()
+            self.stream.clear()
+
+
+class MultiCameraCapture(object):
+    """Concurrent recording from several cameras with progress and throughput reports """
+
+    def __init__(self, recorders, logger, report_interval=5.0):
+        """
+        Args:
+            recorders (list of CameraRecorder): one recorder per camera.
+            logger: logger for the reports.
+            report_interval (float): seconds between progress reports while recording.
+        """
+        self.recorders = recorders
+        self.logger = logger
+        self.report_interval = report_interval
+
+    def run(self):
+        """Record from all the cameras until each has its frames, returns the final stats """
+        for recorder in self.recorders:
+            recorder.start()
+
+        while any(recorder.is_alive for recorder in self.recorders):
+            deadline = time.monotonic() + self.report_interval
+            for recorder in self.recorders:
+                recorder.join(max(0.0, deadline - time.monotonic()))
+            if any(recorder.is_alive for recorder in self.recorders):
+                self.report()
+
+        return self.report()
+
+    def report(self):
+        """Log per camera and aggregate FPS and dropped frames, returns the stats """
+        stats = [recorder.stats for recorder in self.recorders]
+        for camera_stats in stats:
+            self.logger.info('{name}: {written} frames, {fps:.2f} FPS, dropped by camera: '
+                             '{sdk_dropped}, by ring buffer: {ring_dropped}, timeouts: {timeouts}'
+                             .format(**camera_stats))
+        total = {'written': sum(camera_stats['written'] for camera_stats in stats),
+                 'fps': sum(camera_stats['fps'] for camera_stats in stats),
+                 'sdk_dropped': sum(camera_stats['sdk_dropped'] for camera_stats in stats),
+                 'ring_dropped': sum(camera_stats['ring_dropped'] for camera_stats in stats)}
+        self.logger.info('All {} cameras: {written} frames, {fps:.2f} FPS, dropped by cameras: '
+                         '{sdk_dropped}, by ring buffers: {ring_dropped}'
+                         .format(len(stats), **total))
+        return {'cameras': stats, 'total': total}
@@ -1,14 +1,14 @@
-from typing import Final
+from typing import Final, Optional
 from astropy import units as u
-# import numpy as np
+import numpy as np
 import time
-from datetime import datetime, timezone, timedelta
-import multiprocessing
 import argparse
 import yaml
 import logging
 import os
 import resource
+import signal
+from dataclasses import dataclass
 
 # fitsio (wrapper for NASA cfitsio) provides way better performance
 # for FITS compression
@@ -17,10 +17,29 @@ import fitsio
 # ### locally modified copy of panoptes fits_utils with compression added
 # import fits as fits_utils
 
+from panoptes.utils import error
 from panoptes.utils.utils import get_quantity_value
 
 # local mended lib
-from libasi import ASIDriver
+from libasi import ASIDriver, TimeoutPolicy, image_layout
+from videostream import VideoStream, OVERFLOW_POLICIES
+from multicam import CameraRecorder, MultiCameraCapture
+from writerpool import WriterPool
+from cubewriter import CubeWriter, CUBE_MODES
+from spool import SpoolWriter
+from fitstemplate import FRAME_KEYS, FitsTemplate, write_file
+from tilecompress import TileCompressor, is_supported
+from autocompress import AdaptiveWriter, ADAPTIVE
+from bitpack import FramePacker, packed_dtype, packing_keys, packing_shift
+from migrator import JOURNAL_NAME, Migrator
+from metrics import Metrics, MetricsExporter
+from frameclock import FrameClock
+from exposure import AE_POLICIES, ExposureController, ExposureSchedule
+from coadd import FrameStacker, STACK_DTYPES
+from lucky import FrameSelector, REGION_SIZE, SHARPNESS_METRICS
+from events import EventCapture, TriggerSocket, EVENT_MODES
+from transients import TransientDetector
+from telemetry import TelemetrySampler
 # from panoptes.pocs.camera.libasi import ASIDriver
 # from panoptes.pocs.camera.zwo import Camera as ZWOCam
 
@@ -29,7 +48,10 @@ JETSON009_ASI178_SN: Final[str] = '0e2c420013090900'
 # Other Huntsman camera serial numbers are in
 # repo huntsman-config$ /conf_files/pocs/huntsman.yaml
 
-MAX_PROCESSES: Final[int] = 500
+# Stages of a frame in the capture loop, each with a latency histogram
+CAPTURE_STAGES = ('sdk_wait', 'queue_wait', 'telemetry', 'header', 'exposure', 'transient',
+                  'event', 'lucky', 'coadd', 'compress', 'write')
+
 
 def setup_logger(debug=False):
     level = logging.DEBUG if debug else logging.INFO
@@ -42,13 +64,174 @@ def parse_args():
     parser.add_argument('-c', '--config', type=str, required=True, help='Path to the YAML configuration file')
     parser.add_argument('-d', '--debug', action='store_true', help='Enable debug logging')
     parser.add_argument('-p', '--parallel_write', action='store_true', help='Write files in parallel with multiprocessing')
+    parser.add_argument('--writers', type=int, default=4,
+                        help='Number of writer processes for --parallel_write (default 4)')
+    parser.add_argument('--writer_slots', type=int, default=16,
+                        help='Number of frames in flight to the writer processes (default 16)')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-a', '--auto_exptime', action='store_true', help='Enable automatic exposure time mode')
     group.add_argument('-v', '--variable_exptime', action='store_true', help='Enable variable exposure time mode')
+    group.add_argument('-e', '--exposure_control', action='store_true',
+                       help='Control the exposure time from the frame brightness on the host, '
+                            'see the --ae options')
+    parser.add_argument('--ae_target', type=float, default=0.25,
+                        help='With -e, target brightness as a fraction of the full scale (default 0.25)')
+    parser.add_argument('--ae_percentile', type=float, default=50.0,
+                        help='With -e, percentile of the pixel values driven to the target (default 50)')
+    parser.add_argument('--ae_policy', type=str, default='pid', choices=AE_POLICIES,
+                        help='With -e, PID corrections or fixed steps (default pid)')
+    parser.add_argument('--ae_gain', action='store_true',
+                        help='With -e, also control the gain, when the exposure time is at its limits')
+    parser.add_argument('--ae_max_exposure', type=int, default=1000000,
+                        help='With -e, maximum exposure time in us (default 1000000)')
     parser.add_argument('-C', '--compress', type=str, default=None, required=False, 
                         nargs='?', const='RICE',
-                        help='Enable FITS compression (RICE, GZIP, PLIO, None)')
-    return parser.parse_args()
+                        help='Enable FITS compression (RICE, GZIP, PLIO, AUTO, None), AUTO picks the '
+                             'compression of each file that keeps up with the frame rate')
+    parser.add_argument('--compress_threads', type=int, default=os.cpu_count(),
+                        help='Threads compressing the tiles of each RICE or GZIP frame, '
+                             '0 to compress with fitsio (default number of CPUs)')
+    parser.add_argument('--max_quant_bits', type=int, default=0,
+                        help='With -C AUTO, drop up to this many low bits of the pixel values when '
+                             'lossless compression cannot keep up (default 0, lossless only)')
+    parser.add_argument('--compress_log', type=str, default=None, metavar='PATH',
+                        help='With -C AUTO, write the compression decisions into this JSON lines file')
+    parser.add_argument('--pack_bits', action='store_true',
+                        help='Store RAW16 frames right shifted to the ADC bit depth (lossless, BSCALE '
+                             'restores the values), and 12 bit frames packed in --spool files')
+    parser.add_argument('-T', '--timeout', type=int, default=None,
+                        help='Frame wait timeout in ms (default 2 * exposure time + 500 ms)')
+    parser.add_argument('--telemetry', type=float, default=None, metavar='INTERVAL',
+                        help='Sample temperature, exposure etc. in a background thread every INTERVAL'
+                             ' seconds, instead of reading the camera for every frame')
+    parser.add_argument('-m', '--multi_camera', action='store_true',
+                        help='Record from all the camera devices in the config concurrently')
+    parser.add_argument('-t', '--capture_thread', action='store_true',
+                        help='Capture frames in a dedicated thread into a ring buffer, '
+                             'as -m does for each camera')
+    parser.add_argument('--ring_size', type=int, default=16,
+                        help='Capture thread ring buffer size in frames (default 16)')
+    parser.add_argument('--ring_policy', type=str, default='drop_oldest', choices=OVERFLOW_POLICIES,
+                        help='What to do when the ring buffer is full (default drop_oldest)')
+    parser.add_argument('--cube', type=int, default=None, metavar='N',
+                        help='Write the frames into multi-frame FITS files of up to N frames')
+    parser.add_argument('--cube_mode', type=str, default='cube', choices=CUBE_MODES,
+                        help='Multi-frame file layout, 3D cube or multi-extension (default cube)')
+    parser.add_argument('--cube_max_mb', type=float, default=None,
+                        help='Roll over to a new multi-frame file after this many MB of frame data')
+    parser.add_argument('--events', action='store_true',
+                        help='Keep the last frames in memory and write only the frames around '
+                             'triggered events, see the --event options')
+    parser.add_argument('--event_pre', type=float, default=5.0,
+                        help='With --events, seconds of frames written before a trigger (default 5)')
+    parser.add_argument('--event_post', type=float, default=5.0,
+                        help='With --events, seconds of frames written after a trigger (default 5)')
+    parser.add_argument('--event_max_mb', type=float, default=1024,
+                        help='With --events, memory of the frames kept per camera in MB (default 1024)')
+    parser.add_argument('--event_mode', type=str, default='cube', choices=EVENT_MODES,
+                        help='With --events, file layout of an event (default cube)')
+    parser.add_argument('--trigger_port', type=int, default=None, metavar='PORT',
+                        help='With --events, trigger an event on each UDP datagram to localhost PORT, '
+                             'the datagram text is recorded as the reason')
+    parser.add_argument('--lucky', type=float, default=None, metavar='FRACTION',
+                        help='Lucky imaging, write only the sharpest FRACTION of the frames of a '
+                             'sliding window')
+    parser.add_argument('--lucky_threshold', type=float, default=None, metavar='SCORE',
+                        help='Write only the frames with a sharpness score of at least SCORE')
+    parser.add_argument('--lucky_window', type=int, default=100,
+                        help='Number of frames of the --lucky sliding window (default 100)')
+    parser.add_argument('--lucky_metric', type=str, default='laplacian', choices=SHARPNESS_METRICS,
+                        help='Sharpness score, variance of the Laplacian or peak over flux '
+                             '(default laplacian)')
+    parser.add_argument('--lucky_size', type=int, default=REGION_SIZE,
+                        help=f'Side of the square region scored, in pixels (default {REGION_SIZE})')
+    parser.add_argument('--lucky_center', type=int, nargs=2, default=None, metavar=('X', 'Y'),
+                        help='Centre of the region scored, in binned pixels (default frame centre)')
+    parser.add_argument('--lucky_log', type=str, default=None, metavar='PATH',
+                        help='Write the sharpness score of every frame, kept or not, into this '
+                             'JSON lines file')
+    parser.add_argument('--transients', type=float, default=None, metavar='SIGMA',
+                        help='Detect the regions brighter than a running background by SIGMA noise '
+                             'sigma, see the --transient options')
+    parser.add_argument('--transient_bin', type=int, default=4,
+                        help='Binning of the frames for the --transients detection (default 4)')
+    parser.add_argument('--transient_alpha', type=float, default=0.05,
+                        help='Update rate of the --transients background per frame (default 0.05)')
+    parser.add_argument('--transient_min_pixels', type=int, default=2,
+                        help='Minimum number of binned pixels of a detection (default 2)')
+    parser.add_argument('--transient_log', type=str, default=None, metavar='PATH',
+                        help='Write the frame, bounding box, peak and centroid of every detection '
+                             'into this JSON lines file')
+    parser.add_argument('--transient_only', action='store_true',
+                        help='Write only the frames with --transients detections')
+    parser.add_argument('--coadd', type=int, default=None, metavar='N',
+                        help='Sum every N consecutive frames in memory and write only the sums, '
+                             'with NCOMBINE and their total exposure time')
+    parser.add_argument('--coadd_dtype', type=str, default='uint32', choices=list(STACK_DTYPES),
+                        help='Pixel type of the --coadd sums (default uint32)')
+    parser.add_argument('--spool', type=str, default=None, metavar='PATH',
+                        help='Only copy the frames into a raw spool file during capture, '
+                             'convert it to FITS afterwards with spool2fits.py')
+    parser.add_argument('--staging', type=str, default=None, metavar='FOLDER',
+                        help='Write the files into this fast local folder and move them to the output '
+                             'folder in the background (default staging_folder of the device config)')
+    parser.add_argument('--migrate_workers', type=int, default=2,
+                        help='Number of files moved from the staging folder concurrently (default 2)')
+    parser.add_argument('--staging_high_water', type=float, default=0.9,
+                        help='Pause the capture while the staging disk is fuller than this (default 0.9)')
+    parser.add_argument('--no_header_template', action='store_true',
+                        help='Build every uncompressed frame header with fitsio, instead of patching '
+                             'a precomputed header')
+    parser.add_argument('--metrics_file', type=str, default=None, metavar='PATH',
+                        help='Write the stage latency histograms, queue depths and dropped frames '
+                             'to this file in the Prometheus text format during the run')
+    parser.add_argument('--metrics_port', type=int, default=None, metavar='PORT',
+                        help='Serve the metrics on http://localhost:PORT/metrics during the run')
+    parser.add_argument('--metrics_interval', type=float, default=5.0,
+                        help='Seconds between refreshes of the metrics file and endpoint (default 5)')
+    args = parser.parse_args()
+    if args.spool is not None and (args.cube is not None or args.parallel_write):
+        parser.error('--spool cannot be used with --cube or --parallel_write')
+    if args.spool is not None and args.staging is not None:
+        parser.error('--spool already writes to a local file, it cannot be used with --staging')
+    if args.compress is not None and args.compress.upper() == ADAPTIVE:
+        args.compress = ADAPTIVE
+    if args.compress == ADAPTIVE and (args.parallel_write or args.cube is not None or args.spool):
+        parser.error('-C AUTO cannot be used with --parallel_write, --cube or --spool')
+    if args.events:
+        if args.spool is not None or args.cube is not None or args.parallel_write:
+            parser.error('--events cannot be used with --spool, --cube or --parallel_write')
+        if args.coadd is not None or args.lucky is not None or args.lucky_threshold is not None:
+            parser.error('--events cannot be used with --coadd or the --lucky selection')
+        if args.pack_bits or args.compress == ADAPTIVE:
+            parser.error('--events cannot be used with --pack_bits or -C AUTO')
+        if args.compress and args.event_mode == 'cube':
+            parser.error('compressed events need --event_mode mef or sequence')
+    if args.multi_camera and args.capture_thread:
+        parser.error('-m already captures each camera in its own thread, -t is for one camera')
+    if args.lucky is not None and not 0 < args.lucky <= 1:
+        parser.error('--lucky needs a fraction of the frames between 0 and 1')
+    if args.transient_only:
+        if args.transients is None:
+            parser.error('--transient_only needs --transients')
+        if args.events:
+            parser.error('--transient_only cannot be used with --events, the detections trigger '
+                         'the events')
+    if args.coadd is not None:
+        if args.coadd < 1:
+            parser.error('--coadd needs at least 1 frame per sum')
+        if args.spool is not None or args.parallel_write:
+            parser.error('--coadd cannot be used with --spool or --parallel_write')
+        if args.pack_bits or args.compress == ADAPTIVE:
+            parser.error('--coadd cannot be used with --pack_bits or -C AUTO')
+        if args.compress and args.coadd_dtype == 'float32':
+            parser.error('float32 sums cannot be compressed losslessly, use --coadd_dtype uint32')
+    if args.cube is not None:
+        if args.parallel_write:
+            parser.error('--cube writes the frames sequentially, it cannot be used with --parallel_write')
+        if args.compress and args.cube_mode == 'cube':
+            parser.error('compressed multi-frame files need --cube_mode mef')
+    return args
 
 
 def load_yaml_config(file_path):
@@ -56,74 +239,174 @@ def load_yaml_config(file_path):
         return yaml.safe_load(file)
 
 
-def write_file_process(data, header, filename, compress):
-    # ## using panoptes.utils.images.fits as fits_utils
-    # fits_utils.write_fits(data, header, filename, overwrite=True, compress=compress)
-    # ## using fitsio wrapper for cfitsio
-    fitsio.write(filename, data, header=header, compress=compress, clobber=True)
-    # The thread will automatically exit when this function completes
-
-
-def spawn_file_write(data, header, filename, compress, processes):
-    process = multiprocessing.Process(target=write_file_process, 
-                                      args=(data, header, filename, compress))
-    process.daemon = True
-    process.start()
-    processes.append(process)
-    # The process will run independently and disappear when ends
-    # There is also unfinished processes collecting loop at the end of capture
-    # otherwise not all the frames would be written
-
-
-def main():
-    args = parse_args()   
-    logger = setup_logger(args.debug)
-
-    # Load the YAML configuration
-    logger.info(f"Loading configuration from: {args.config}")
-    config = load_yaml_config(args.config)
-
-    logger.info(f"Use compression: {args.compress}")
-
-    if args.parallel_write:
-        logger.info(f"Write files in parallel threads")
-
-    if args.auto_exptime:
-        logger.info(f"Enable automatic exposure time mode")
-
-    if args.variable_exptime:
-        logger.info(f"Enable variable exposure time mode")
-
-    # Now you can access the configuration data
-    cameras = config.get('cameras', {})
-    devices = cameras.get('devices', [])
-
-    # print config to log
-    for device in devices:
-        logger.info(f"Camera: {device['name']}")
-        for key, value in device.items():
-            if key != 'name':
-                logger.info(f"  {key}: {value}")
-
-    # Take the 1st camera device
-    device = devices[0]
-
-    kwargs = {}
-    kwargs['serial_number'] = device['serial_number']
-    cam = ASIDriver(**kwargs)
-
-    # libasi.py might need to be updated for later ZWO SDK versions
-    # this was tested with V1.33 and V1.29
-    ver = cam.get_SDK_version()
-    logger.info(f'SDK Version is {ver}')
-
-    cameras = cam.get_devices()
-    logger.debug(f'Devices {cameras}')
-
-    ids = cam.get_product_ids()
-    logger.debug(f'Product IDs {ids}')
-
-    cam_id = cameras[device['serial_number']]
+def start_writer_pool(roi_formats, args, logger, on_written=None):
+    """Start the pool of writer processes for --parallel_write, with slots for the largest ROI """
+    slot_size = 0
+    for roi_format in roi_formats:
+        shape, dtype = image_layout(roi_format['width'], roi_format['height'],
+                                    roi_format['image_type'])
+        slot_size = max(slot_size, int(np.prod(shape)) * dtype.itemsize)
+    logger.info(f"Writing files with {args.writers} processes, {args.writer_slots} frames in flight")
+    return WriterPool(slot_size, n_workers=args.writers, n_slots=args.writer_slots, logger=logger,
+                      on_written=on_written)
+
+
+def make_cube_writer(output_folder, args, prefix='cube', on_file_closed=None):
+    """Make the multi-frame file writer for --cube """
+    max_bytes = None if args.cube_max_mb is None else int(args.cube_max_mb * 1e6)
+    return CubeWriter(output_folder, prefix=prefix, frames_per_file=args.cube, max_bytes=max_bytes,
+                      mode=args.cube_mode, compress=args.compress, on_file_closed=on_file_closed)
+
+
+def make_migrator(device, args, logger, per_camera=False):
+    """Make the migrator of the files of a device from its staging folder, or None.
+
+    The staging folder is --staging, in a subfolder per camera if per_camera, or else the
+    staging_folder of the device config.
+    """
+    staging_folder = args.staging
+    if staging_folder is not None and per_camera:
+        staging_folder = os.path.join(staging_folder, device['name'])
+    staging_folder = staging_folder or device.get('staging_folder')
+    if not staging_folder or args.spool is not None:
+        return None
+    migrator = Migrator(staging_folder, device['output_folder'], n_workers=args.migrate_workers,
+                        high_water=args.staging_high_water, logger=logger)
+    logger.info(f"Staging files in {staging_folder}, moved to {device['output_folder']} by "
+                f"{args.migrate_workers} threads, {migrator.n_resumed} files of a previous run resumed")
+    return migrator
+
+
+def folder_key(folder):
+    """Key of a folder in the migrators dict, the same for any spelling of its path """
+    return os.path.normpath(os.path.abspath(folder))
+
+
+def migration_callback(migrators):
+    """Make a callback handing the files written under a staging folder to its migrator.
+
+    migrators are keyed by folder_key() of their staging folder. The files can be in a
+    subfolder of it, e.g. the frames of an event.
+    """
+    def submit(path):
+        folder = os.path.dirname(folder_key(path))
+        while True:
+            migrator = migrators.get(folder)
+            if migrator is not None:
+                migrator.submit(path)
+                return
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                return
+            folder = parent
+    return submit
+
+
+def close_migrator(migrator, logger):
+    """Wait for the files still to move to the output folder """
+    if migrator.pending:
+        logger.info(f"Waiting for {migrator.pending} files to move to {migrator.output_folder}")
+    migrator.close()
+    logger.info(f"Migration from {migrator.staging_folder}: {migrator.stats}")
+    left = [name for _, _, names in os.walk(migrator.staging_folder) for name in names
+            if name != JOURNAL_NAME]
+    if left:
+        logger.warning(f"{len(left)} files are left in the staging folder {migrator.staging_folder}")
+
+
+def make_spool(path, settings, num_frames, logger):
+    """Make the raw spool file for --spool, with a slot for each frame """
+    roi_format = settings['roi_format']
+    shape, dtype = image_layout(roi_format['width'], roi_format['height'], roi_format['image_type'])
+    # the per frame keys are filled in by spool2fits.py, the spool frames are not right shifted
+    header = make_header('', dict(settings, pack_shift=0), settings['exposure_time_us'], '', '', 0.0)
+    bit_depth = settings['bit_depth'] if settings['pack_shift'] else None
+    logger.info(f"Spooling {num_frames} frames into {path}")
+    return SpoolWriter(path, num_frames, shape, dtype, header, bit_depth=bit_depth)
+
+
+def make_stage_histograms(metrics, camera_name):
+    """Make the latency histograms of the CAPTURE_STAGES of a camera """
+    return {stage: metrics.histogram('stage_seconds', 'Time spent on a frame in a capture stage',
+                                     stage=stage, camera=camera_name)
+            for stage in CAPTURE_STAGES}
+
+
+def add_capture_samples(metrics, cam, cam_id, camera_name, frames, stream=None):
+    """Sample the frame counters and ring buffer of a camera when the metrics are published.
+
+    Args:
+        frames (callable): returns the number of frames recorded so far.
+    """
+    metrics.sample('frames_total', 'Frames recorded', frames, 'counter', camera=camera_name)
+    metrics.sample('dropped_frames_total', 'Frames dropped by the camera or the ring buffer',
+                   lambda: cam.get_dropped_frames(cam_id), 'counter', camera=camera_name,
+                   source='camera')
+    if stream is not None:
+        metrics.sample('dropped_frames_total', 'Frames dropped by the camera or the ring buffer',
+                       lambda: stream.n_dropped_oldest + stream.n_dropped_newest, 'counter',
+                       camera=camera_name, source='ring')
+        metrics.sample('queue_depth', 'Frames or files waiting in a queue', lambda: stream.depth,
+                       camera=camera_name, queue='ring')
+
+
+def add_writer_samples(metrics, writer_pool=None, migrators=None):
+    """Sample the frames in flight to the writer pool and the files still to migrate """
+    if writer_pool is not None:
+        metrics.sample('queue_depth', 'Frames or files waiting in a queue',
+                       lambda: writer_pool.in_flight, queue='writer_pool')
+    for migrator in (migrators or {}).values():
+        metrics.sample('queue_depth', 'Frames or files waiting in a queue',
+                       lambda migrator=migrator: migrator.pending, queue='migrator',
+                       folder=migrator.staging_folder)
+        metrics.sample('staging_usage_ratio', 'Used fraction of the staging file system',
+                       lambda migrator=migrator: migrator.staging_usage,
+                       folder=migrator.staging_folder)
+
+
+def start_metrics_exporter(metrics, args, logger):
+    """Start publishing the metrics to --metrics_file and --metrics_port, or None """
+    if args.metrics_file is None and args.metrics_port is None:
+        return None
+    exporter = MetricsExporter(metrics, path=args.metrics_file, port=args.metrics_port,
+                               interval=args.metrics_interval)
+    if args.metrics_file is not None:
+        logger.info(f"Writing metrics to {args.metrics_file} every {args.metrics_interval} s")
+    if exporter.port is not None:
+        logger.info(f"Serving metrics on http://localhost:{exporter.port}/metrics")
+    return exporter
+
+
+def log_stage_latencies(metrics, logger):
+    """Log the count, mean and estimated percentiles of each capture stage latency """
+    for _, labels, histogram in metrics.histograms:
+        if not histogram.count:
+            continue
+        logger.info(f"{labels['camera']} {labels['stage']}: {histogram.count} frames, "
+                    f"mean {histogram.sum / histogram.count * 1e3:.2f} ms, "
+                    f"p50 {histogram.quantile(0.5) * 1e3:.2f} ms, "
+                    f"p99 {histogram.quantile(0.99) * 1e3:.2f} ms")
+
+
+def log_stacker_stats(stacker, camera_name, logger):
+    logger.info(f"{camera_name}: {stacker.n_added} frames co-added into {stacker.n_stacks} sums, "
+                f"{stacker.n_skipped} frames skipped")
+
+
+def log_writer_pool_stats(writer_pool, logger):
+    logger.info(f"Writer pool: {writer_pool.stats}")
+    for worker_stats in writer_pool.worker_stats:
+        logger.info('Writer {worker}: {frames} frames, {MBps:.1f} MB/s, {fps:.2f} frames/s while busy, '
+                    '{errors} errors'.format(**worker_stats))
+
+
+def configure_camera(cam, cam_id, device, args, logger):
+    """Open, initialise and configure the camera as given by its device config.
+
+    Returns:
+        dict: the resulting capture settings read back from the camera, used for the
+            frame headers, see make_header().
+    """
     cam.open_camera(cam_id)
     cam.init_camera(cam_id)
 
@@ -132,6 +415,7 @@ def main():
     logger.info(f'Camera info: {info}')
 
     camera_name = info['name']
+    bit_depth = int(get_quantity_value(info['bit_depth'], unit=u.bit))
     pixel_size = get_quantity_value(info['pixel_size'], unit=u.um)
 
     n_controls = cam.get_num_of_controls(cam_id)
@@ -238,6 +522,760 @@ def main():
     cooler_on = cam.get_control_value(cam_id, 'COOLER_ON')
     logger.info(f'Cooler status = {cooler_on}')
 
+    # RAW16 pixels are left aligned, the low 16 - bit_depth bits are zero
+    pack_shift = 0
+    if args.pack_bits:
+        pack_shift = packing_shift(bit_depth, np.uint16 if img_type == 'RAW16' else np.uint8)
+        logger.info(f'ADC bit depth {bit_depth}, frames right shifted by {pack_shift} bits')
+
+    return {'roi_format': roi_format,
+            'image_type': img_type,
+            'binning': binning,
+            'gain': gain,
+            'exposure_time_us': exp_time_us_int,
+            'start_x': start_x_int,
+            'start_y': start_y_int,
+            'camera_name': camera_name,
+            'pixel_size': pixel_size,
+            'bit_depth': bit_depth,
+            'pack_shift': pack_shift}
+
+
+def make_header(filename, settings, exp_time_us_int, iso_start_date, iso_end_date, temp_C):
+    """Build the FITS header of a frame, with the packing keys of --pack_bits frames """
+    exp_time = exp_time_us_int / 1e6
+    header = {
+             'FILE': filename,
+             'TEST': True,
+             'EXPTIME': exp_time,
+             'EXPOSURE': exp_time,
+             'EXPOINUS': exp_time_us_int,
+             'START_X': settings['start_x'],
+             'START_Y': settings['start_y'],
+             'DATE-OBS': iso_start_date,
+             'DATE-STA': iso_start_date,
+             'DATE-END': iso_end_date,
+             'XBINNING': settings['binning'],
+             'YBINNING': settings['binning'],
+             'GAIN': settings['gain'],
+             'BAYERPAT': 'NONE',
+             'COLORTYP': settings['image_type'],
+             'INSTRUME': settings['camera_name'],
+             'XPIXSZ': settings['pixel_size'],
+             'YPIXSZ': settings['pixel_size'],
+             'CCD_TEMP': temp_C
+           }
+    if settings['pack_shift']:
+        header.update(packing_keys(settings['pack_shift'], settings['bit_depth']))
+    return header
+
+
+def frame_values(filename, exp_time_us_int, iso_start_date, iso_end_date, temp_C):
+    """The header values of make_header() that change from frame to frame """
+    exp_time = exp_time_us_int / 1e6
+    return {'FILE': filename,
+            'EXPTIME': exp_time,
+            'EXPOSURE': exp_time,
+            'EXPOINUS': exp_time_us_int,
+            'DATE-OBS': iso_start_date,
+            'DATE-STA': iso_start_date,
+            'DATE-END': iso_end_date,
+            'CCD_TEMP': temp_C}
+
+
+def make_header_template(settings, args):
+    """Make the precomputed header of the frame files, or None if the frames are not written
+    to uncompressed files directly.
+    """
+    if args.no_header_template or args.compress or args.parallel_write or args.cube or args.spool:
+        return None
+    roi_format = settings['roi_format']
+    shape, dtype = image_layout(roi_format['width'], roi_format['height'], roi_format['image_type'])
+    header = make_header('frame000000.fits', settings, settings['exposure_time_us'], '', '', 0.0)
+    # the gain card is patched too, the one the host set for each frame
+    frame_keys = FRAME_KEYS + ('GAIN',) if host_exposure(args) else FRAME_KEYS
+    dtype = packed_dtype(dtype, settings['pack_shift'])
+    if args.coadd is not None:
+        # the sums, the last one may have fewer frames
+        header['NCOMBINE'] = args.coadd
+        frame_keys += ('NCOMBINE',)
+        dtype = STACK_DTYPES[args.coadd_dtype]
+    return FitsTemplate(header, shape, dtype, frame_keys)
+
+
+def host_exposure(args):
+    """True if the host sets the exposure time and gain of the frames, for -e and -v """
+    return args.exposure_control or args.variable_exptime
+
+
+def make_exposure_schedule(cam, cam_id, settings, args):
+    """Make the schedule of the exposure times and gains set by the host for -e and -v, or None """
+    if not host_exposure(args):
+        return None
+    return ExposureSchedule(cam, cam_id, settings['exposure_time_us'], settings['gain'])
+
+
+def make_exposure_controller(cam, cam_id, schedule, args, logger):
+    """Make the host exposure controller for -e, or None """
+    if not args.exposure_control:
+        return None
+    logger.info(f"Exposure control: percentile {args.ae_percentile} to {args.ae_target:.0%} of full scale, "
+                f"{args.ae_policy} policy, up to {args.ae_max_exposure} us"
+                f"{', with gain' if args.ae_gain else ''}")
+    return ExposureController(cam, cam_id, schedule, target=args.ae_target,
+                              percentile=args.ae_percentile, policy=args.ae_policy,
+                              max_exposure_us=args.ae_max_exposure, control_gain=args.ae_gain,
+                              logger=logger)
+
+
+def make_event_capture(settings, output_folder, args, clock, logger, prefix='event',
+                       on_file_closed=None):
+    """Make the pre-trigger frame buffer and event writer for --events, or None """
+    if not args.events:
+        return None
+    roi_format = settings['roi_format']
+    shape, dtype = image_layout(roi_format['width'], roi_format['height'], roi_format['image_type'])
+
+    def header_function(filename, exposure_us, start_ns, end_ns, temp_C):
+        return make_header(filename, settings, exposure_us, clock.iso_date(start_ns),
+                           clock.iso_date(end_ns), temp_C)
+
+    events = EventCapture(shape, dtype, args.event_pre, args.event_post,
+                          int(args.event_max_mb * 1e6), output_folder, header_function,
+                          mode=args.event_mode, compress=args.compress, prefix=prefix,
+                          clock=clock, on_file_closed=on_file_closed, logger=logger)
+    logger.info(f"Keeping the last {events.n_slots} frames of {settings['camera_name']} in memory, "
+                f"writing {args.event_pre} s before and {args.event_post} s after each event "
+                f"in {args.event_mode} mode")
+    return events
+
+
+def start_event_triggers(captures, args, logger):
+    """Trigger the events of all the cameras on SIGUSR1, and on --trigger_port datagrams.
+
+    Returns:
+        TriggerSocket or None: the listener of the trigger port.
+    """
+    def trigger(reason):
+        for events in captures:
+            events.trigger(reason)
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: trigger('SIGUSR1'))
+    logger.info(f"Trigger an event with: kill -USR1 {os.getpid()}")
+    if args.trigger_port is None:
+        return None
+    listener = TriggerSocket(trigger, args.trigger_port)
+    logger.info(f"Trigger an event with: echo <reason> > /dev/udp/127.0.0.1/{listener.port}")
+    return listener
+
+
+def close_event_capture(events, camera_name, logger):
+    """Write the events in progress and log the event counters """
+    events.close()
+    logger.info(f"{camera_name} events: {events.stats}")
+    if events.n_dropped:
+        logger.warning(f"{camera_name}: {events.n_dropped} frames dropped, the event writer was "
+                       f"behind, use a larger --event_max_mb")
+
+
+def make_frame_selector(args, logger, log_path=None):
+    """Make the lucky imaging selection of the frames for --lucky or --lucky_threshold, or None """
+    if args.lucky is None and args.lucky_threshold is None:
+        return None
+    kept = []
+    if args.lucky is not None:
+        kept.append(f"the sharpest {args.lucky:.0%} of {args.lucky_window} frames")
+    if args.lucky_threshold is not None:
+        kept.append(f"{args.lucky_metric} scores of at least {args.lucky_threshold}")
+    logger.info(f"Writing only the frames with {' and '.join(kept)}")
+    return FrameSelector(fraction=args.lucky, threshold=args.lucky_threshold,
+                         window=args.lucky_window, metric=args.lucky_metric, size=args.lucky_size,
+                         center=args.lucky_center, log_path=log_path, logger=logger)
+
+
+def make_transient_detector(args, logger, log_path=None):
+    """Make the transient detector for --transients, or None """
+    if args.transients is None:
+        return None
+    written = ', writing only the frames with detections' if args.transient_only else ''
+    logger.info(f"Detecting transients of {args.transients} sigma on frames binned by "
+                f"{args.transient_bin}{written}")
+    return TransientDetector(n_sigma=args.transients, binning=args.transient_bin,
+                             alpha=args.transient_alpha, min_pixels=args.transient_min_pixels,
+                             log_path=log_path, logger=logger)
+
+
+def transient_reason(detections):
+    """Trigger reason of the strongest of the detections in a frame """
+    best = max(detections, key=lambda detection: detection.sigma)
+    reason = f'transient at {best.x:.0f},{best.y:.0f} {best.sigma:.1f} sigma'
+    if len(detections) > 1:
+        reason += f' and {len(detections) - 1} more'
+    return reason
+
+
+def make_frame_stacker(settings, args, num_frames, logger):
+    """Make the in-memory sums of --coadd frames, or None """
+    if args.coadd is None:
+        return None
+    roi_format = settings['roi_format']
+    _, dtype = image_layout(roi_format['width'], roi_format['height'], roi_format['image_type'])
+    logger.info(f"Co-adding {args.coadd} frames into {args.coadd_dtype} sums")
+    return FrameStacker(args.coadd, dtype, STACK_DTYPES[args.coadd_dtype], total_frames=num_frames)
+
+
+def make_tile_compressor(args, logger):
+    """Make the parallel tile compressor of the compressed frame files, or None if the frames
+    are not written to compressed files directly or fitsio has to compress them.
+    """
+    if (not args.compress or not is_supported(args.compress) or args.compress_threads < 1
+            or args.parallel_write or args.cube or args.spool):
+        return None
+    logger.info(f"Compressing frame tiles with {args.compress_threads} threads")
+    return TileCompressor(args.compress, n_threads=args.compress_threads)
+
+
+def make_adaptive_writer(settings, args, logger, log_path=None):
+    """Make the writer choosing the compression of each file for -C AUTO, or None """
+    if args.compress != ADAPTIVE:
+        return None
+    logger.info(f"Adaptive compression, up to {args.max_quant_bits} quantization bits")
+    return AdaptiveWriter(settings['exposure_time_us'] / 1e6, max_quant_bits=args.max_quant_bits,
+                          n_threads=args.compress_threads or None, log_path=log_path,
+                          logger=logger)
+
+
+def make_frame_packer(settings, logger):
+    """Make the right shift of the frames for --pack_bits, or None """
+    if not settings['pack_shift']:
+        return None
+    logger.info(f"Packing {settings['bit_depth']} bit frames, right shifted by {settings['pack_shift']} bits")
+    return FramePacker(settings['pack_shift'])
+
+
+def frame_timeout_ms(args, device):
+    """Frame wait timeout, ZWO recommend 2 * exposure time + 500 ms """
+    # (500 was the timeout in Dale's example)
+    if args.timeout is not None:
+        return args.timeout
+    exposure_time = device['exposure_time']
+    if args.exposure_control:
+        # the exposure controller may lengthen the exposure up to its maximum
+        exposure_time = max(exposure_time, args.ae_max_exposure)
+    return 2 * exposure_time // 1000 + 500
+
+
+@dataclass
+class PipelineConfig:
+    """The components of the frame pipeline of a camera, see FramePipeline.
+
+    The optional components are None when their option is not given.
+
+    Attributes:
+        name (str): name of the camera device.
+        settings (dict): capture settings of the camera, see configure_camera().
+        output_folder (str): folder of the files, the staging folder with a migrator.
+        prefix (str): start of the frame and stack file names, the camera name with -m.
+    """
+    name: str
+    settings: dict
+    output_folder: str
+    prefix: str = ''
+    telemetry: Optional[TelemetrySampler] = None
+    writer_pool: Optional[WriterPool] = None
+    cube_writer: Optional[CubeWriter] = None
+    spool: Optional[SpoolWriter] = None
+    template: Optional[FitsTemplate] = None
+    compressor: Optional[TileCompressor] = None
+    adaptive_writer: Optional[AdaptiveWriter] = None
+    packer: Optional[FramePacker] = None
+    migrator: Optional[Migrator] = None
+    schedule: Optional[ExposureSchedule] = None
+    controller: Optional[ExposureController] = None
+    detector: Optional[TransientDetector] = None
+    events: Optional[EventCapture] = None
+    selector: Optional[FrameSelector] = None
+    stacker: Optional[FrameStacker] = None
+
+
+def make_pipeline_config(cam, cam_id, device, settings, args, logger, migrators, clock,
+                         writer_pool=None, compressor=None, per_camera=False):
+    """Make the components of the frame pipeline of a device for the options in args.
+
+    With a staging folder the files are written to it, and its migrator is added to migrators.
+    With per_camera, for -m, the cameras may share the output folder and the --staging folder,
+    so the file names start with the camera name, the log files of the options end with it,
+    and the --staging folder has a subfolder per camera. The writer pool and the tile
+    compressor are shared by the cameras.
+    """
+    name = device['name']
+    prefix = f'{name}_' if per_camera else ''
+
+    def camera_path(path):
+        # the log file of the options, one per camera with -m
+        if path is None or not per_camera:
+            return path
+        root, ext = os.path.splitext(path)
+        return f'{root}_{name}{ext}'
+
+    output_folder = device['output_folder']
+    migrator = make_migrator(device, args, logger, per_camera)
+    if migrator is not None:
+        # the files are written to the staging folder
+        migrators[folder_key(migrator.staging_folder)] = migrator
+        output_folder = migrator.staging_folder
+
+    telemetry = None
+    if args.telemetry is not None:
+        telemetry = cam.start_telemetry(cam_id, interval=args.telemetry)
+        logger.info(f'Telemetry of {telemetry.controls} sampled every {args.telemetry} s')
+
+    cube_writer = None
+    if args.cube is not None:
+        cube_writer = make_cube_writer(output_folder, args, f'{prefix}cube',
+                                       migration_callback(migrators))
+        logger.info(f"Writing {args.cube_mode} files of up to {args.cube} frames")
+
+    spool = None
+    if args.spool is not None:
+        spool = make_spool(camera_path(args.spool), settings, device['num_frames'], logger)
+
+    template = make_header_template(settings, args)
+    if template is not None:
+        logger.info(f"Writing frames with a precomputed {template.header_size} byte header")
+
+    schedule = make_exposure_schedule(cam, cam_id, settings, args)
+    return PipelineConfig(
+        name=name, settings=settings, output_folder=output_folder, prefix=prefix,
+        telemetry=telemetry, writer_pool=writer_pool, cube_writer=cube_writer, spool=spool,
+        template=template, compressor=compressor,
+        adaptive_writer=make_adaptive_writer(settings, args, logger, camera_path(args.compress_log)),
+        packer=None if spool is not None else make_frame_packer(settings, logger),
+        migrator=migrator, schedule=schedule,
+        controller=make_exposure_controller(cam, cam_id, schedule, args, logger),
+        detector=make_transient_detector(args, logger, camera_path(args.transient_log)),
+        events=make_event_capture(settings, output_folder, args, clock, logger, f'{prefix}event',
+                                  migration_callback(migrators)),
+        selector=make_frame_selector(args, logger, camera_path(args.lucky_log)),
+        stacker=make_frame_stacker(settings, args, device['num_frames'], logger))
+
+
+class FramePipeline(object):
+    """Processes and writes the frames of a camera, in the single camera loop and with -m.
+
+    Each frame goes through the stages of the components of the config, those which are not
+    None: its temperature and exposure time are read from the telemetry or the camera, or
+    from the exposure schedule, which the controller corrects from the frame and -v varies.
+    The transient detector searches it, and its detections trigger the events. With events,
+    the frame is only kept in their memory, and written by them around the triggered events.
+    Otherwise the frames rejected by the selector, or without detections with
+    --transient_only, are dropped, and with a stacker only its sums are written. The header
+    is patched into the template or built, the data right shifted by the packer, and the
+    frame copied into the spool, appended by the cube writer, or written to its own file by
+    the writer pool, with the tile compressor, the adaptive writer or fitsio. The files
+    written directly are handed to the migrator.
+
+    The time spent in each stage goes into the stages histograms, see make_stage_histograms().
+
+    Example:
+        pipeline = FramePipeline(cam, cam_id, config, args, logger)
+        for frame in stream:
+            pipeline.write_frame(frame)
+            stream.release(frame)
+        pipeline.close()
+    """
+
+    def __init__(self, cam, cam_id, config, args, logger, stages=None, clock=None):
+        """
+        Args:
+            cam (ASIDriver): driver of the camera.
+            cam_id (int): integer ID of the camera.
+            config (PipelineConfig): the components, see make_pipeline_config().
+            args (argparse.Namespace): the command line options.
+            logger (logging.Logger): logger of the frames and of the final stats.
+            stages (dict, optional): latency histograms of the CAPTURE_STAGES.
+            clock (FrameClock, optional): clock converting the frame timestamps to UTC.
+        """
+        self.cam = cam
+        self.cam_id = cam_id
+        self.config = config
+        self.args = args
+        self.logger = logger
+        self.stages = stages if stages is not None else make_stage_histograms(Metrics(), config.name)
+        self.clock = clock if clock is not None else FrameClock()
+        self.last_path = None
+
+    def write_frame(self, frame):
+        """Process a videostream.Frame, see process() """
+        self.process(frame.data, frame.timestamp_ns, frame.sequence)
+
+    def process(self, data, timestamp_ns, sequence):
+        """Process a frame, the data buffer is not referenced afterwards.
+
+        Args:
+            data (numpy.ndarray): the frame data.
+            timestamp_ns (int): time.monotonic_ns() when the frame data arrived.
+            sequence (int): frame number, in the file names of the frames.
+        """
+        config, args, stages, clock = self.config, self.args, self.stages, self.clock
+        with stages['telemetry'].time():
+            exp_us = config.settings['exposure_time_us']
+            temp_C = auto_exp_us = None
+            if config.telemetry is not None:
+                # sampled values interpolated to the frame time, no camera access, None while
+                # a control has no sample, e.g. its first reads failed
+                frame_time = clock.timestamp(timestamp_ns)
+                temp_C = config.telemetry.value_at('TEMPERATURE', frame_time)
+                if args.auto_exptime:
+                    auto_exp_us = config.telemetry.value_at('EXPOSURE', frame_time)
+            if temp_C is None:
+                # raw value is in 1/10 degree C
+                temp_C = self.cam.get_control_raw(self.cam_id, 'TEMPERATURE')[0] / 10.0
+            if args.auto_exptime:
+                if auto_exp_us is None:
+                    # raw value is in us
+                    auto_exp_us = self.cam.get_control_raw(self.cam_id, 'EXPOSURE')[0]
+                exp_us = int(round(auto_exp_us))
+            gain = None
+            if config.schedule is not None:
+                # what the host set for this frame, not what the camera has now
+                exp_us, gain = config.schedule.at(timestamp_ns)
+        if config.controller is not None:
+            # the correction applies to the frames exposed from now on
+            with stages['exposure'].time():
+                config.controller.update(data, timestamp_ns)
+        if args.variable_exptime:
+            self._vary_exposure()
+
+        # the exposure ended when the frame data arrived
+        end_ns = timestamp_ns
+        start_ns = end_ns - exp_us * 1000
+        filename = f'{config.prefix}frame{sequence:06d}.fits'
+        keep = True
+        if config.detector is not None:
+            with stages['transient'].time():
+                detections = config.detector.detect(data, sequence, clock.timestamp(end_ns))
+            if detections and config.events is not None:
+                # handled by the add() below, the frame is in the event
+                config.events.trigger(transient_reason(detections), end_ns)
+            keep = bool(detections) or not args.transient_only
+        if config.events is not None:
+            # copied into memory, written by the event writer if an event is triggered
+            with stages['event'].time():
+                config.events.add(data, start_ns, end_ns, exp_us, temp_C, sequence)
+            return
+        if config.selector is not None:
+            with stages['lucky'].time():
+                # every frame is scored, for the sliding window
+                keep = config.selector.select(data, sequence, clock.timestamp(end_ns)) and keep
+        if config.stacker is not None:
+            with stages['coadd'].time():
+                stack = (config.stacker.add(data, start_ns, end_ns, exp_us, temp_C, sequence)
+                         if keep else config.stacker.skip())
+            if stack is not None:
+                self._write_stack(stack)
+            return
+        if not keep:
+            # rejected, only its score or detections are kept
+            return
+        self._write(data, timestamp_ns, sequence, filename, exp_us, gain, start_ns, end_ns,
+                    temp_C)
+
+    def missing(self):
+        """Count a frame which did not arrive, e.g. after a camera stall.
+
+        The frame is skipped by the stacker, so the last sum is still written at the last frame
+        of the run.
+        """
+        if self.config.stacker is not None:
+            stack = self.config.stacker.skip()
+            if stack is not None:
+                self._write_stack(stack)
+
+    def close(self):
+        """Close the components of the camera and log their stats.
+
+        The writer pool, the tile compressor and the migrator are closed by the caller, after
+        the files of all the cameras are written.
+        """
+        config, name, logger = self.config, self.config.name, self.logger
+        if config.stacker is not None and config.stacker.n_pending:
+            # frames lost to write errors, the last sum is not complete
+            logger.warning(f"{name}: writing the unfinished sum of {config.stacker.n_pending} frames")
+            self._write_stack(config.stacker.flush())
+        if config.telemetry is not None:
+            self.cam.stop_telemetry(self.cam_id)
+            logger.info(f"{name} telemetry samples: {config.telemetry.n_samples}, read errors: "
+                        f"{config.telemetry.n_errors} {config.telemetry.errors}")
+        if config.adaptive_writer is not None:
+            config.adaptive_writer.close()
+            logger.info(f"{name} files per compression method: {config.adaptive_writer.stats}")
+        if config.controller is not None:
+            logger.info(f"{name} exposure control: {config.controller.stats}")
+        if config.events is not None:
+            close_event_capture(config.events, name, logger)
+        if config.detector is not None:
+            config.detector.close()
+            logger.info(f"{name} transient detection: {config.detector.stats}")
+        if config.selector is not None:
+            config.selector.close()
+            logger.info(f"{name} frame selection: {config.selector.stats}")
+        if config.stacker is not None:
+            log_stacker_stats(config.stacker, name, logger)
+        if config.spool is not None:
+            config.spool.close()
+            logger.info(f"Spooled {config.spool.n_frames} frames into {config.spool.path}, "
+                        f"convert them with spool2fits.py")
+        elif config.cube_writer is not None:
+            cube_writer = config.cube_writer
+            cube_writer.close()
+            logger.info(f"Wrote {cube_writer.n_frames} frames into {len(cube_writer.files)} files, "
+                        f"last file name: {cube_writer.files[-1] if cube_writer.files else None}")
+        elif self.last_path is not None:
+            logger.info(f'{name} last frame file name: {self.last_path}')
+
+    # Private methods
+
+    def _vary_exposure(self):
+        # this is just super dummy simple placeholder for some meaningful
+        # algorithm, to check that the exposure time is actually changing
+        schedule = self.config.schedule
+        if schedule.exposure_us < 5000:
+            schedule.set(exposure_us=self.config.settings['exposure_time_us'])
+        else:
+            schedule.set(exposure_us=schedule.exposure_us - 2000)
+
+    def _write_stack(self, stack):
+        # the sum is written like a frame, with the combined exposure and the last gain
+        gain = None
+        if self.config.schedule is not None:
+            _, gain = self.config.schedule.at(stack.end_ns)
+        self._write(stack.data, stack.end_ns, stack.index,
+                    f'{self.config.prefix}stack{stack.index:06d}.fits', stack.exposure_us, gain,
+                    stack.start_ns, stack.end_ns, stack.temp_C, stack.n_frames)
+
+    def _write(self, data, timestamp_ns, sequence, filename, exp_us, gain, start_ns, end_ns,
+               temp_C, n_combine=None):
+        # write a frame or a sum, n_combine is the number of frames of a sum
+        config, args, stages, clock = self.config, self.args, self.stages, self.clock
+        header_start_time = time.perf_counter()
+        if config.spool is not None:
+            stages['header'].observe(time.perf_counter() - header_start_time)
+            # just a copy into the memory mapped spool, FITS files are made later
+            with stages['write'].time():
+                config.spool.write(data, clock.timestamp(start_ns), clock.timestamp(end_ns),
+                                   exp_us, temp_C, sequence)
+            return
+        full_path = os.path.join(config.output_folder, filename)
+        iso_start_date = clock.iso_date(start_ns)
+        iso_end_date = clock.iso_date(end_ns)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'ISO frame start: {iso_start_date}  end: {iso_end_date}  '
+                              f'temp: {temp_C}  ExpTime: {exp_us / 1e6}')
+        if config.template is not None:
+            # only the changing cards of the precomputed header are formatted
+            values = frame_values(filename, exp_us, iso_start_date, iso_end_date, temp_C)
+            # the schedule is made for host_exposure(), like the GAIN card of the template
+            if config.schedule is not None:
+                values['GAIN'] = gain
+            if n_combine is not None:
+                values['NCOMBINE'] = n_combine
+        else:
+            header = make_header(filename, config.settings, exp_us, iso_start_date, iso_end_date,
+                                 temp_C)
+            if config.schedule is not None:
+                header['GAIN'] = gain
+            if n_combine is not None:
+                header['NCOMBINE'] = n_combine
+        stages['header'].observe(time.perf_counter() - header_start_time)
+
+        compress_start_time = time.perf_counter()
+        if config.packer is not None:
+            # ADC values, the header BSCALE scales them back
+            data = config.packer(data)
+        if config.compressor is not None:
+            # the frame tiles are compressed on all the cores
+            buffers = config.compressor.file_buffers(data, header)
+        compress_time = time.perf_counter() - compress_start_time
+
+        write_start_time = time.perf_counter()
+        if config.migrator is not None:
+            # blocks while the staging disk is too full
+            config.migrator.wait_for_space()
+        if config.template is not None:
+            # header, big endian data and padding in a single writev
+            config.template.write(full_path, data, values)
+        elif config.cube_writer is not None:
+            # appended to the open multi-frame file
+            config.cube_writer.write(data, header, sequence)
+        elif config.writer_pool is not None:
+            # blocks while all the writer slots are in flight, the frame is copied into
+            # shared memory so its buffer can go back to the pool for the next frame
+            config.writer_pool.submit(data, header, full_path, args.compress)
+        elif config.compressor is not None:
+            write_file(full_path, buffers)
+        elif config.adaptive_writer is not None:
+            # compression chosen from the measured frame period and write bandwidth
+            config.adaptive_writer.observe_frame(timestamp_ns / 1e9)
+            decision = config.adaptive_writer.write(full_path, data, header)
+            compress_time += decision['compress_s']
+        else:
+            # clobber=True is to overwrite existing files
+            fitsio.write(full_path, data, header=header, compress=args.compress, clobber=True)
+        if config.migrator is not None and config.cube_writer is None and config.writer_pool is None:
+            # the cube writer and the writer pool hand over their files when complete
+            config.migrator.submit(full_path)
+        write_time = time.perf_counter() - write_start_time
+        if config.adaptive_writer is not None:
+            write_time -= decision['compress_s']
+        if config.packer is not None or config.compressor is not None or config.adaptive_writer is not None:
+            stages['compress'].observe(compress_time)
+        # fitsio compression is part of the write
+        stages['write'].observe(write_time)
+        if config.cube_writer is None:
+            self.last_path = full_path
+
+
+def run_multi_camera(cam, cameras, devices, args, logger):
+    """Record from all the devices concurrently, each with its own capture thread and writer """
+    all_settings = []
+    for device in devices:
+        cam_id = cameras[device['serial_number']]
+        logger.info(f'----- Configure camera {device["name"]} -----')
+        all_settings.append(configure_camera(cam, cam_id, device, args, logger))
+
+    # start the writer processes before any other threads
+    migrators = {}
+    writer_pool = None
+    if args.parallel_write:
+        writer_pool = start_writer_pool([settings['roi_format'] for settings in all_settings],
+                                        args, logger, migration_callback(migrators))
+
+    # shared by the cameras, the tiles of all their frames are compressed in one thread pool
+    compressor = make_tile_compressor(args, logger)
+
+    metrics = Metrics(logger=logger)
+    # one clock for all the cameras, their frame dates are anchored to UTC together
+    clock = FrameClock()
+    recorders = []
+    pipelines = []
+    for device, settings in zip(devices, all_settings):
+        cam_id = cameras[device['serial_number']]
+        roi_format = settings['roi_format']
+        stages = make_stage_histograms(metrics, device['name'])
+        stream = VideoStream(cam, cam_id, roi_format['width'], roi_format['height'],
+                             settings['image_type'], frame_timeout_ms(args, device),
+                             capacity=args.ring_size, policy=args.ring_policy,
+                             wait_histogram=stages['sdk_wait'], clock=clock)
+        # the cameras may share the output folder
+        config = make_pipeline_config(cam, cam_id, device, settings, args, logger, migrators, clock,
+                                      writer_pool, compressor, per_camera=True)
+        pipeline = FramePipeline(cam, cam_id, config, args, logger, stages, clock)
+        pipelines.append(pipeline)
+        recorder = CameraRecorder(device['name'], stream, pipeline.write_frame, device['num_frames'],
+                                  logger)
+        recorders.append(recorder)
+        add_capture_samples(metrics, cam, cam_id, device['name'],
+                            lambda recorder=recorder: recorder.n_written, stream)
+    add_writer_samples(metrics, writer_pool, migrators)
+    exporter = start_metrics_exporter(metrics, args, logger)
+    captures = [pipeline.config.events for pipeline in pipelines if pipeline.config.events is not None]
+    trigger_socket = start_event_triggers(captures, args, logger) if captures else None
+
+    logger.info(f'Starting to capture from {len(recorders)} cameras')
+    stats = MultiCameraCapture(recorders, logger).run()
+    log_stage_latencies(metrics, logger)
+    if trigger_socket is not None:
+        trigger_socket.close()
+
+    for pipeline in pipelines:
+        pipeline.close()
+    logger.info(f"Frame buffer pool: {cam.frame_pool.stats}")
+    if writer_pool is not None:
+        writer_pool.close()
+        log_writer_pool_stats(writer_pool, logger)
+    if compressor is not None:
+        compressor.close()
+    for migrator in migrators.values():
+        close_migrator(migrator, logger)
+    if exporter is not None:
+        exporter.close()
+    return stats
+
+
+def main():
+    args = parse_args()   
+    logger = setup_logger(args.debug)
+
+    # Load the YAML configuration
+    logger.info(f"Loading configuration from: {args.config}")
+    config = load_yaml_config(args.config)
+
+    logger.info(f"Use compression: {args.compress}")
+
+    if args.parallel_write:
+        logger.info(f"Write files in parallel threads")
+
+    if args.auto_exptime:
+        logger.info(f"Enable automatic exposure time mode")
+
+    if args.variable_exptime:
+        logger.info(f"Enable variable exposure time mode")
+
+    if args.exposure_control:
+        logger.info(f"Enable host exposure control mode")
+
+    if args.capture_thread:
+        logger.info(f"Capture in a thread, ring buffer of {args.ring_size} frames, {args.ring_policy} when full")
+
+    # Now you can access the configuration data
+    cameras = config.get('cameras', {})
+    devices = cameras.get('devices', [])
+
+    # print config to log
+    for device in devices:
+        logger.info(f"Camera: {device['name']}")
+        for key, value in device.items():
+            if key != 'name':
+                logger.info(f"  {key}: {value}")
+
+    # Take the 1st camera device, unless recording from all
+    device = devices[0]
+
+    kwargs = {}
+    kwargs['serial_number'] = device['serial_number']
+    if cameras.get('library_path'):
+        # e.g. the simulated SDK library, relative paths are relative to the config file
+        kwargs['library_path'] = os.path.join(os.path.dirname(os.path.abspath(args.config)),
+                                              cameras['library_path'])
+    if args.multi_camera:
+        # enough buffers for full rings plus the frames being written, for all the cameras
+        kwargs['frame_pool_size'] = (args.ring_size + 2) * len(devices)
+    elif args.capture_thread:
+        # enough buffers for a full ring plus the frames being written
+        kwargs['frame_pool_size'] = args.ring_size + 2
+    cam = ASIDriver(**kwargs)
+
+    # libasi.py might need to be updated for later ZWO SDK versions
+    # this was tested with V1.33 and V1.29
+    ver = cam.get_SDK_version()
+    logger.info(f'SDK Version is {ver}')
+
+    cameras = cam.get_devices()
+    logger.debug(f'Devices {cameras}')
+
+    ids = cam.get_product_ids()
+    logger.debug(f'Product IDs {ids}')
+
+    if args.multi_camera:
+        run_multi_camera(cam, cameras, devices, args, logger)
+        return
+
+    cam_id = cameras[device['serial_number']]
+    settings = configure_camera(cam, cam_id, device, args, logger)
+    roi_format = settings['roi_format']
+    img_type = settings['image_type']
+
     num_frames = device['num_frames']
     frames_count = 0
     logger.info(f'Starting to capture {num_frames} frames')
@@ -245,116 +1283,99 @@ def main():
     soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
     logger.info(f"Files open soft limit: {soft}, hard limit: {hard}")
 
-    # A list of processes, to be able to wait for all frames
-    # to be written to files.
-    processes = []
+    # start the writer processes before any other threads
+    migrators = {}
+    writer_pool = None
+    if args.parallel_write:
+        writer_pool = start_writer_pool([roi_format], args, logger, migration_callback(migrators))
+
+    compressor = make_tile_compressor(args, logger)
+
+    # always on, published during the run with --metrics_file or --metrics_port
+    metrics = Metrics(logger=logger)
+    stages = make_stage_histograms(metrics, device['name'])
+
+    # bounded frame waits
+    frame_timeout = frame_timeout_ms(args, device)
+    timeout_policy = TimeoutPolicy()
+    logger.info(f'Frame wait timeout {frame_timeout} ms')
+
+    # frames are stamped with an integer, converted to UTC dates for the headers
+    clock = FrameClock()
+
+    config = make_pipeline_config(cam, cam_id, device, settings, args, logger, migrators, clock,
+                                  writer_pool, compressor)
+    pipeline = FramePipeline(cam, cam_id, config, args, logger, stages, clock)
+    trigger_socket = None
+    if config.events is not None:
+        trigger_socket = start_event_triggers([config.events], args, logger)
+
+    stream = None
+    if args.capture_thread:
+        stream = VideoStream(cam, cam_id, roi_format['width'], roi_format['height'], img_type,
+                             frame_timeout, capacity=args.ring_size, policy=args.ring_policy,
+                             timeout_policy=timeout_policy, wait_histogram=stages['sdk_wait'],
+                             clock=clock)
+        stream.start()
+    else:
+        cam.start_video_capture(cam_id)
 
-    cam.start_video_capture(cam_id)
+    add_capture_samples(metrics, cam, cam_id, device['name'], lambda: frames_count, stream)
+    add_writer_samples(metrics, writer_pool, migrators)
+    exporter = start_metrics_exporter(metrics, args, logger)
 
-    start_datetime = datetime.now(timezone.utc)
     start_time = time.perf_counter()
-    frame_start_datetime = start_datetime
-    frame_start_time = start_time
-
-    output_folder = device['output_folder']
-    entered_loop = False
 
     while frames_count < num_frames:
-        temp = cam.get_control_value(cam_id, 'TEMPERATURE')
-        temp_C = temp[0] / 10.0
-
-        # timeout 500 is from Dale's example
-        data = cam.get_video_data(cam_id, roi_format['width'], roi_format['height'], img_type, 500)
-        frame_got_data_time = time.perf_counter()
-        frame_end_datetime = datetime.now(timezone.utc) 
-        if data is not None:
-            # ## collect changing params before creating header
-            if args.variable_exptime or args.auto_exptime:
-                exp_time_tupple = cam.get_control_value(cam_id, 'EXPOSURE')
-                exp_time_us_int = int(round(get_quantity_value(exp_time_tupple[0], unit=u.us)))
-            start_date = frame_start_datetime.replace(microsecond=int((frame_start_time % 1) * 1e6))
-            end_date = start_date + timedelta(microseconds=exp_time_us_int)
-            exp_time = exp_time_us_int / 1e6
-            iso_start_date = start_date.isoformat(timespec='milliseconds').replace('+00:00', '')
-            iso_end_date = end_date.isoformat(timespec='milliseconds').replace('+00:00', '')
-
-            logger.debug(f'ISO frame start: {iso_start_date}  end: {iso_end_date}  temp: {temp_C}  ExpTime: {exp_time}')
-
-            filename = str(f'frame{frames_count:06d}.fits')
-
-            header = {
-                       'FILE': filename,
-                       'TEST': True,
-                       'EXPTIME': exp_time,
-                       'EXPOSURE': exp_time,
-                       'EXPOINUS': exp_time_us_int,
-                       'START_X': start_x_int,
-                       'START_Y': start_y_int,
-                       'DATE-OBS': iso_start_date,
-                       'DATE-STA': iso_start_date,
-                       'DATE-END': iso_end_date,
-                       'XBINNING': binning,
-                       'YBINNING': binning,
-                       'GAIN': gain,
-                       'BAYERPAT': 'NONE',
-                       'COLORTYP': img_type,
-                       'INSTRUME': camera_name,
-                       'XPIXSZ': pixel_size,
-                       'YPIXSZ': pixel_size,
-                       'CCD_TEMP': get_quantity_value(temp_C, unit=u.deg_C)
-                     }
-
-            # vary the exposure time
-            # this is just super dummy simple placeholder for some meaningful
-            # algorithm, to check that the exposure time is actually changing
-            if args.variable_exptime:
-                if (exp_time_us_int < 5000):
-                    exp_time_us_int = device['exposure_time']
-                else:
-                    exp_time_us_int -= 2000
-                cam.set_control_value(cam_id, 'EXPOSURE', exp_time_us_int)
-
-            # ## write frame into file
-            full_path = os.path.join(output_folder, filename)
-
-            # ## using panoptes.utils.images.fits as fits_utils
-            # fits_utils.write_fits(data, header, full_path,
-            #                      overwrite=True,
-            #                      compress=args.compress)
-            # ## using multiprocessing to write file in a side thread is not really faster
-            #    unless compression is used
-            # spawn_file_write(data, header, full_path, compress=args.compress, processes)
-
-            # ## using fitsio wrapper for cfitsio
-            #    clobber=True is to overwrite existing files
-            if args.parallel_write:
-                # ### using multiprocessing to write file in a side thread is not really faster
-                # only spin up MAX_PROCESSES
-                while len(processes) > MAX_PROCESSES:
-                    entered_loop = True
-                    print('#', end='')
-                    processes = [p for p in processes if p.is_alive()]
-                    time.sleep(exp_time / 1e6)
-                spawn_file_write(data, header, full_path, args.compress, processes)
+        if stream is not None:
+            # waiting for the capture thread, the SDK wait is measured in the thread
+            with stages['queue_wait'].time():
+                frame = stream.get()
+            if frame is None:
+                if stream.error is not None:
+                    raise stream.error
+                data = None
             else:
-                fitsio.write(full_path, data, header=header, compress=args.compress, clobber=True)
-
-            frame_start_time = frame_got_data_time
-            frame_start_datetime = frame_end_datetime
+                data = frame.data
+                frame_got_data_ns = frame.timestamp_ns
+                # numbered by the stream, the frames dropped by the ring buffer leave gaps
+                sequence = frame.sequence
+        else:
+            wait_start_ns = time.monotonic_ns()
+            try:
+                data = cam.wait_video_data(cam_id, roi_format['width'], roi_format['height'], img_type,
+                                           frame_timeout, policy=timeout_policy)
+            except error.Timeout as err:
+                logger.error(f"Camera stalled: {err}")
+                data = None
+            # the only clock reading of a frame, the dates are made from it
+            frame_got_data_ns = time.monotonic_ns()
+            stages['sdk_wait'].observe((frame_got_data_ns - wait_start_ns) / 1e9)
+            sequence = frames_count
+        if data is not None:
+            pipeline.process(data, frame_got_data_ns, sequence)
+            # written, or copied into the event memory, the sum or the writer pool shared memory,
+            # so the buffer can go back to the pool for the next frame
+            cam.release_frame(data)
         else:
             logger.error("No data.")
+            pipeline.missing()
         frames_count += 1
 
     end_time = time.perf_counter()
 
-    cam.stop_video_capture(cam_id)
-
-    # wrap line if printed any '#' characters for limiting number or processes
-    if entered_loop:
-        print('')
+    if stream is not None:
+        stream.stop()
+        stream.clear()
+        logger.info(f"Capture thread ring buffer: {stream.stats}")
+    else:
+        cam.stop_video_capture(cam_id)
 
-    if filename is not None:
-        logger.info(f'last frame file name: {full_path}')
+    if trigger_socket is not None:
+        trigger_socket.close()
+    pipeline.close()
+    if compressor is not None:
+        compressor.close()
 
     elapsed_time = end_time - start_time
     logger.info(f"Recorded {frames_count} frames, elapsed capture time: {elapsed_time:.6f} seconds")
@@ -363,17 +1384,29 @@ def main():
     dropped_frames = cam.get_dropped_frames(cam_id)
     logger.info(f"Number of dropped frames: {dropped_frames}")
 
+    logger.info(f"Frame wait timeouts: {timeout_policy.stats}")
+
+    # in steady state all the frames should come from reused buffers
+    logger.info(f"Frame buffer pool: {cam.frame_pool.stats}")
+
     exp_time = cam.get_control_value(cam_id, 'EXPOSURE')
     logger.info(f'Exposure_time = {exp_time}')
 
     if args.parallel_write:
-        # Wait for all processes to complete
-        for process in processes:
-            process.join()
+        # Wait for all the frames in flight to be written
+        writer_pool.close()
         logger.info(f"All file writing processes have completed.")
         end_write_time = time.perf_counter()
         elapsed_time = end_write_time - end_time
         logger.info(f"Writing files in parallel to catch up took extra time: {elapsed_time:.6f} seconds")
+        log_writer_pool_stats(writer_pool, logger)
+
+    for migrator in migrators.values():
+        close_migrator(migrator, logger)
+
+    log_stage_latencies(metrics, logger)
+    if exporter is not None:
+        exporter.close()
 
 
 if __name__ == '__main__':
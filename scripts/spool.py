@@ -0,0 +1,269 @@
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+from panoptes.utils import error
+
+from bitpack import pack12, packed12_size, unpack12
+from frameclock import iso_dates
+
+SPOOL_MAGIC = b'ASISPOOL'
+# version 2 added the 12 bit packed frames
+SPOOL_VERSION = 2
+
+# magic, version, header size, number of slots, slot size, index offset, data offset, JSON size
+_spool_header = struct.Struct('<8sIIQQQQQ')
+
+# Alignment of the index and of the frame slots, a page
+_ALIGNMENT = 4096
+
+# Marks an index entry whose frame is completely written
+COMMITTED = 0x54494D4D4F43  # 'COMMIT'
+
+INDEX_DTYPE = np.dtype([('committed', '<u8'),
+                        ('sequence', '<i8'),
+                        ('start_time', '<f8'),
+                        ('end_time', '<f8'),
+                        ('exp_us', '<i8'),
+                        ('ccd_temp', '<f8')])
+
+
+def _aligned(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _json_default(value):
+    # numpy scalars in the header
+    return value.item()
+
+
+class SpoolWriter(object):
+    """Raw frame spool in a preallocated memory mapped file.
+
+    At high frame rates building FITS headers and calling fitsio.write for every frame can
+    fall behind the camera. The spool defers all that: a frame is a memcpy into a fixed size
+    slot of a memory mapped file and a few numbers into its index entry, and the FITS files
+    are made afterwards with spool2fits.py.
+
+    File layout, little endian:
+        header: magic, version, sizes and offsets, then a JSON document with the frame shape,
+            dtype and packing and the FITS header of the run.
+        index: n_slots INDEX_DTYPE entries, page aligned.
+        data: n_slots frame slots, each page aligned.
+
+    The file is allocated in full when created, so the capture cannot run out of disk space
+    halfway. An index entry is marked COMMITTED only after its frame and metadata are
+    written, so a spool left behind by a crashed or killed capture is still consistent: the
+    committed frames are complete, the rest are ignored. The data reaches the disk when the
+    kernel writes back the pages, flush() forces it, e.g. to survive a power loss.
+
+    Left aligned 12 bit RAW16 frames (bit_depth 12) are stored packed, 3 bytes per pair of
+    pixels instead of 4, see bitpack.pack12(). SpoolReader unpacks them to the original
+    values.
+
+    Example:
+        with SpoolWriter('capture.spool', 1000, (1832, 2744), np.uint16, header) as spool:
+            spool.write(data, start_time, end_time, exp_us, ccd_temp)
+    """
+
+    def __init__(self, path, n_slots, shape, dtype, header=None, bit_depth=None):
+        """
+        Args:
+            path (str): path of the spool file, overwritten if it exists.
+            n_slots (int): maximum number of frames.
+            shape (tuple): frame shape.
+            dtype (numpy.dtype): frame dtype.
+            header (dict, optional): FITS header of the frames, the per frame keys are
+                replaced with the frame values when converted, see SpoolReader.fits_header.
+            bit_depth (int, optional): ADC bit depth, 12 bit uint16 frames are packed.
+        """
+        self.path = path
+        self.n_slots = n_slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.n_frames = 0
+        self.packed = bit_depth == 12 and self.dtype == np.uint16
+
+        description = json.dumps({'shape': self.shape,
+                                  'dtype': self.dtype.str,
+                                  'packing': 'pack12' if self.packed else None,
+                                  'header': header or {}},
+                                 default=_json_default).encode()
+        if self.packed:
+            frame_bytes = packed12_size(int(np.prod(self.shape)))
+        else:
+            frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        slot_size = _aligned(frame_bytes)
+        index_offset = _aligned(_spool_header.size + len(description))
+        data_offset = _aligned(index_offset + n_slots * INDEX_DTYPE.itemsize)
+        file_size = data_offset + n_slots * slot_size
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, file_size)
+            else:
+                os.ftruncate(fd, file_size)
+            os.pwrite(fd, _spool_header.pack(SPOOL_MAGIC, SPOOL_VERSION, index_offset, n_slots,
+                                             slot_size, index_offset, data_offset,
+                                             len(description)) + description, 0)
+            self._mmap = mmap.mmap(fd, file_size)
+        finally:
+            os.close(fd)
+
+        self._index = np.ndarray(n_slots, dtype=INDEX_DTYPE, buffer=self._mmap,
+                                 offset=index_offset)
+        self._slots = _slot_array(self._mmap, n_slots, slot_size, data_offset, self.shape,
+                                  self.dtype, self.packed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def is_full(self):
+        return self.n_frames >= self.n_slots
+
+    def write(self, data, start_time, end_time, exp_us, ccd_temp, sequence=None):
+        """Copy a frame and its metadata into the next slot.
+
+        Args:
+            data (numpy.ndarray): the frame, of the spool shape and dtype.
+            start_time (float): exposure start, seconds since epoch.
+            end_time (float): exposure end, seconds since epoch.
+            exp_us (int): exposure time in microseconds.
+            ccd_temp (float): sensor temperature in degree C.
+            sequence (int, optional): frame number, default is the number of frames written.
+
+        Raises:
+            ValueError: if the frame does not match the spool shape and dtype.
+            panoptes.utils.error.PanError: if all the slots are used.
+        """
+        if data.shape != self.shape or data.dtype != self.dtype:
+            raise ValueError(f'Frame {data.shape} {data.dtype} does not match the spool '
+                             f'{self.shape} {self.dtype}')
+        if self.is_full:
+            raise error.PanError(f'Spool {self.path} is full ({self.n_slots} frames)')
+
+        slot = self.n_frames
+        if self.packed:
+            pack12(data, out=self._slots[slot])
+        else:
+            self._slots[slot] = data
+        entry = self._index[slot:slot + 1]
+        entry['sequence'] = slot if sequence is None else sequence
+        entry['start_time'] = start_time
+        entry['end_time'] = end_time
+        entry['exp_us'] = exp_us
+        entry['ccd_temp'] = ccd_temp
+        # the frame only counts once everything else is in place
+        entry['committed'] = COMMITTED
+        self.n_frames += 1
+
+    def flush(self):
+        """Write the spool pages back to the disk """
+        self._mmap.flush()
+
+    def close(self):
+        if self._mmap.closed:
+            return
+        self.flush()
+        del self._index, self._slots
+        self._mmap.close()
+
+
+class SpoolReader(object):
+    """Reads the committed frames of a spool file written by SpoolWriter """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, _, n_slots, slot_size, index_offset, data_offset,
+         json_size) = _spool_header.unpack_from(self._mmap, 0)
+        if magic != SPOOL_MAGIC or version not in (1, SPOOL_VERSION):
+            raise ValueError(f'{path} is not a version 1 to {SPOOL_VERSION} ASI spool file')
+        description = json.loads(self._mmap[_spool_header.size:_spool_header.size + json_size])
+        self.shape = tuple(description['shape'])
+        self.dtype = np.dtype(description['dtype'])
+        self.header = description['header']
+        self.n_slots = n_slots
+        self.packed = description.get('packing') == 'pack12'
+
+        self._index = np.ndarray(n_slots, dtype=INDEX_DTYPE, buffer=self._mmap,
+                                 offset=index_offset)
+        self._slots = _slot_array(self._mmap, n_slots, slot_size, data_offset, self.shape,
+                                  self.dtype, self.packed)
+        self._committed = np.flatnonzero(self._index['committed'] == COMMITTED)
+        # ISO start and end dates of the committed frames, converted all at once when needed
+        self._iso_dates = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._committed)
+
+    def read(self, index):
+        """Get the data of a committed frame, a read only view of the spool unless packed """
+        if self.packed:
+            return unpack12(self._slots[self._committed[index]], self.shape)
+        return self._slots[self._committed[index]]
+
+    def metadata(self, index):
+        """Get the index entry of a committed frame as a dict """
+        entry = self._index[self._committed[index]]
+        return {name: entry[name].item() for name in INDEX_DTYPE.names if name != 'committed'}
+
+    def fits_header(self, index, filename):
+        """Make the FITS header of a committed frame, the spool header with the frame values """
+        metadata = self.metadata(index)
+        if self._iso_dates is None:
+            entries = self._index[self._committed]
+            self._iso_dates = (iso_dates(entries['start_time']), iso_dates(entries['end_time']))
+        iso_start_date = str(self._iso_dates[0][index])
+        exp_time = metadata['exp_us'] / 1e6
+        frame_values = {'FILE': filename,
+                        'EXPTIME': exp_time,
+                        'EXPOSURE': exp_time,
+                        'EXPOINUS': metadata['exp_us'],
+                        'DATE-OBS': iso_start_date,
+                        'DATE-STA': iso_start_date,
+                        'DATE-END': str(self._iso_dates[1][index]),
+                        'CCD_TEMP': metadata['ccd_temp']}
+        header = {key: frame_values.get(key, value) for key, value in self.header.items()}
+        for key, value in frame_values.items():
+            header.setdefault(key, value)
+        return header
+
+    def close(self):
+        if self._mmap.closed:
+            return
+        del self._index, self._slots
+        self._mmap.close()
+
+
+def _slot_array(buffer, n_slots, slot_size, data_offset, shape, dtype, packed):
+    # the frame slots, as packed bytes or as frames
+    if packed:
+        return np.ndarray((n_slots, packed12_size(int(np.prod(shape)))), dtype=np.uint8,
+                          buffer=buffer, offset=data_offset, strides=(slot_size, 1))
+    return np.ndarray((n_slots,) + shape, dtype=dtype, buffer=buffer, offset=data_offset,
+                      strides=(slot_size,) + _c_strides(shape, dtype))
+
+
+def _c_strides(shape, dtype):
+    strides = []
+    stride = np.dtype(dtype).itemsize
+    for size in reversed(shape):
+        strides.insert(0, stride)
+        stride *= size
+    return tuple(strides)
@@ -0,0 +1,117 @@
+"""Convert a raw frame spool written by pp_test.py --spool into FITS files.
+
+The frames are converted in parallel by a pool of processes, each reading its share of the
+frames straight from the memory mapped spool. Spools of interrupted captures are converted up
+to the last completely written frame.
+
+    python3 spool2fits.py /mnt/fast/capture.spool -o /var/huntsman/images/demo -C RICE
+    python3 spool2fits.py /mnt/fast/capture.spool -o /var/huntsman/images/demo --cube 100
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+
+import fitsio
+
+from cubewriter import CubeWriter, CUBE_MODES
+from spool import SpoolReader
+
+# Frames converted per task in single frame file mode
+CHUNK_SIZE = 16
+
+# The spool of the current worker process, opened once
+_reader = None
+
+
+def setup_logger(debug=False):
+    level = logging.DEBUG if debug else logging.INFO
+    logging.basicConfig(level=level, format='%(asctime)s - %(levelname)s - %(message)s')
+    return logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert a raw frame spool into FITS files')
+    parser.add_argument('spool', type=str, help='Path to the spool file')
+    parser.add_argument('-o', '--output_folder', type=str, default='.',
+                        help='Folder of the FITS files (default current folder)')
+    parser.add_argument('-d', '--debug', action='store_true', help='Enable debug logging')
+    parser.add_argument('-C', '--compress', type=str, default=None, required=False,
+                        nargs='?', const='RICE',
+                        help='Enable FITS compression (RICE, GZIP, PLIO, None)')
+    parser.add_argument('-j', '--processes', type=int, default=os.cpu_count(),
+                        help='Number of conversion processes (default number of CPUs)')
+    parser.add_argument('--cube', type=int, default=None, metavar='N',
+                        help='Write multi-frame FITS files of N frames instead of a file per frame')
+    parser.add_argument('--cube_mode', type=str, default='cube', choices=CUBE_MODES,
+                        help='Multi-frame file layout, 3D cube or multi-extension (default cube)')
+    args = parser.parse_args()
+    if args.cube is not None and args.compress and args.cube_mode == 'cube':
+        parser.error('compressed multi-frame files need --cube_mode mef')
+    return args
+
+
+def _open_spool(path):
+    global _reader
+    _reader = SpoolReader(path)
+
+
+def convert_frames(start, stop, output_folder, compress):
+    """Write the spool frames start to stop - 1 into a FITS file each """
+    for index in range(start, stop):
+        filename = f'frame{_reader.metadata(index)["sequence"]:06d}.fits'
+        fitsio.write(os.path.join(output_folder, filename), _reader.read(index),
+                     header=_reader.fits_header(index, filename), compress=compress, clobber=True)
+    return stop - start
+
+
+def convert_cube(file_number, start, stop, output_folder, compress, cube_mode):
+    """Write the spool frames start to stop - 1 into one multi-frame file """
+    with CubeWriter(output_folder, frames_per_file=stop - start, mode=cube_mode,
+                    compress=compress, first_file=file_number) as cube_writer:
+        for index in range(start, stop):
+            metadata = _reader.metadata(index)
+            cube_writer.write(_reader.read(index), _reader.fits_header(index, ''),
+                              metadata['sequence'])
+    return stop - start
+
+
+def _run_task(task):
+    function, args = task
+    return function(*args)
+
+
+def main():
+    args = parse_args()
+    logger = setup_logger(args.debug)
+
+    with SpoolReader(args.spool) as reader:
+        n_frames = len(reader)
+        logger.info(f'{args.spool}: {n_frames} of {reader.n_slots} frames written, '
+                    f'{reader.shape} {reader.dtype}')
+
+    if args.cube is not None:
+        tasks = [(convert_cube, (file_number, start, min(start + args.cube, n_frames),
+                                 args.output_folder, args.compress, args.cube_mode))
+                 for file_number, start in enumerate(range(0, n_frames, args.cube))]
+    else:
+        tasks = [(convert_frames, (start, min(start + CHUNK_SIZE, n_frames),
+                                   args.output_folder, args.compress))
+                 for start in range(0, n_frames, CHUNK_SIZE)]
+
+    start_time = time.perf_counter()
+    n_converted = 0
+    with multiprocessing.Pool(args.processes, initializer=_open_spool,
+                              initargs=(args.spool,)) as pool:
+        for n_task_frames in pool.imap_unordered(_run_task, tasks):
+            n_converted += n_task_frames
+            logger.debug(f'Converted {n_converted} of {n_frames} frames')
+    elapsed_time = time.perf_counter() - start_time
+
+    logger.info(f'Converted {n_converted} frames with {args.processes} processes in '
+                f'{elapsed_time:.3f} seconds, {n_converted / elapsed_time:.2f} frames/s')
+
+
+if __name__ == '__main__':
+    main()
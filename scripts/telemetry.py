@@ -0,0 +1,160 @@
+import collections
+import threading
+import time
+
+# Controls sampled by default
+DEFAULT_CONTROLS = ('TEMPERATURE', 'COOLER_POWER_PERC', 'EXPOSURE', 'GAIN')
+
+# ASI_ERROR_INVALID_CONTROL_TYPE, the error reading a control the camera does not have
+UNSUPPORTED_CONTROL = 3
+
+# Scale of the raw SDK values of controls not already in natural units
+telemetry_scale = {'TEMPERATURE': 0.1}  # tenths of degree C
+
+
+class TelemetrySampler(object):
+    """Background sampling of camera control values.
+
+    Reading a control is a blocking USB round trip, so instead of reading e.g. the sensor
+    temperature before every frame, a background thread polls the controls on its own
+    schedule and keeps a timestamped history of each. The capture loop then gets the latest
+    or time-interpolated value for a frame without touching the SDK.
+
+    Values are floats in the SDK units, e.g. microseconds for EXPOSURE, except for the
+    controls in telemetry_scale, e.g. TEMPERATURE in degree C. Timestamps are host times in
+    seconds since epoch (time.time()).
+    """
+
+    def __init__(self, driver, camera_ID, controls=DEFAULT_CONTROLS, interval=1.0,
+                 history_size=3600):
+        """
+        Args:
+            driver (ASIDriver): driver of the camera, the camera must be open and initialised.
+            camera_ID (int): integer ID of the camera
+            controls (sequence of str): names of the controls to sample.
+            interval (float): time between samples in seconds.
+            history_size (int): number of samples kept for each control.
+        """
+        self.driver = driver
+        self.camera_ID = camera_ID
+        self.controls = tuple(controls)
+        self.interval = interval
+        self.n_samples = 0
+        self.n_errors = 0
+        self.errors = {}  # read errors by control name
+
+        self._history = {control: collections.deque(maxlen=history_size)
+                         for control in self.controls}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Take a first sample of all the controls and start the sampling thread """
+        if self.is_running:
+            return
+        self._stopping.clear()
+        self.sample()
+        self._thread = threading.Thread(target=self._run,
+                                        name=f'Telemetry-{self.camera_ID}',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the sampling thread, the history is kept """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def sample(self):
+        """Read all the controls once and add the values to the history.
+
+        A control which cannot be read is left out of this sample only, the others are still
+        recorded. A control the camera does not have is no longer sampled.
+        """
+        errors = {}
+        values = self.driver.get_controls_raw(self.camera_ID, self.controls, errors)
+        for control, err in errors.items():
+            self.n_errors += 1
+            self.errors[control] = self.errors.get(control, 0) + 1
+            if getattr(err, 'error_code', None) == UNSUPPORTED_CONTROL:
+                self.controls = tuple(name for name in self.controls if name != control)
+                self.driver.logger.warning(f'Camera {self.camera_ID} has no control {control}, '
+                                           f'it is no longer sampled')
+            elif self.errors[control] == 1:
+                # a flaky control is only reported once
+                self.driver.logger.warning(f'Telemetry read of {control} of camera '
+                                           f'{self.camera_ID} failed: {err}')
+        if not values:
+            return
+        timestamp = time.time()
+        with self._lock:
+            for control, (value, _) in values.items():
+                self._history[control].append((timestamp, value * telemetry_scale.get(control, 1.0)))
+        self.n_samples += 1
+
+    def latest(self, control):
+        """Get the most recent sample of a control.
+
+        Returns:
+            (float, float) or None: timestamp and value, or None if not sampled yet.
+        """
+        with self._lock:
+            history = self._history[control]
+            return history[-1] if history else None
+
+    def value_at(self, control, timestamp):
+        """Get the value of a control at given time, interpolated between the samples.
+
+        Times outside the sampled range get the nearest sample.
+
+        Returns:
+            float or None: the value, or None if not sampled yet.
+        """
+        with self._lock:
+            history = self._history[control]
+            if not history:
+                return None
+            # The wanted time is nearly always after the last or between the last few samples
+            later = None
+            for sample in reversed(history):
+                if sample[0] <= timestamp:
+                    break
+                later = sample
+            else:
+                return later[1]
+        if later is None:
+            return sample[1]
+        (t0, v0), (t1, v1) = sample, later
+        if t1 == t0:
+            return v1
+        return v0 + (v1 - v0) * (timestamp - t0) / (t1 - t0)
+
+    def history(self, control):
+        """Get a list of all the (timestamp, value) samples of a control kept """
+        with self._lock:
+            return list(self._history[control])
+
+    # Private methods
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as err:
+                # keep sampling, the history would stop at the last sample
+                self.n_errors += 1
+                self.driver.logger.error(f'Telemetry sample of camera {self.camera_ID} failed: {err}')
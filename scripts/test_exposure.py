@@ -0,0 +1,102 @@
+"""Closed loop tests of ExposureController on simulated cameras, run with pytest.
+
+The brightness of a real frame is not proportional to the exposure: the bias offset and the
+sky add a constant, as in sim/asi_sim.c. The plants here have such an offset.
+"""
+import math
+import time
+
+import numpy as np
+import pytest
+
+from exposure import ExposureController, ExposureSchedule
+from libasi import ControlCapsEntry, control_type_codes
+
+
+class OffsetPlant(object):
+    """A camera whose brightness is offset + rate * exposure time * gain factor """
+
+    def __init__(self, offset, rate, exposure_us, gain, max_exposure_us=2000000, max_gain=570):
+        self.offset = offset
+        self.rate = rate
+        self.values = {'EXPOSURE': exposure_us, 'GAIN': gain}
+        self.caps = {control_type_codes['EXPOSURE']: _caps('Exposure', 32, max_exposure_us),
+                     control_type_codes['GAIN']: _caps('Gain', 0, max_gain)}
+
+    def get_control_caps_index(self, camera_ID):
+        return self.caps
+
+    def set_control_raw(self, camera_ID, control_type, value, auto=False):
+        self.values[control_type] = value
+
+    @property
+    def brightness(self):
+        gain_factor = 10 ** (self.values['GAIN'] / 200)
+        return min(self.offset + self.rate * self.values['EXPOSURE'] * gain_factor, 1.0)
+
+    def frame(self):
+        """A frame of the brightness, left aligned 12 bit like RAW16, and its end stamp """
+        value = int(self.brightness * 4095) << 4
+        # exposed after the last change
+        return (np.full((64, 64), value, dtype=np.uint16),
+                time.monotonic_ns() + self.values['EXPOSURE'] * 1000)
+
+
+def _caps(name, min_value, max_value):
+    return ControlCapsEntry(name, name, max_value, min_value, min_value, True, True, None)
+
+
+def run_loop(plant, n_frames, **kwargs):
+    schedule = ExposureSchedule(plant, 0, plant.values['EXPOSURE'], plant.values['GAIN'])
+    controller = ExposureController(plant, 0, schedule, **kwargs)
+    history = []
+    for _ in range(n_frames):
+        data, frame_end_ns = plant.frame()
+        brightness = controller.update(data, frame_end_ns)
+        history.append((brightness, plant.values['EXPOSURE'], plant.values['GAIN']))
+    return controller, history
+
+
+@pytest.mark.parametrize('policy', ['pid', 'step'])
+@pytest.mark.parametrize('control_gain', [False, True])
+def test_darkens_to_target_with_offset(policy, control_gain):
+    # too bright: 0.1 + 0.4 at gain 100
+    plant = OffsetPlant(0.1, 0.4 / 45000 / 10 ** 0.5, 45000, 100)
+    controller, history = run_loop(plant, 60, target=0.25, policy=policy,
+                                   control_gain=control_gain)
+    assert controller.brightness == pytest.approx(0.25, rel=0.1 + 1 / 256)
+    assert abs(controller._integral) * controller.ki <= math.log(controller.max_step) + 1e-9
+    # while too bright the gain never goes up
+    gains = [gain for _, _, gain in history]
+    assert all(later <= earlier for earlier, later in zip(gains, gains[1:]))
+
+
+@pytest.mark.parametrize('control_gain', [False, True])
+def test_brightens_to_target_with_offset(control_gain):
+    # too dark: 0.02 + 0.03, the exposure limit needs gain to reach the target
+    plant = OffsetPlant(0.02, 0.03 / 45000 / 10 ** 0.5, 45000, 100, max_exposure_us=200000)
+    controller, history = run_loop(plant, 80, target=0.25, control_gain=control_gain)
+    if control_gain:
+        assert controller.brightness == pytest.approx(0.25, rel=0.1 + 1 / 256)
+        # the gain only goes up once the exposure is at its limit
+        for brightness, exposure_us, gain in history:
+            if gain > 100:
+                assert exposure_us == 200000
+    else:
+        # at the limit, the integral does not wind up
+        assert plant.values['EXPOSURE'] == 200000
+        assert abs(controller._integral) * controller.ki <= math.log(controller.max_step) + 1e-9
+
+
+def test_recovers_after_limit():
+    # dark at the exposure limit, then the sky brightens: no wound up integral delays it
+    plant = OffsetPlant(0.02, 0.03 / 45000 / 10 ** 0.5, 45000, 100, max_exposure_us=200000)
+    schedule = ExposureSchedule(plant, 0, 45000, 100)
+    controller = ExposureController(plant, 0, schedule, target=0.25)
+    for _ in range(200):
+        controller.update(*plant.frame())
+    plant.offset = 0.1
+    plant.rate *= 20
+    for _ in range(30):
+        controller.update(*plant.frame())
+    assert controller.brightness == pytest.approx(0.25, rel=0.1 + 1 / 256)
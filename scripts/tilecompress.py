@@ -0,0 +1,182 @@
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fitstemplate import CARD_LENGTH, FITS_BLOCK, fits_types, format_card, padded_size, write_file
+
+try:
+    # the FITS tile codecs of astropy >= 5.3, private API
+    from astropy.io.fits.hdu.compressed._codecs import Rice1
+except ImportError:
+    Rice1 = None
+
+# Compression types, with the names accepted by pp_test.py -C. HCOMPRESS is left to fitsio,
+# the hcompress codec keeps global state and cannot run in several threads.
+COMPRESSION_TYPES = {'RICE': 'RICE_1',
+                     'RICE_1': 'RICE_1',
+                     'GZIP': 'GZIP_1',
+                     'GZIP_1': 'GZIP_1'}
+
+RICE_BLOCKSIZE = 32
+
+# Header keys of the compressed HDU, not taken from the frame header, BZERO and BSCALE only if
+# the dtype needs them
+_reserved_keys = {'SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'NAXIS3', 'EXTEND',
+                  'PCOUNT', 'GCOUNT', 'TFIELDS', 'BZERO', 'BSCALE', 'END'}
+
+
+def is_supported(compress):
+    """Whether TileCompressor supports a compression type name """
+    algorithm = COMPRESSION_TYPES.get(str(compress).upper())
+    return algorithm == 'GZIP_1' or (algorithm == 'RICE_1' and Rice1 is not None)
+
+
+class TileCompressor(object):
+    """Tile compression of a single frame on several cores.
+
+    cfitsio compresses a frame tile by tile on one core. The compressor splits the frame into
+    the same FITS tiles, a tile per row by default, compresses groups of tiles concurrently
+    in a thread pool, and assembles the standard tile compressed BINTABLE HDU, readable by
+    funpack, fitsio and astropy. RICE uses the astropy codec and GZIP zlib, both of which
+    release the GIL while compressing.
+
+    Example:
+        with TileCompressor('RICE', n_threads=4) as compressor:
+            compressor.write(path, data, header)
+    """
+
+    def __init__(self, compress='RICE', n_threads=None, tile_rows=1, gzip_level=1):
+        """
+        Args:
+            compress (str): compression type, one of COMPRESSION_TYPES.
+            n_threads (int, optional): number of compression threads, default number of CPUs.
+            tile_rows (int): rows per tile, cfitsio uses 1.
+            gzip_level (int): zlib compression level, cfitsio uses 1.
+        """
+        if not is_supported(compress):
+            raise ValueError(f'Unsupported parallel compression type {compress}')
+        self.algorithm = COMPRESSION_TYPES[compress.upper()]
+        self.n_threads = n_threads or os.cpu_count()
+        self.tile_rows = tile_rows
+        self.gzip_level = gzip_level
+        self._executor = ThreadPoolExecutor(self.n_threads, thread_name_prefix='TileCompressor')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown()
+
+    def compress_tiles(self, data):
+        """Compress the tiles of a frame.
+
+        Returns:
+            list of bytes: the compressed tiles, in FITS tile order.
+        """
+        if data.dtype not in fits_types or data.dtype.kind == 'f':
+            # floats would need the lossy quantization of cfitsio
+            raise ValueError(f'Unsupported frame dtype {data.dtype}')
+        if data.ndim not in (2, 3):
+            raise ValueError(f'Unsupported frame shape {data.shape}')
+        planes = data if data.ndim == 3 else data[np.newaxis]
+        n_rows = planes.shape[1]
+        tiles = [(plane, row) for plane in range(planes.shape[0])
+                 for row in range(0, n_rows, self.tile_rows)]
+
+        # a few groups of tiles per thread, a task per tile would cost more than a row
+        n_groups = min(len(tiles), self.n_threads * 4)
+        bounds = np.linspace(0, len(tiles), n_groups + 1).astype(int)
+        futures = [self._executor.submit(self._compress_group, planes, tiles[start:stop])
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+        return [tile for future in futures for tile in future.result()]
+
+    def hdu_buffers(self, data, header=None):
+        """Compress a frame into a tile compressed BINTABLE HDU.
+
+        Returns:
+            list of bytes-like: header, table, heap and padding of the HDU.
+        """
+        tiles = self.compress_tiles(data)
+        bitpix, bzero = fits_types[data.dtype]
+
+        descriptors = np.empty((len(tiles), 2), dtype='>i4')
+        descriptors[:, 0] = [len(tile) for tile in tiles]
+        descriptors[0, 1] = 0
+        descriptors[1:, 1] = np.cumsum(descriptors[:-1, 0])
+        heap_size = int(descriptors[:, 0].sum())
+
+        cards = [format_card('XTENSION', 'BINTABLE'),
+                 format_card('BITPIX', 8),
+                 format_card('NAXIS', 2),
+                 format_card('NAXIS1', descriptors.itemsize * 2),
+                 format_card('NAXIS2', len(tiles)),
+                 format_card('PCOUNT', heap_size),
+                 format_card('GCOUNT', 1),
+                 format_card('TFIELDS', 1),
+                 format_card('TTYPE1', 'COMPRESSED_DATA'),
+                 format_card('TFORM1', f'1PB({int(descriptors[:, 0].max())})'),
+                 format_card('ZIMAGE', True),
+                 format_card('ZSIMPLE', True),
+                 format_card('ZBITPIX', bitpix),
+                 format_card('ZNAXIS', data.ndim)]
+        cards += [format_card(f'ZNAXIS{axis}', size)
+                  for axis, size in enumerate(reversed(data.shape), start=1)]
+        tile_shape = (1,) * (data.ndim - 2) + (self.tile_rows, data.shape[-1])
+        cards += [format_card(f'ZTILE{axis}', size)
+                  for axis, size in enumerate(reversed(tile_shape), start=1)]
+        cards.append(format_card('ZCMPTYPE', self.algorithm))
+        if self.algorithm == 'RICE_1':
+            cards += [format_card('ZNAME1', 'BLOCKSIZE'), format_card('ZVAL1', RICE_BLOCKSIZE),
+                      format_card('ZNAME2', 'BYTEPIX'), format_card('ZVAL2', data.dtype.itemsize)]
+        reserved = _reserved_keys
+        if bzero is not None:
+            cards += [format_card('BZERO', bzero), format_card('BSCALE', 1)]
+        else:
+            # e.g. the scaling of bit packed frames
+            reserved = _reserved_keys - {'BZERO', 'BSCALE'}
+        for key, value in (header or {}).items():
+            if key not in reserved:
+                cards.append(format_card(key, value))
+        cards.append(f'{"END":{CARD_LENGTH}s}'.encode('ascii'))
+
+        header_bytes = b''.join(cards)
+        header_bytes = header_bytes.ljust(padded_size(len(header_bytes)), b' ')
+        data_size = descriptors.nbytes + heap_size
+        return [header_bytes, descriptors, b''.join(tiles), bytes(padded_size(data_size) - data_size)]
+
+    def write(self, path, data, header=None):
+        """Write a frame to a tile compressed FITS file, like fitsio.write(compress=...) does:
+        an empty primary HDU and the compressed image HDU.
+        """
+        write_file(path, self.file_buffers(data, header))
+
+    def file_buffers(self, data, header=None):
+        """Compress a frame into the buffers of a FITS file, see write() """
+        primary = b''.join([format_card('SIMPLE', True),
+                            format_card('BITPIX', 8),
+                            format_card('NAXIS', 0),
+                            format_card('EXTEND', True),
+                            f'{"END":{CARD_LENGTH}s}'.encode('ascii')]).ljust(FITS_BLOCK, b' ')
+        return [primary] + self.hdu_buffers(data, header)
+
+    # Private methods
+
+    def _compress_group(self, planes, tiles):
+        return [self._compress_tile(planes[plane, row:row + self.tile_rows]) for plane, row in tiles]
+
+    def _compress_tile(self, tile):
+        bzero = fits_types[tile.dtype][1]
+        if bzero is not None:
+            # to the signed FITS integers, value - BZERO is flipping the sign bit
+            tile = (tile ^ bzero).view(tile.dtype.str.replace('u', 'i'))
+        if self.algorithm == 'RICE_1':
+            return Rice1(blocksize=RICE_BLOCKSIZE, bytepix=tile.dtype.itemsize,
+                         tilesize=tile.size).encode(tile)
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)  # gzip format
+        return (compressor.compress(tile.astype(tile.dtype.newbyteorder('>')).tobytes())
+                + compressor.flush())
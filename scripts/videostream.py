@@ -0,0 +1,261 @@
+import collections
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from panoptes.utils import error
+
+from frameclock import FrameClock
+from libasi import TimeoutPolicy
+
+
+# What to do with a new frame when the ring buffer is full
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+
+@dataclass
+class Frame:
+    """A video frame taken from the ring buffer.
+
+    Attributes:
+        sequence (int): running number of the frame within the stream, starting at 0.
+            Gaps in the sequence are frames dropped by the ring buffer overflow policy.
+        timestamp_ns (int): time.monotonic_ns() when the frame data arrived, the stream clock
+            converts it to UTC.
+        data (numpy.ndarray): the frame data, a buffer from the driver frame pool.
+    """
+    sequence: int
+    timestamp_ns: int
+    data: np.ndarray
+
+
+class VideoStream(object):
+    """Video capture running in a dedicated acquisition thread.
+
+    The acquisition thread does nothing but call ASIDriver.wait_video_data and push the frames
+    into a fixed capacity ring buffer, so slow consumers (header building, FITS writes, ...)
+    do not delay the next ASIGetVideoData call. ctypes releases the GIL during the SDK call.
+    Each wait for a frame is bounded by the timeout, timed out waits are retried according to
+    the TimeoutPolicy, and stop() is noticed within one wait even if the camera stalls.
+
+    Consumers take frames with get() or by iterating the stream, and must hand each frame
+    back with release() when done with it, so its buffer is reused for the next frames.
+
+    When the ring buffer is full the overflow policy decides what happens:
+        'drop_oldest': the oldest frame in the buffer is discarded to make room.
+        'drop_newest': the new frame is discarded.
+        'block': the acquisition thread waits for a consumer to take a frame, and the
+            camera drops frames instead (see ASIDriver.get_dropped_frames).
+
+    Example:
+        with VideoStream(cam, cam_id, width, height, 'RAW16') as stream:
+            for frame in stream:
+                ... write frame.data ...
+                stream.release(frame)
+    """
+
+    def __init__(self, driver, camera_ID, width, height, image_type, timeout=500,
+                 capacity=16, policy='drop_oldest', timeout_policy=None, wait_histogram=None,
+                 clock=None):
+        """
+        Args:
+            driver (ASIDriver): driver of the camera, the camera must be open and initialised.
+            camera_ID (int): integer ID of the camera
+            width (int or astropy.units.Quantity): ROI width
+            height (int or astropy.units.Quantity): ROI height
+            image_type (str): image type name, e.g. 'RAW16'
+            timeout (int or astropy.units.Quantity): frame wait timeout, in ms if int.
+            capacity (int): maximum number of frames held in the ring buffer.
+            policy (str): ring buffer overflow policy, one of OVERFLOW_POLICIES.
+            timeout_policy (libasi.TimeoutPolicy, optional): retry/backoff policy for timed
+                out waits, default TimeoutPolicy().
+            wait_histogram (metrics.Histogram, optional): histogram of the time spent waiting
+                for each frame in the SDK.
+            clock (frameclock.FrameClock, optional): clock converting the frame timestamps to
+                UTC, default a new FrameClock().
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {policy}, use one of {OVERFLOW_POLICIES}')
+        if capacity < 1:
+            raise ValueError('Ring buffer capacity must be at least 1')
+
+        self.driver = driver
+        self.camera_ID = camera_ID
+        self.width = width
+        self.height = height
+        self.image_type = image_type
+        self.timeout = timeout
+        self.capacity = capacity
+        self.policy = policy
+        self.timeout_policy = timeout_policy if timeout_policy is not None else TimeoutPolicy()
+        self.wait_histogram = wait_histogram
+        self.clock = clock if clock is not None else FrameClock()
+
+        # counters
+        self.n_captured = 0  # frames received from the SDK
+        self.n_no_data = 0  # get_video_data calls returning no frame
+        self.n_dropped_oldest = 0
+        self.n_dropped_newest = 0
+        self.n_blocked = 0  # times the acquisition thread had to wait for a free slot
+        self.n_consumed = 0
+
+        self.error = None  # exception that stopped the acquisition thread, if any
+
+        self._ring = collections.deque()
+        self._condition = threading.Condition()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __iter__(self):
+        """Iterate the frames until the stream is stopped and the ring buffer is empty """
+        while True:
+            frame = self.get()
+            if frame is None:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield frame
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def depth(self):
+        """Number of frames waiting in the ring buffer """
+        return len(self._ring)
+
+    @property
+    def stats(self):
+        """Dictionary of the stream counters """
+        return {'captured': self.n_captured,
+                'no_data': self.n_no_data,
+                **self.timeout_policy.stats,
+                'dropped_oldest': self.n_dropped_oldest,
+                'dropped_newest': self.n_dropped_newest,
+                'blocked': self.n_blocked,
+                'consumed': self.n_consumed,
+                'depth': self.depth}
+
+    def start(self):
+        """Start video capture on the camera and the acquisition thread """
+        if self.is_running:
+            return
+        self._stopping.clear()
+        self.driver.start_video_capture(self.camera_ID)
+        self._thread = threading.Thread(target=self._acquire,
+                                        name=f'VideoStream-{self.camera_ID}',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the acquisition thread and video capture.
+
+        Frames already in the ring buffer stay available to get() until drained or cleared.
+        """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        with self._condition:
+            self._condition.notify_all()
+        self._thread.join()
+        self._thread = None
+        self.driver.stop_video_capture(self.camera_ID)
+
+    def get(self, timeout=None):
+        """Take the oldest frame from the ring buffer.
+
+        Args:
+            timeout (float, optional): maximum time to wait for a frame in seconds, wait
+                until a frame arrives or the stream stops if None.
+
+        Returns:
+            Frame or None: the frame, or None on timeout or if the stream stopped and the
+                ring buffer is empty.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._ring or self._stopping.is_set(),
+                                            timeout=timeout):
+                return None
+            if not self._ring:
+                return None
+            frame = self._ring.popleft()
+            self.n_consumed += 1
+            self._condition.notify_all()
+        return frame
+
+    def release(self, frame):
+        """Hand the frame buffer back to the driver frame pool """
+        self.driver.release_frame(frame.data)
+
+    def clear(self):
+        """Discard all frames waiting in the ring buffer """
+        with self._condition:
+            while self._ring:
+                self.release(self._ring.popleft())
+            self._condition.notify_all()
+
+    # Private methods
+
+    def _acquire(self):
+        sequence = 0
+        try:
+            while not self._stopping.is_set():
+                wait_start_ns = time.monotonic_ns()
+                try:
+                    data = self.driver.wait_video_data(self.camera_ID,
+                                                       self.width,
+                                                       self.height,
+                                                       self.image_type,
+                                                       self.timeout,
+                                                       policy=self.timeout_policy,
+                                                       stop_event=self._stopping)
+                except error.Timeout as err:
+                    # A stalled camera, keep trying until stopped
+                    self.driver.logger.warning(str(err))
+                    continue
+                timestamp_ns = time.monotonic_ns()
+                if self.wait_histogram is not None:
+                    self.wait_histogram.observe((timestamp_ns - wait_start_ns) / 1e9)
+                if data is None:
+                    self.n_no_data += 1
+                    continue
+                frame = Frame(sequence=sequence, timestamp_ns=timestamp_ns, data=data)
+                sequence += 1
+                self.n_captured += 1
+                self._push(frame)
+        except Exception as err:
+            self.driver.logger.error(f'Acquisition thread of camera {self.camera_ID} failed: {err}')
+            self.error = err
+            self._stopping.set()
+        finally:
+            with self._condition:
+                self._condition.notify_all()
+
+    def _push(self, frame):
+        with self._condition:
+            if len(self._ring) >= self.capacity:
+                if self.policy == 'drop_oldest':
+                    self.release(self._ring.popleft())
+                    self.n_dropped_oldest += 1
+                elif self.policy == 'drop_newest':
+                    self.release(frame)
+                    self.n_dropped_newest += 1
+                    return
+                else:
+                    self.n_blocked += 1
+                    self._condition.wait_for(lambda: len(self._ring) < self.capacity or
+                                             self._stopping.is_set())
+                    if self._stopping.is_set():
+                        self.release(frame)
+                        return
+            self._ring.append(frame)
+            self._condition.notify_all()
@@ -0,0 +1,247 @@
+import collections
+import logging
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+
+import fitsio
+import numpy as np
+from panoptes.utils import error
+
+
+def _write_worker(worker_index, shm, slot_size, tasks, done):
+    """Writer process main loop, writes the frames of the slots it is given until a None task """
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, shape, dtype, header, filename, compress = task
+        start_time = time.perf_counter()
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=slot * slot_size)
+        try:
+            fitsio.write(filename, data, header=header, compress=compress, clobber=True)
+        except Exception as err:
+            message = f'{type(err).__name__}: {err}'
+        else:
+            message = None
+        nbytes = data.nbytes
+        del data
+        done.put((slot, worker_index, nbytes, time.perf_counter() - start_time, filename, message))
+    shm.close()
+
+
+class WriterPool(object):
+    """Fixed pool of long lived FITS writer processes fed through shared memory slots.
+
+    Starting a process per frame costs a fork, and pickling the frame into it a full copy per
+    process, with hundreds of copies alive while the writes catch up. The pool instead starts
+    n_workers processes once and allocates one shared memory block of n_slots frame slots.
+    submit() copies the frame into a free slot and queues only the slot index, the header and
+    the file name, a worker writes the slot to the FITS file and hands the slot back.
+
+    At most n_slots frames are in flight. When all slots are taken submit() blocks until a
+    worker finishes a write, so a capture loop writing faster than the disks can keep up is
+    slowed down instead of piling up frames in memory.
+
+    Example:
+        with WriterPool(slot_size=data.nbytes, n_workers=4) as pool:
+            pool.submit(data, header, filename, compress='RICE')
+        logger.info(pool.stats)
+    """
+
+    def __init__(self, slot_size, n_workers=4, n_slots=16, logger=None, start_method=None,
+                 on_written=None):
+        """
+        Args:
+            slot_size (int): size of a slot in bytes, the largest frame that can be written.
+            n_workers (int): number of writer processes.
+            n_slots (int): number of shared memory frame slots, the maximum in-flight depth.
+            logger (logging.Logger, optional): logger for write errors.
+            start_method (str, optional): multiprocessing start method of the writers, default
+                is the platform default.
+            on_written (callable, optional): called with the file name of each file written,
+                from the collector thread.
+        """
+        if n_workers < 1 or n_slots < 1:
+            raise ValueError('WriterPool needs at least 1 worker and 1 slot')
+
+        self.slot_size = slot_size
+        self.n_workers = n_workers
+        self.n_slots = n_slots
+        self.logger = logger or logging.getLogger(__name__)
+        self.on_written = on_written
+
+        self.n_submitted = 0
+        self.n_completed = 0
+        self.n_errors = 0
+        self.n_blocked = 0
+        self.blocked_time = 0.0
+        self.max_in_flight = 0
+        self._worker_stats = [{'frames': 0, 'bytes': 0, 'busy_time': 0.0, 'errors': 0}
+                              for _ in range(n_workers)]
+
+        self._free = collections.deque(range(n_slots))
+        self._cond = threading.Condition()
+        self._closed = False
+
+        context = multiprocessing.get_context(start_method)
+        self._shm = shared_memory.SharedMemory(create=True, size=slot_size * n_slots)
+        self._tasks = context.Queue()
+        self._done = context.Queue()
+        self._workers = [context.Process(target=_write_worker,
+                                         args=(index, self._shm, slot_size, self._tasks, self._done),
+                                         name=f'Writer-{index}',
+                                         daemon=True)
+                         for index in range(n_workers)]
+        for worker in self._workers:
+            worker.start()
+        self._collector = threading.Thread(target=self._collect, name='WriterPool-collector',
+                                           daemon=True)
+        self._collector.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def in_flight(self):
+        """Number of frames submitted and not written yet """
+        with self._cond:
+            return self.n_slots - len(self._free)
+
+    @property
+    def worker_stats(self):
+        """List of the per worker counters, with the write throughput while busy """
+        stats = []
+        for index, counters in enumerate(self._worker_stats):
+            busy_time = counters['busy_time']
+            stats.append({'worker': index,
+                          **counters,
+                          'fps': counters['frames'] / busy_time if busy_time > 0 else 0.0,
+                          'MBps': counters['bytes'] / busy_time / 1e6 if busy_time > 0 else 0.0})
+        return stats
+
+    @property
+    def stats(self):
+        """Dictionary of the pool counters """
+        return {'submitted': self.n_submitted,
+                'completed': self.n_completed,
+                'errors': self.n_errors,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'blocked': self.n_blocked,
+                'blocked_time': self.blocked_time}
+
+    def submit(self, data, header, filename, compress=None, timeout=None):
+        """Queue a frame to be written to a FITS file.
+
+        The frame is copied into a shared memory slot before returning, so the caller can
+        reuse data straight away. Blocks while all the slots are in flight.
+
+        Args:
+            data (numpy.ndarray): the frame.
+            header (dict): FITS header keywords.
+            filename (str): path of the FITS file, overwritten if it exists.
+            compress (str, optional): fitsio compression type, e.g. 'RICE'.
+            timeout (float, optional): maximum time to wait for a free slot in seconds, default
+                is to wait as long as it takes.
+
+        Raises:
+            ValueError: if the frame does not fit in a slot.
+            panoptes.utils.error.Timeout: if no slot became free within timeout.
+            panoptes.utils.error.PanError: if the pool is closed or a writer process died.
+        """
+        if data.nbytes > self.slot_size:
+            raise ValueError(f'Frame of {data.nbytes} bytes does not fit in {self.slot_size} byte slots')
+
+        with self._cond:
+            if not self._free:
+                self.n_blocked += 1
+                start_time = time.perf_counter()
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not self._free and not self._closed:
+                    self._check_workers()
+                    wait = 1.0 if deadline is None else min(1.0, deadline - time.monotonic())
+                    if wait <= 0:
+                        self.blocked_time += time.perf_counter() - start_time
+                        raise error.Timeout(f'No free writer slot within {timeout} s')
+                    self._cond.wait(wait)
+                self.blocked_time += time.perf_counter() - start_time
+            if self._closed:
+                raise error.PanError('WriterPool is closed')
+            slot = self._free.popleft()
+            self.max_in_flight = max(self.max_in_flight, self.n_slots - len(self._free))
+
+        slot_data = np.ndarray(data.shape, dtype=data.dtype, buffer=self._shm.buf,
+                               offset=slot * self.slot_size)
+        np.copyto(slot_data, data)
+        del slot_data
+        self._tasks.put((slot, data.shape, data.dtype.str, header, filename, compress))
+        self.n_submitted += 1
+
+    def flush(self, timeout=None):
+        """Wait until all the submitted frames are written.
+
+        Raises:
+            panoptes.utils.error.Timeout: if frames are still in flight after timeout seconds.
+            panoptes.utils.error.PanError: if a writer process died.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while len(self._free) < self.n_slots:
+                self._check_workers()
+                wait = 1.0 if deadline is None else min(1.0, deadline - time.monotonic())
+                if wait <= 0:
+                    raise error.Timeout(f'{self.n_slots - len(self._free)} frames still in flight')
+                self._cond.wait(wait)
+
+    def close(self):
+        """Wait for the frames in flight, stop the writer processes and free the shared memory """
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            for _ in self._workers:
+                self._tasks.put(None)
+            for worker in self._workers:
+                worker.join()
+            self._done.put(None)
+            self._collector.join()
+            self._shm.close()
+            self._shm.unlink()
+
+    # Private methods
+
+    def _check_workers(self):
+        dead = [worker.name for worker in self._workers if worker.exitcode is not None]
+        if dead and not self._closed:
+            raise error.PanError(f'Writer processes died: {dead}')
+
+    def _collect(self):
+        while True:
+            result = self._done.get()
+            if result is None:
+                break
+            slot, worker_index, nbytes, busy_time, filename, message = result
+            counters = self._worker_stats[worker_index]
+            counters['busy_time'] += busy_time
+            if message is None:
+                counters['frames'] += 1
+                counters['bytes'] += nbytes
+                if self.on_written is not None:
+                    self.on_written(filename)
+            else:
+                counters['errors'] += 1
+                self.n_errors += 1
+                self.logger.error(f'Writing {filename} failed: {message}')
+            with self._cond:
+                self.n_completed += 1
+                self._free.append(slot)
+                self._cond.notify_all()
@@ -0,0 +1,867 @@
+/*
+ * Simulated ZWO ASICamera2 SDK shared library.
+ *
+ * Implements the ASICamera2.h functions called by libasi.ASIDriver for one or more simulated
+ * monochrome cameras producing synthetic star field frames, so the driver and the whole
+ * capture pipeline can be run and benchmarked without camera hardware:
+ *
+ *     make -C sim
+ *     ASIDriver(library_path='sim/libASICamera2_sim.so')
+ *
+ * The simulation is configured with environment variables, read when the library is loaded:
+ *
+ *     ASISIM_SERIALS     comma separated 16 hex digit serial numbers, one per camera
+ *                        (default 2d194b0013090900,0e2c420013090900)
+ *     ASISIM_MODEL       ASI183MM, ASI1600MM or ASI178MM (default ASI183MM)
+ *     ASISIM_FPS         maximum video frame rate (default 20), the frame period is never
+ *                        shorter than the exposure time
+ *     ASISIM_BIT_DEPTH   ADC bit depth (default from model), RAW16 data is left shifted to
+ *                        16 bits like the real cameras do
+ *     ASISIM_DROP_RATE   probability of a frame being dropped by the camera (default 0)
+ *     ASISIM_STARS       number of stars in the field (default 200)
+ *     ASISIM_NOISE       read noise in ADU (default 8)
+ *     ASISIM_EVENT_RATE  probability of a frame having a meteor like streak (default 0)
+ *     ASISIM_SEED        random seed (default 1)
+ *
+ * Frames not read within ASISIM_BUFFERS frame periods are dropped and counted by
+ * ASIGetDroppedFrames, as the SDK does when the host does not keep up.
+ */
+#include <math.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+/* ASI_ERROR_CODE */
+#define ASI_SUCCESS 0
+#define ASI_ERROR_INVALID_INDEX 1
+#define ASI_ERROR_INVALID_ID 2
+#define ASI_ERROR_INVALID_CONTROL_TYPE 3
+#define ASI_ERROR_CAMERA_CLOSED 4
+#define ASI_ERROR_INVALID_SIZE 8
+#define ASI_ERROR_INVALID_IMGTYPE 9
+#define ASI_ERROR_OUTOF_BOUNDARY 10
+#define ASI_ERROR_TIMEOUT 11
+#define ASI_ERROR_INVALID_SEQUENCE 12
+#define ASI_ERROR_BUFFER_TOO_SMALL 13
+#define ASI_ERROR_VIDEO_MODE_ACTIVE 14
+#define ASI_ERROR_EXPOSURE_IN_PROGRESS 15
+#define ASI_ERROR_GENERAL_ERROR 16
+#define ASI_ERROR_INVALID_MODE 17
+
+/* ASI_IMG_TYPE */
+#define ASI_IMG_RAW8 0
+#define ASI_IMG_RGB24 1
+#define ASI_IMG_RAW16 2
+#define ASI_IMG_Y8 3
+#define ASI_IMG_END -1
+
+/* ASI_CONTROL_TYPE */
+enum {
+    ASI_GAIN = 0, ASI_EXPOSURE, ASI_GAMMA, ASI_WB_R, ASI_WB_B, ASI_OFFSET,
+    ASI_BANDWIDTHOVERLOAD, ASI_OVERCLOCK, ASI_TEMPERATURE, ASI_FLIP, ASI_AUTO_MAX_GAIN,
+    ASI_AUTO_MAX_EXP, ASI_AUTO_TARGET_BRIGHTNESS, ASI_HARDWARE_BIN, ASI_HIGH_SPEED_MODE,
+    ASI_COOLER_POWER_PERC, ASI_TARGET_TEMP, ASI_COOLER_ON, ASI_MONO_BIN, ASI_FAN_ON,
+    ASI_PATTERN_ADJUST, ASI_ANTI_DEW_HEATER, N_CONTROL_TYPES
+};
+
+/* ASI_EXPOSURE_STATUS */
+#define ASI_EXP_IDLE 0
+#define ASI_EXP_WORKING 1
+#define ASI_EXP_SUCCESS 2
+#define ASI_EXP_FAILED 3
+
+#define MAX_CAMERAS 8
+#define ASISIM_BUFFERS 2
+#define AMBIENT_TEMP 20.0
+#define COOLING_TIME_CONSTANT 30.0
+
+typedef struct _ASI_CAMERA_INFO {
+    char Name[64];
+    int CameraID;
+    long MaxHeight;
+    long MaxWidth;
+    int IsColorCam;
+    int BayerPattern;
+    int SupportedBins[16];
+    int SupportedVideoFormat[8];
+    double PixelSize;
+    int MechanicalShutter;
+    int ST4Port;
+    int IsCoolerCam;
+    int IsUSB3Host;
+    int IsUSB3Camera;
+    float ElecPerADU;
+    int BitDepth;
+    int IsTriggerCam;
+    char Unused[16];
+} ASI_CAMERA_INFO;
+
+typedef struct _ASI_CONTROL_CAPS {
+    char Name[64];
+    char Description[128];
+    long MaxValue;
+    long MinValue;
+    long DefaultValue;
+    int IsAutoSupported;
+    int IsWritable;
+    int ControlType;
+    char Unused[32];
+} ASI_CONTROL_CAPS;
+
+typedef struct _ASI_ID {
+    unsigned char id[8];
+} ASI_ID;
+
+typedef struct _ASI_SUPPORTED_MODE {
+    int SupportedCameraMode[16];
+} ASI_SUPPORTED_MODE;
+
+typedef struct {
+    const char *name;
+    long width;
+    long height;
+    double pixel_size;
+    int bit_depth;
+    float e_per_adu;
+} model_t;
+
+static const model_t models[] = {
+    {"ZWO ASI183MM Pro", 5496, 3672, 2.4, 12, 0.25f},
+    {"ZWO ASI1600MM Pro", 4656, 3520, 3.8, 12, 0.31f},
+    {"ZWO ASI178MM", 3096, 2080, 2.4, 14, 0.06f},
+};
+
+/* Controls of the simulated cameras, with their SDK names and limits */
+static const ASI_CONTROL_CAPS controls[] = {
+    {"Gain", "Gain", 570, 0, 200, 1, 1, ASI_GAIN, ""},
+    {"Exposure", "Exposure Time(us)", 2000000000, 32, 10000, 1, 1, ASI_EXPOSURE, ""},
+    {"Offset", "offset", 80, 0, 10, 0, 1, ASI_OFFSET, ""},
+    {"BandWidth", "The total data transfer rate percentage", 100, 40, 50, 1, 1,
+     ASI_BANDWIDTHOVERLOAD, ""},
+    {"Flip", "Flip: 0->None 1->Horiz 2->Vert 3->Both", 3, 0, 0, 0, 1, ASI_FLIP, ""},
+    {"AutoExpMaxGain", "Auto exposure maximum gain value", 285, 0, 285, 0, 1,
+     ASI_AUTO_MAX_GAIN, ""},
+    {"AutoExpMaxExpMS", "Auto exposure maximum exposure value(unit ms)", 60000, 1, 30000, 0,
+     1, ASI_AUTO_MAX_EXP, ""},
+    {"AutoExpTargetBrightness", "Auto exposure target brightness value", 160, 50, 100, 0, 1,
+     ASI_AUTO_TARGET_BRIGHTNESS, ""},
+    {"HardwareBin", "Is hardware bin2:0->No 1->Yes", 1, 0, 0, 0, 1, ASI_HARDWARE_BIN, ""},
+    {"HighSpeedMode", "Is high speed mode:0->No 1->Yes", 1, 0, 0, 0, 1, ASI_HIGH_SPEED_MODE,
+     ""},
+    {"Temperature", "Sensor temperature(degrees Celsius)", 1000, -500, 20, 0, 0,
+     ASI_TEMPERATURE, ""},
+    {"CoolPowerPerc", "Cooler power percent", 100, 0, 0, 0, 0, ASI_COOLER_POWER_PERC, ""},
+    {"TargetTemp", "Target temperature(cool camera only)", 30, -40, 0, 0, 1, ASI_TARGET_TEMP,
+     ""},
+    {"CoolerOn", "turn on/off cooler(cool camera only)", 1, 0, 0, 0, 1, ASI_COOLER_ON, ""},
+    {"AntiDewHeater", "turn on/off anti dew heater", 1, 0, 0, 0, 1, ASI_ANTI_DEW_HEATER, ""},
+};
+#define N_CONTROLS ((int)(sizeof(controls) / sizeof(controls[0])))
+
+typedef struct {
+    double x;
+    double y;
+    double flux; /* ADU per second at gain 0 */
+} star_t;
+
+typedef struct {
+    unsigned char serial[8];
+    unsigned char id[8];
+    int is_open;
+    int is_initialised;
+    int is_capturing;
+    int width, height, bin, img_type;
+    int start_x, start_y;
+    long values[N_CONTROL_TYPES];
+    int is_auto[N_CONTROL_TYPES];
+    int dropped_frames;
+    int64_t next_frame_ns;
+    int64_t cooler_on_ns;
+    double cooling_from;
+    int exp_status;
+    int64_t exp_end_ns;
+    uint64_t rng;
+    uint16_t *scratch;
+    size_t scratch_size;
+    pthread_mutex_t lock;
+} camera_t;
+
+static const model_t *model = &models[0];
+static camera_t cameras[MAX_CAMERAS];
+static int n_cameras;
+static double max_fps = 20.0;
+static int bit_depth;
+static double drop_rate;
+static double event_rate;
+static double read_noise = 8.0;
+static int n_stars = 200;
+static star_t *stars;
+static int16_t *noise;
+static size_t noise_size;
+static const int product_ids[] = {0x183, 0x1600, 0x178};
+
+/* xorshift64* */
+static uint64_t next_random(uint64_t *state)
+{
+    uint64_t x = *state;
+    x ^= x >> 12;
+    x ^= x << 25;
+    x ^= x >> 27;
+    *state = x;
+    return x * 2685821657736338717ULL;
+}
+
+static double uniform(uint64_t *state)
+{
+    return (next_random(state) >> 11) * (1.0 / 9007199254740992.0);
+}
+
+static int64_t now_ns(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (int64_t)ts.tv_sec * 1000000000LL + ts.tv_nsec;
+}
+
+static void sleep_ns(int64_t ns)
+{
+    struct timespec ts;
+    if (ns <= 0)
+        return;
+    ts.tv_sec = ns / 1000000000LL;
+    ts.tv_nsec = ns % 1000000000LL;
+    while (nanosleep(&ts, &ts) != 0)
+        ;
+}
+
+static double env_double(const char *name, double fallback)
+{
+    const char *value = getenv(name);
+    return value && *value ? atof(value) : fallback;
+}
+
+static int parse_serial(const char *text, unsigned char *serial)
+{
+    unsigned int byte;
+    int i;
+    for (i = 0; i < 8; i++) {
+        if (sscanf(text + 2 * i, "%2x", &byte) != 1)
+            return 0;
+        serial[i] = (unsigned char)byte;
+    }
+    return 1;
+}
+
+__attribute__((constructor)) static void sim_init(void)
+{
+    const char *serials = getenv("ASISIM_SERIALS");
+    const char *model_name = getenv("ASISIM_MODEL");
+    char buffer[MAX_CAMERAS * 17 + 1];
+    uint64_t rng;
+    char *token;
+    size_t i;
+    int c;
+
+    if (model_name) {
+        for (i = 0; i < sizeof(models) / sizeof(models[0]); i++)
+            if (strstr(models[i].name, model_name))
+                model = &models[i];
+    }
+    max_fps = env_double("ASISIM_FPS", max_fps);
+    bit_depth = (int)env_double("ASISIM_BIT_DEPTH", model->bit_depth);
+    if (bit_depth < 8 || bit_depth > 16)
+        bit_depth = model->bit_depth;
+    drop_rate = env_double("ASISIM_DROP_RATE", 0.0);
+    event_rate = env_double("ASISIM_EVENT_RATE", 0.0);
+    read_noise = env_double("ASISIM_NOISE", read_noise);
+    n_stars = (int)env_double("ASISIM_STARS", n_stars);
+    rng = (uint64_t)env_double("ASISIM_SEED", 1) * 0x9E3779B97F4A7C15ULL + 1;
+
+    snprintf(buffer, sizeof(buffer), "%s",
+             serials ? serials : "2d194b0013090900,0e2c420013090900");
+    for (token = strtok(buffer, ","); token && n_cameras < MAX_CAMERAS; token = strtok(NULL, ",")) {
+        camera_t *camera = &cameras[n_cameras];
+        if (!parse_serial(token, camera->serial))
+            continue;
+        memcpy(camera->id, "ASISIM  ", 8);
+        pthread_mutex_init(&camera->lock, NULL);
+        camera->rng = rng + 7919 * (n_cameras + 1);
+        n_cameras++;
+    }
+
+    /* Stars in full frame pixel coordinates, fluxes following a rough power law */
+    stars = malloc(sizeof(star_t) * (n_stars > 0 ? n_stars : 1));
+    for (c = 0; c < n_stars; c++) {
+        stars[c].x = uniform(&rng) * model->width;
+        stars[c].y = uniform(&rng) * model->height;
+        stars[c].flux = 2000.0 / pow(uniform(&rng) + 0.01, 1.5);
+    }
+
+    /* Shared table of gaussian read noise, frames start at a random offset into it */
+    noise_size = (size_t)model->width * model->height + 65536;
+    noise = malloc(noise_size * sizeof(int16_t));
+    for (i = 0; i < noise_size; i++) {
+        double sum = uniform(&rng) + uniform(&rng) + uniform(&rng) + uniform(&rng) - 2.0;
+        noise[i] = (int16_t)lrint(sum * read_noise * 1.732);
+    }
+}
+
+static camera_t *get_camera(int iCameraID, int must_be_open)
+{
+    if (iCameraID < 0 || iCameraID >= n_cameras)
+        return NULL;
+    if (must_be_open && !cameras[iCameraID].is_open)
+        return NULL;
+    return &cameras[iCameraID];
+}
+
+static const ASI_CONTROL_CAPS *get_caps(int control_type)
+{
+    int i;
+    for (i = 0; i < N_CONTROLS; i++)
+        if (controls[i].ControlType == control_type)
+            return &controls[i];
+    return NULL;
+}
+
+static double sensor_temperature(camera_t *camera)
+{
+    double target = camera->values[ASI_TARGET_TEMP];
+    double elapsed;
+    if (!camera->values[ASI_COOLER_ON])
+        return AMBIENT_TEMP;
+    elapsed = (now_ns() - camera->cooler_on_ns) / 1e9;
+    return target + (camera->cooling_from - target) * exp(-elapsed / COOLING_TIME_CONSTANT);
+}
+
+static int64_t frame_period_ns(camera_t *camera)
+{
+    int64_t period = (int64_t)(1e9 / (max_fps > 0 ? max_fps : 1e9));
+    int64_t exposure = (int64_t)camera->values[ASI_EXPOSURE] * 1000;
+    return exposure > period ? exposure : period;
+}
+
+/* Render a frame of the current ROI and settings into buffer */
+static int render_frame(camera_t *camera, unsigned char *buffer, long size)
+{
+    size_t n_pixels = (size_t)camera->width * camera->height;
+    int bytes_per_pixel = camera->img_type == ASI_IMG_RAW16 ? 2 : 1;
+    double exposure = camera->values[ASI_EXPOSURE] / 1e6;
+    double gain = pow(10.0, camera->values[ASI_GAIN] / 200.0);
+    double seeing = 0.7 + 1.5 * uniform(&camera->rng); /* PSF sigma in full frame pixels */
+    double jitter_x = (uniform(&camera->rng) - 0.5) * 2.0;
+    double jitter_y = (uniform(&camera->rng) - 0.5) * 2.0;
+    int max_value = (1 << bit_depth) - 1;
+    int background = 16 * (int)camera->values[ASI_OFFSET] + (int)(200.0 * exposure * gain) + 4 * read_noise;
+    size_t offset = next_random(&camera->rng) % (noise_size - n_pixels);
+    uint16_t *pixels;
+    size_t i;
+    int s;
+
+    if ((size_t)size < n_pixels * bytes_per_pixel)
+        return ASI_ERROR_BUFFER_TOO_SMALL;
+    if (camera->scratch_size < n_pixels) {
+        free(camera->scratch);
+        camera->scratch = malloc(n_pixels * sizeof(uint16_t));
+        camera->scratch_size = n_pixels;
+    }
+    pixels = camera->scratch;
+
+    for (i = 0; i < n_pixels; i++) {
+        int value = background + noise[offset + i];
+        pixels[i] = (uint16_t)(value < 0 ? 0 : value > max_value ? max_value : value);
+    }
+
+    /* Stars, gaussian PSF in binned pixels */
+    {
+        double sigma = seeing / camera->bin;
+        int radius = (int)ceil(3 * sigma);
+        double scale = exposure * gain / (2 * M_PI * sigma * sigma);
+        for (s = 0; s < n_stars; s++) {
+            double x = (stars[s].x + jitter_x) / camera->bin - camera->start_x;
+            double y = (stars[s].y + jitter_y) / camera->bin - camera->start_y;
+            double peak = stars[s].flux * scale;
+            int cx = (int)x, cy = (int)y, px, py;
+            if (x < -radius || y < -radius || x >= camera->width + radius ||
+                y >= camera->height + radius)
+                continue;
+            for (py = cy - radius; py <= cy + radius; py++) {
+                double gy;
+                if (py < 0 || py >= camera->height)
+                    continue;
+                gy = exp(-0.5 * (py - y) * (py - y) / (sigma * sigma));
+                for (px = cx - radius; px <= cx + radius; px++) {
+                    int value;
+                    if (px < 0 || px >= camera->width)
+                        continue;
+                    value = pixels[(size_t)py * camera->width + px] +
+                            (int)(peak * gy * exp(-0.5 * (px - x) * (px - x) / (sigma * sigma)));
+                    pixels[(size_t)py * camera->width + px] =
+                        (uint16_t)(value > max_value ? max_value : value);
+                }
+            }
+        }
+    }
+
+    /* Occasional meteor like streak */
+    if (event_rate > 0 && uniform(&camera->rng) < event_rate) {
+        double x = uniform(&camera->rng) * camera->width;
+        double y = uniform(&camera->rng) * camera->height;
+        double angle = uniform(&camera->rng) * 2 * M_PI;
+        int length = camera->width / 10 + 1, step;
+        for (step = 0; step < length; step++) {
+            int px = (int)(x + step * cos(angle)), py = (int)(y + step * sin(angle)), dy;
+            for (dy = -1; dy <= 1; dy++) {
+                if (px < 0 || px >= camera->width || py + dy < 0 || py + dy >= camera->height)
+                    continue;
+                pixels[(size_t)(py + dy) * camera->width + px] = (uint16_t)(max_value * 3 / 4);
+            }
+        }
+    }
+
+    /* Convert to the output format, RAW16 is left aligned in 16 bits */
+    if (bytes_per_pixel == 2) {
+        uint16_t *out = (uint16_t *)buffer;
+        int shift = 16 - bit_depth;
+        for (i = 0; i < n_pixels; i++)
+            out[i] = (uint16_t)(pixels[i] << shift);
+    } else {
+        int shift = bit_depth - 8;
+        for (i = 0; i < n_pixels; i++)
+            buffer[i] = (unsigned char)(pixels[i] >> shift);
+    }
+    return ASI_SUCCESS;
+}
+
+static void fill_info(ASI_CAMERA_INFO *info, int id)
+{
+    memset(info, 0, sizeof(*info));
+    snprintf(info->Name, sizeof(info->Name), "%s", model->name);
+    info->CameraID = id;
+    info->MaxHeight = model->height;
+    info->MaxWidth = model->width;
+    info->SupportedBins[0] = 1;
+    info->SupportedBins[1] = 2;
+    info->SupportedBins[2] = 3;
+    info->SupportedBins[3] = 4;
+    info->SupportedVideoFormat[0] = ASI_IMG_RAW8;
+    info->SupportedVideoFormat[1] = ASI_IMG_RAW16;
+    info->SupportedVideoFormat[2] = ASI_IMG_Y8;
+    info->SupportedVideoFormat[3] = ASI_IMG_END;
+    info->PixelSize = model->pixel_size;
+    info->ST4Port = 1;
+    info->IsCoolerCam = 1;
+    info->IsUSB3Host = 1;
+    info->IsUSB3Camera = 1;
+    info->ElecPerADU = model->e_per_adu;
+    info->BitDepth = bit_depth;
+}
+
+int ASIGetNumOfConnectedCameras(void) { return n_cameras; }
+
+int ASIGetProductIDs(int *pPIDs)
+{
+    if (pPIDs)
+        memcpy(pPIDs, product_ids, sizeof(product_ids));
+    return sizeof(product_ids) / sizeof(product_ids[0]);
+}
+
+const char *ASIGetSDKVersion(void) { return "1, 37, 0, 0"; }
+
+int ASIGetCameraProperty(ASI_CAMERA_INFO *pASICameraInfo, int iCameraIndex)
+{
+    if (iCameraIndex < 0 || iCameraIndex >= n_cameras)
+        return ASI_ERROR_INVALID_INDEX;
+    fill_info(pASICameraInfo, iCameraIndex);
+    return ASI_SUCCESS;
+}
+
+int ASIGetCameraPropertyByID(int iCameraID, ASI_CAMERA_INFO *pASICameraInfo)
+{
+    if (!get_camera(iCameraID, 0))
+        return ASI_ERROR_INVALID_ID;
+    fill_info(pASICameraInfo, iCameraID);
+    return ASI_SUCCESS;
+}
+
+int ASIOpenCamera(int iCameraID)
+{
+    camera_t *camera = get_camera(iCameraID, 0);
+    if (!camera)
+        return ASI_ERROR_INVALID_ID;
+    camera->is_open = 1;
+    return ASI_SUCCESS;
+}
+
+int ASIInitCamera(int iCameraID)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    int i;
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    pthread_mutex_lock(&camera->lock);
+    for (i = 0; i < N_CONTROLS; i++)
+        camera->values[controls[i].ControlType] = controls[i].DefaultValue;
+    camera->values[ASI_TEMPERATURE] = (long)(AMBIENT_TEMP * 10);
+    camera->width = (int)model->width;
+    camera->height = (int)model->height;
+    camera->bin = 1;
+    camera->img_type = ASI_IMG_RAW8;
+    camera->start_x = camera->start_y = 0;
+    camera->is_initialised = 1;
+    pthread_mutex_unlock(&camera->lock);
+    return ASI_SUCCESS;
+}
+
+int ASICloseCamera(int iCameraID)
+{
+    camera_t *camera = get_camera(iCameraID, 0);
+    if (!camera)
+        return ASI_ERROR_INVALID_ID;
+    pthread_mutex_lock(&camera->lock);
+    camera->is_open = camera->is_initialised = camera->is_capturing = 0;
+    free(camera->scratch);
+    camera->scratch = NULL;
+    camera->scratch_size = 0;
+    pthread_mutex_unlock(&camera->lock);
+    return ASI_SUCCESS;
+}
+
+int ASIGetNumOfControls(int iCameraID, int *piNumberOfControls)
+{
+    if (!get_camera(iCameraID, 1))
+        return ASI_ERROR_CAMERA_CLOSED;
+    *piNumberOfControls = N_CONTROLS;
+    return ASI_SUCCESS;
+}
+
+int ASIGetControlCaps(int iCameraID, int iControlIndex, ASI_CONTROL_CAPS *pControlCaps)
+{
+    if (!get_camera(iCameraID, 1))
+        return ASI_ERROR_CAMERA_CLOSED;
+    if (iControlIndex < 0 || iControlIndex >= N_CONTROLS)
+        return ASI_ERROR_INVALID_INDEX;
+    *pControlCaps = controls[iControlIndex];
+    return ASI_SUCCESS;
+}
+
+int ASIGetControlValue(int iCameraID, int ControlType, long *plValue, int *pbAuto)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    if (!get_caps(ControlType))
+        return ASI_ERROR_INVALID_CONTROL_TYPE;
+    pthread_mutex_lock(&camera->lock);
+    if (ControlType == ASI_TEMPERATURE) {
+        *plValue = lrint(sensor_temperature(camera) * 10);
+    } else if (ControlType == ASI_COOLER_POWER_PERC) {
+        double delta = AMBIENT_TEMP - sensor_temperature(camera);
+        *plValue = camera->values[ASI_COOLER_ON] ? lrint(delta > 0 ? 20 + 2 * delta : 0) : 0;
+        if (*plValue > 100)
+            *plValue = 100;
+    } else {
+        *plValue = camera->values[ControlType];
+    }
+    *pbAuto = camera->is_auto[ControlType];
+    pthread_mutex_unlock(&camera->lock);
+    return ASI_SUCCESS;
+}
+
+int ASISetControlValue(int iCameraID, int ControlType, long lValue, int bAuto)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    const ASI_CONTROL_CAPS *caps = get_caps(ControlType);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    if (!caps)
+        return ASI_ERROR_INVALID_CONTROL_TYPE;
+    if (!caps->IsWritable || lValue < caps->MinValue || lValue > caps->MaxValue)
+        return ASI_ERROR_GENERAL_ERROR;
+    pthread_mutex_lock(&camera->lock);
+    if (ControlType == ASI_COOLER_ON && lValue && !camera->values[ASI_COOLER_ON]) {
+        camera->cooling_from = sensor_temperature(camera);
+        camera->cooler_on_ns = now_ns();
+    }
+    camera->values[ControlType] = lValue;
+    camera->is_auto[ControlType] = bAuto && caps->IsAutoSupported;
+    pthread_mutex_unlock(&camera->lock);
+    return ASI_SUCCESS;
+}
+
+int ASISetROIFormat(int iCameraID, int iWidth, int iHeight, int iBin, int Img_type)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    if (camera->is_capturing)
+        return ASI_ERROR_VIDEO_MODE_ACTIVE;
+    if (Img_type != ASI_IMG_RAW8 && Img_type != ASI_IMG_RAW16 && Img_type != ASI_IMG_Y8)
+        return ASI_ERROR_INVALID_IMGTYPE;
+    if (iBin < 1 || iBin > 4 || iWidth <= 0 || iHeight <= 0 || iWidth % 8 || iHeight % 2 ||
+        (long)iWidth * iBin > model->width || (long)iHeight * iBin > model->height)
+        return ASI_ERROR_INVALID_SIZE;
+    pthread_mutex_lock(&camera->lock);
+    camera->width = iWidth;
+    camera->height = iHeight;
+    camera->bin = iBin;
+    camera->img_type = Img_type;
+    /* The SDK centres the new ROI */
+    camera->start_x = (int)((model->width / iBin - iWidth) / 2);
+    camera->start_y = (int)((model->height / iBin - iHeight) / 2);
+    pthread_mutex_unlock(&camera->lock);
+    return ASI_SUCCESS;
+}
+
+int ASIGetROIFormat(int iCameraID, int *piWidth, int *piHeight, int *piBin, int *pImg_type)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    *piWidth = camera->width;
+    *piHeight = camera->height;
+    *piBin = camera->bin;
+    *pImg_type = camera->img_type;
+    return ASI_SUCCESS;
+}
+
+int ASISetStartPos(int iCameraID, int iStartX, int iStartY)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    if (iStartX < 0 || iStartY < 0 || iStartX + camera->width > model->width / camera->bin ||
+        iStartY + camera->height > model->height / camera->bin)
+        return ASI_ERROR_OUTOF_BOUNDARY;
+    camera->start_x = iStartX;
+    camera->start_y = iStartY;
+    return ASI_SUCCESS;
+}
+
+int ASIGetStartPos(int iCameraID, int *piStartX, int *piStartY)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    *piStartX = camera->start_x;
+    *piStartY = camera->start_y;
+    return ASI_SUCCESS;
+}
+
+int ASIGetDroppedFrames(int iCameraID, int *piDropFrames)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    *piDropFrames = camera->dropped_frames;
+    return ASI_SUCCESS;
+}
+
+int ASIEnableDarkSubtract(int iCameraID, char *pcBMPPath) { return ASI_ERROR_GENERAL_ERROR; }
+
+int ASIDisableDarkSubtract(int iCameraID)
+{
+    return get_camera(iCameraID, 1) ? ASI_SUCCESS : ASI_ERROR_CAMERA_CLOSED;
+}
+
+int ASIStartVideoCapture(int iCameraID)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    pthread_mutex_lock(&camera->lock);
+    camera->is_capturing = 1;
+    camera->dropped_frames = 0;
+    camera->next_frame_ns = now_ns() + frame_period_ns(camera);
+    pthread_mutex_unlock(&camera->lock);
+    return ASI_SUCCESS;
+}
+
+int ASIStopVideoCapture(int iCameraID)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    camera->is_capturing = 0;
+    return ASI_SUCCESS;
+}
+
+int ASIGetVideoData(int iCameraID, unsigned char *pBuffer, long lBuffSize, int iWaitms)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    int64_t deadline, period, now;
+    int result;
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    if (!camera->is_capturing)
+        return ASI_ERROR_INVALID_SEQUENCE;
+
+    now = now_ns();
+    deadline = iWaitms < 0 ? INT64_MAX : now + (int64_t)iWaitms * 1000000LL;
+    pthread_mutex_lock(&camera->lock);
+    period = frame_period_ns(camera);
+    /* Frames not read in time are lost, the camera only buffers a few */
+    if (now - camera->next_frame_ns > ASISIM_BUFFERS * period) {
+        int64_t lost = (now - camera->next_frame_ns) / period - ASISIM_BUFFERS + 1;
+        camera->dropped_frames += (int)lost;
+        camera->next_frame_ns += lost * period;
+    }
+    for (;;) {
+        int64_t frame_ns = camera->next_frame_ns;
+        if (frame_ns > deadline) {
+            pthread_mutex_unlock(&camera->lock);
+            sleep_ns(deadline - now_ns());
+            return ASI_ERROR_TIMEOUT;
+        }
+        camera->next_frame_ns += period;
+        if (drop_rate > 0 && uniform(&camera->rng) < drop_rate) {
+            camera->dropped_frames++;
+            continue;
+        }
+        pthread_mutex_unlock(&camera->lock);
+        sleep_ns(frame_ns - now_ns());
+        break;
+    }
+    pthread_mutex_lock(&camera->lock);
+    result = render_frame(camera, pBuffer, lBuffSize);
+    pthread_mutex_unlock(&camera->lock);
+    return result;
+}
+
+int ASIPulseGuideOn(int iCameraID, int direction)
+{
+    return get_camera(iCameraID, 1) ? ASI_SUCCESS : ASI_ERROR_CAMERA_CLOSED;
+}
+
+int ASIPulseGuideOff(int iCameraID, int direction)
+{
+    return get_camera(iCameraID, 1) ? ASI_SUCCESS : ASI_ERROR_CAMERA_CLOSED;
+}
+
+int ASIStartExposure(int iCameraID, int bIsDark)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    if (camera->is_capturing)
+        return ASI_ERROR_VIDEO_MODE_ACTIVE;
+    camera->exp_status = ASI_EXP_WORKING;
+    camera->exp_end_ns = now_ns() + camera->values[ASI_EXPOSURE] * 1000;
+    return ASI_SUCCESS;
+}
+
+int ASIStopExposure(int iCameraID)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    if (camera->exp_status == ASI_EXP_WORKING)
+        camera->exp_status = ASI_EXP_FAILED;
+    return ASI_SUCCESS;
+}
+
+int ASIGetExpStatus(int iCameraID, int *pExpStatus)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    if (camera->exp_status == ASI_EXP_WORKING && now_ns() >= camera->exp_end_ns)
+        camera->exp_status = ASI_EXP_SUCCESS;
+    *pExpStatus = camera->exp_status;
+    return ASI_SUCCESS;
+}
+
+int ASIGetDataAfterExp(int iCameraID, unsigned char *pBuffer, long lBuffSize)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    int result;
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    if (camera->exp_status != ASI_EXP_SUCCESS)
+        return ASI_ERROR_GENERAL_ERROR;
+    pthread_mutex_lock(&camera->lock);
+    result = render_frame(camera, pBuffer, lBuffSize);
+    camera->exp_status = ASI_EXP_IDLE;
+    pthread_mutex_unlock(&camera->lock);
+    return result;
+}
+
+int ASIGetID(int iCameraID, ASI_ID *pID)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    memcpy(pID->id, camera->id, 8);
+    return ASI_SUCCESS;
+}
+
+int ASISetID(int iCameraID, ASI_ID ID)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    memcpy(camera->id, ID.id, 8);
+    return ASI_SUCCESS;
+}
+
+int ASIGetGainOffset(int iCameraID, int *pOffset_HighestDR, int *pOffset_UnityGain,
+                     int *pGain_LowestRN, int *pOffset_LowestRN)
+{
+    if (!get_camera(iCameraID, 1))
+        return ASI_ERROR_CAMERA_CLOSED;
+    *pOffset_HighestDR = 10;
+    *pOffset_UnityGain = 21;
+    *pGain_LowestRN = 270;
+    *pOffset_LowestRN = 30;
+    return ASI_SUCCESS;
+}
+
+int ASIGetCameraSupportMode(int iCameraID, ASI_SUPPORTED_MODE *pSupportedMode)
+{
+    if (!get_camera(iCameraID, 1))
+        return ASI_ERROR_CAMERA_CLOSED;
+    memset(pSupportedMode, 0, sizeof(*pSupportedMode));
+    pSupportedMode->SupportedCameraMode[0] = 0;
+    pSupportedMode->SupportedCameraMode[1] = -1;
+    return ASI_SUCCESS;
+}
+
+int ASIGetCameraMode(int iCameraID, int *mode)
+{
+    if (!get_camera(iCameraID, 1))
+        return ASI_ERROR_CAMERA_CLOSED;
+    *mode = 0;
+    return ASI_SUCCESS;
+}
+
+int ASISetCameraMode(int iCameraID, int mode)
+{
+    if (!get_camera(iCameraID, 1))
+        return ASI_ERROR_CAMERA_CLOSED;
+    return mode == 0 ? ASI_SUCCESS : ASI_ERROR_INVALID_MODE;
+}
+
+int ASISendSoftTrigger(int iCameraID, int bStart) { return ASI_ERROR_GENERAL_ERROR; }
+
+int ASIGetSerialNumber(int iCameraID, ASI_ID *pSN)
+{
+    camera_t *camera = get_camera(iCameraID, 1);
+    if (!camera)
+        return ASI_ERROR_CAMERA_CLOSED;
+    memcpy(pSN->id, camera->serial, 8);
+    return ASI_SUCCESS;
+}
+
+int ASISetTriggerOutputIOConf(int iCameraID, int pin, int bPinHigh, long lDelay, long lDuration)
+{
+    return ASI_ERROR_GENERAL_ERROR;
+}
+
+int ASIGetTriggerOutputIOConf(int iCameraID, int pin, int *bPinHigh, long *lDelay,
+                              long *lDuration)
+{
+    return ASI_ERROR_GENERAL_ERROR;
+}
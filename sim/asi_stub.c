@@ -0,0 +1,251 @@
+/*
+ * Stub of the ZWO ASICamera2 SDK shared library.
+ *
+ * Every function returns immediately with ASI_SUCCESS and fixed values, so calling it measures
+ * nothing but the Python/ctypes call overhead of libasi.ASIDriver (see scripts/bench_ctypes.py).
+ * Only the function signatures and structures of ASICamera2.h used by libasi are declared.
+ *
+ * Build with: make -C sim
+ */
+#include <string.h>
+
+#define ASI_SUCCESS 0
+#define ASI_ERROR_INVALID_INDEX 1
+#define ASI_ERROR_INVALID_CONTROL_TYPE 3
+
+typedef struct _ASI_CAMERA_INFO {
+    char Name[64];
+    int CameraID;
+    long MaxHeight;
+    long MaxWidth;
+    int IsColorCam;
+    int BayerPattern;
+    int SupportedBins[16];
+    int SupportedVideoFormat[8];
+    double PixelSize;
+    int MechanicalShutter;
+    int ST4Port;
+    int IsCoolerCam;
+    int IsUSB3Host;
+    int IsUSB3Camera;
+    float ElecPerADU;
+    int BitDepth;
+    int IsTriggerCam;
+    char Unused[16];
+} ASI_CAMERA_INFO;
+
+typedef struct _ASI_CONTROL_CAPS {
+    char Name[64];
+    char Description[128];
+    long MaxValue;
+    long MinValue;
+    long DefaultValue;
+    int IsAutoSupported;
+    int IsWritable;
+    int ControlType;
+    char Unused[32];
+} ASI_CONTROL_CAPS;
+
+typedef struct _ASI_ID {
+    unsigned char id[8];
+} ASI_ID;
+
+typedef struct _ASI_SUPPORTED_MODE {
+    int SupportedCameraMode[16];
+} ASI_SUPPORTED_MODE;
+
+static const int product_ids[] = {0x183, 0x1600};
+static long control_values[32];
+
+int ASIGetNumOfConnectedCameras(void) { return 1; }
+
+int ASIGetProductIDs(int *pPIDs)
+{
+    if (pPIDs)
+        memcpy(pPIDs, product_ids, sizeof(product_ids));
+    return sizeof(product_ids) / sizeof(product_ids[0]);
+}
+
+const char *ASIGetSDKVersion(void) { return "1, 37, 0, 0"; }
+
+static void fill_info(ASI_CAMERA_INFO *info, int id)
+{
+    memset(info, 0, sizeof(*info));
+    strcpy(info->Name, "ZWO ASI183MM Pro (stub)");
+    info->CameraID = id;
+    info->MaxHeight = 3672;
+    info->MaxWidth = 5496;
+    info->SupportedBins[0] = 1;
+    info->SupportedBins[1] = 2;
+    info->SupportedVideoFormat[0] = 0;
+    info->SupportedVideoFormat[1] = 2;
+    info->SupportedVideoFormat[2] = -1;
+    info->PixelSize = 2.4;
+    info->IsCoolerCam = 1;
+    info->IsUSB3Host = 1;
+    info->IsUSB3Camera = 1;
+    info->ElecPerADU = 0.25f;
+    info->BitDepth = 12;
+}
+
+int ASIGetCameraProperty(ASI_CAMERA_INFO *pASICameraInfo, int iCameraIndex)
+{
+    if (iCameraIndex != 0)
+        return ASI_ERROR_INVALID_INDEX;
+    fill_info(pASICameraInfo, iCameraIndex);
+    return ASI_SUCCESS;
+}
+
+int ASIGetCameraPropertyByID(int iCameraID, ASI_CAMERA_INFO *pASICameraInfo)
+{
+    fill_info(pASICameraInfo, iCameraID);
+    return ASI_SUCCESS;
+}
+
+int ASIOpenCamera(int iCameraID) { return ASI_SUCCESS; }
+int ASIInitCamera(int iCameraID) { return ASI_SUCCESS; }
+int ASICloseCamera(int iCameraID) { return ASI_SUCCESS; }
+
+int ASIGetNumOfControls(int iCameraID, int *piNumberOfControls)
+{
+    *piNumberOfControls = 1;
+    return ASI_SUCCESS;
+}
+
+int ASIGetControlCaps(int iCameraID, int iControlIndex, ASI_CONTROL_CAPS *pControlCaps)
+{
+    memset(pControlCaps, 0, sizeof(*pControlCaps));
+    strcpy(pControlCaps->Name, "Gain");
+    strcpy(pControlCaps->Description, "Gain");
+    pControlCaps->MaxValue = 570;
+    pControlCaps->IsAutoSupported = 1;
+    pControlCaps->IsWritable = 1;
+    return ASI_SUCCESS;
+}
+
+int ASIGetControlValue(int iCameraID, int ControlType, long *plValue, int *pbAuto)
+{
+    if (ControlType < 0 || ControlType >= 32)
+        return ASI_ERROR_INVALID_CONTROL_TYPE;
+    *plValue = control_values[ControlType];
+    *pbAuto = 0;
+    return ASI_SUCCESS;
+}
+
+int ASISetControlValue(int iCameraID, int ControlType, long lValue, int bAuto)
+{
+    if (ControlType < 0 || ControlType >= 32)
+        return ASI_ERROR_INVALID_CONTROL_TYPE;
+    control_values[ControlType] = lValue;
+    return ASI_SUCCESS;
+}
+
+int ASISetROIFormat(int iCameraID, int iWidth, int iHeight, int iBin, int Img_type)
+{
+    return ASI_SUCCESS;
+}
+
+int ASIGetROIFormat(int iCameraID, int *piWidth, int *piHeight, int *piBin, int *pImg_type)
+{
+    *piWidth = 5496;
+    *piHeight = 3672;
+    *piBin = 1;
+    *pImg_type = 2;
+    return ASI_SUCCESS;
+}
+
+int ASISetStartPos(int iCameraID, int iStartX, int iStartY) { return ASI_SUCCESS; }
+
+int ASIGetStartPos(int iCameraID, int *piStartX, int *piStartY)
+{
+    *piStartX = 0;
+    *piStartY = 0;
+    return ASI_SUCCESS;
+}
+
+int ASIGetDroppedFrames(int iCameraID, int *piDropFrames)
+{
+    *piDropFrames = 0;
+    return ASI_SUCCESS;
+}
+
+int ASIEnableDarkSubtract(int iCameraID, char *pcBMPPath) { return ASI_SUCCESS; }
+int ASIDisableDarkSubtract(int iCameraID) { return ASI_SUCCESS; }
+int ASIStartVideoCapture(int iCameraID) { return ASI_SUCCESS; }
+int ASIStopVideoCapture(int iCameraID) { return ASI_SUCCESS; }
+
+int ASIGetVideoData(int iCameraID, unsigned char *pBuffer, long lBuffSize, int iWaitms)
+{
+    return ASI_SUCCESS;
+}
+
+int ASIPulseGuideOn(int iCameraID, int direction) { return ASI_SUCCESS; }
+int ASIPulseGuideOff(int iCameraID, int direction) { return ASI_SUCCESS; }
+int ASIStartExposure(int iCameraID, int bIsDark) { return ASI_SUCCESS; }
+int ASIStopExposure(int iCameraID) { return ASI_SUCCESS; }
+
+int ASIGetExpStatus(int iCameraID, int *pExpStatus)
+{
+    *pExpStatus = 2;
+    return ASI_SUCCESS;
+}
+
+int ASIGetDataAfterExp(int iCameraID, unsigned char *pBuffer, long lBuffSize)
+{
+    return ASI_SUCCESS;
+}
+
+int ASIGetID(int iCameraID, ASI_ID *pID)
+{
+    memcpy(pID->id, "STUB0000", 8);
+    return ASI_SUCCESS;
+}
+
+int ASISetID(int iCameraID, ASI_ID ID) { return ASI_SUCCESS; }
+
+int ASIGetGainOffset(int iCameraID, int *pOffset_HighestDR, int *pOffset_UnityGain,
+                     int *pGain_LowestRN, int *pOffset_LowestRN)
+{
+    *pOffset_HighestDR = 70;
+    *pOffset_UnityGain = 30;
+    *pGain_LowestRN = 270;
+    *pOffset_LowestRN = 30;
+    return ASI_SUCCESS;
+}
+
+int ASIGetCameraSupportMode(int iCameraID, ASI_SUPPORTED_MODE *pSupportedMode)
+{
+    pSupportedMode->SupportedCameraMode[0] = 0;
+    pSupportedMode->SupportedCameraMode[1] = -1;
+    return ASI_SUCCESS;
+}
+
+int ASIGetCameraMode(int iCameraID, int *mode)
+{
+    *mode = 0;
+    return ASI_SUCCESS;
+}
+
+int ASISetCameraMode(int iCameraID, int mode) { return ASI_SUCCESS; }
+int ASISendSoftTrigger(int iCameraID, int bStart) { return ASI_SUCCESS; }
+
+int ASIGetSerialNumber(int iCameraID, ASI_ID *pSN)
+{
+    static const unsigned char sn[8] = {0x2d, 0x19, 0x4b, 0x00, 0x13, 0x09, 0x09, 0x00};
+    memcpy(pSN->id, sn, 8);
+    return ASI_SUCCESS;
+}
+
+int ASISetTriggerOutputIOConf(int iCameraID, int pin, int bPinHigh, long lDelay, long lDuration)
+{
+    return ASI_SUCCESS;
+}
+
+int ASIGetTriggerOutputIOConf(int iCameraID, int pin, int *bPinHigh, long *lDelay,
+                              long *lDuration)
+{
+    *bPinHigh = 1;
+    *lDelay = 0;
+    *lDuration = 0;
+    return ASI_SUCCESS;
+}